@@ -0,0 +1,71 @@
+"""
+Compares parsing the date columns of a UCR export with
+``parse_date_columns()`` against passing ``parse_date()`` to
+``pandas.read_csv()`` as its ``date_parser``.
+
+Run from the root of the repository:
+
+    $ python -m benchmarks.parse_dates
+
+"""
+import io
+import random
+import timeit
+import warnings
+from datetime import datetime, timedelta
+
+import pandas
+
+from hq_superset.utils import parse_date, parse_date_columns
+
+ROWS = 100_000
+DATE_COLUMNS = ['inserted_at', 'visit_date', 'lmp_date']
+REPEAT = 5
+
+
+def get_csv():
+    start = datetime(2020, 1, 1)
+
+    def random_datetime():
+        return start + timedelta(seconds=random.randrange(10 ** 8))
+
+    lines = ['doc_id,' + ','.join(DATE_COLUMNS)]
+    for i in range(ROWS):
+        inserted_at = random_datetime().isoformat(sep=' ')
+        visit_date = random_datetime().date().isoformat()
+        lmp_date = '' if i % 10 == 0 else random_datetime().date().isoformat()
+        lines.append(f'doc{i},{inserted_at},{visit_date},{lmp_date}')
+    return '\n'.join(lines)
+
+
+def read_with_date_parser(csv):
+    with warnings.catch_warnings():
+        # ``date_parser`` is deprecated in pandas 2
+        warnings.simplefilter('ignore', FutureWarning)
+        return pandas.read_csv(
+            io.StringIO(csv),
+            parse_dates=DATE_COLUMNS,
+            date_parser=parse_date,
+        )
+
+
+def read_with_parse_date_columns(csv):
+    df = pandas.read_csv(io.StringIO(csv))
+    return parse_date_columns(df, DATE_COLUMNS)
+
+
+def main():
+    csv = get_csv()
+    assert read_with_date_parser(csv).equals(read_with_parse_date_columns(csv))
+
+    for func in (read_with_date_parser, read_with_parse_date_columns):
+        seconds = min(timeit.repeat(
+            lambda: func(csv),
+            repeat=REPEAT,
+            number=1,
+        ))
+        print(f'{func.__name__:>28}: {ROWS / seconds:>10,.0f} rows/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""
+Parsing UCR exports with PyArrow
+
+PyArrow parses CSV files in C++, using several threads, and reads
+exports in columnar formats (Parquet and Arrow IPC), which need no
+parsing. It is an optional dependency. Use ``is_pyarrow_available()``
+to check whether it is installed.
+"""
+import pandas
+
+from .utils import parse_date_columns
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.csv
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+def is_pyarrow_available():
+    return pyarrow is not None
+
+
+def get_arrow_column_types(column_dtypes, date_columns, array_columns):
+    """
+    Maps the Pandas data types returned by ``get_column_dtypes()`` to
+    Arrow data types. Dates and arrays are read as strings, and
+    converted after they have been read.
+
+    >>> get_arrow_column_types(
+    ...     {'doc_id': 'string', 'count': 'Int64', 'visit_date': 'string'},
+    ...     date_columns=['visit_date'],
+    ...     array_columns=[],
+    ... )
+    {'doc_id': DataType(string), 'count': DataType(int64), 'visit_date': DataType(string)}
+
+    """
+    arrow_types = {
+        'string': pyarrow.string(),
+        'Int64': pyarrow.int64(),
+        'Float64': pyarrow.float64(),
+        'Int8': pyarrow.int8(),
+    }
+    column_types = {
+        column: arrow_types[dtype]
+        for column, dtype in column_dtypes.items()
+    }
+    for column in [*date_columns, *array_columns]:
+        column_types[column] = pyarrow.string()
+    return column_types
+
+
+def read_csv_chunks(
+    csv_file,
+    column_dtypes,
+    date_columns,
+    array_columns,
+    block_size,
+    columns=None,
+):
+    """
+    Reads ``csv_file`` with PyArrow, and yields DataFrames of about
+    ``block_size`` bytes of CSV data each. The DataFrames have the same
+    data types as DataFrames read with ``pandas.read_csv()`` using
+    ``column_dtypes``, with dates parsed.
+
+    If ``columns`` is given, only those columns are read.
+    """
+    reader = pyarrow.csv.open_csv(
+        csv_file,
+        read_options=pyarrow.csv.ReadOptions(
+            block_size=block_size,
+            use_threads=True,
+        ),
+        convert_options=pyarrow.csv.ConvertOptions(
+            column_types=get_arrow_column_types(
+                column_dtypes,
+                date_columns,
+                array_columns,
+            ),
+            strings_can_be_null=True,
+            include_columns=columns,
+        ),
+    )
+    for batch in reader:
+        yield record_batch_to_dataframe(batch, date_columns)
+
+
+def read_columnar_chunks(
+    path,
+    export_format,
+    column_dtypes,
+    date_columns,
+    array_columns,
+    batch_size,
+    columns=None,
+):
+    """
+    Reads the Parquet or Arrow IPC file at ``path``, and yields
+    DataFrames with the same data types as ``read_csv_chunks()``,
+    except that array columns are lists. If ``columns`` is given, only
+    those columns are read.
+
+    Parquet files are read ``batch_size`` rows at a time. Arrow IPC
+    files are read in the record batches they were written in.
+    """
+    column_types = get_arrow_column_types(column_dtypes, (), ())
+    column_types.update({
+        column: pyarrow.timestamp('ns') for column in date_columns
+    })
+    column_types.update({
+        column: pyarrow.list_(pyarrow.string()) for column in array_columns
+    })
+    for batch in _iter_record_batches(
+        path,
+        export_format,
+        batch_size,
+        columns,
+    ):
+        batch = cast_record_batch(batch, column_types)
+        yield record_batch_to_dataframe(batch, date_columns)
+
+
+def _iter_record_batches(path, export_format, batch_size, columns=None):
+    if export_format == 'parquet':
+        # Parquet files are stored by column, so other columns are not
+        # read at all
+        yield from pyarrow.parquet.ParquetFile(path).iter_batches(
+            batch_size=batch_size,
+            columns=columns,
+        )
+        return
+
+    with pyarrow.memory_map(path) as source:
+        try:
+            reader = pyarrow.ipc.open_file(source)
+            batches = (
+                reader.get_batch(i) for i in range(reader.num_record_batches)
+            )
+        except pyarrow.ArrowInvalid:
+            # Not the IPC file format. Try the streaming format.
+            source.seek(0)
+            batches = pyarrow.ipc.open_stream(source)
+        for batch in batches:
+            yield batch.select(columns) if columns else batch
+
+
+def cast_record_batch(batch, column_types):
+    """
+    Casts the columns of ``batch`` to the types in ``column_types``. A
+    column that cannot be cast is left as it is, e.g. a column of dates
+    in a format that Arrow does not recognize.
+    """
+    arrays = []
+    for name, array in zip(batch.schema.names, batch.columns):
+        arrow_type = column_types.get(name)
+        if arrow_type is not None and array.type != arrow_type:
+            try:
+                array = pyarrow.compute.cast(array, arrow_type)
+            except (pyarrow.ArrowInvalid, pyarrow.ArrowNotImplementedError):
+                pass
+        arrays.append(array)
+    return pyarrow.RecordBatch.from_arrays(arrays, names=batch.schema.names)
+
+
+def record_batch_to_dataframe(batch, date_columns=()):
+    """
+    Converts an Arrow record batch to a DataFrame with Pandas nullable
+    data types. Dates are parsed by Arrow if they are all in one of the
+    formats that CommCare HQ uses, and otherwise by ``parse_dates()``.
+    List columns are converted to columns of Python lists.
+    """
+    arrays = []
+    unparsed_date_columns = []
+    list_columns = {}
+    for name, array in zip(batch.schema.names, batch.columns):
+        if name in date_columns and pyarrow.types.is_string(array.type):
+            try:
+                array = pyarrow.compute.cast(array, pyarrow.timestamp('ns'))
+            except pyarrow.ArrowInvalid:
+                unparsed_date_columns.append(name)
+        if pyarrow.types.is_list(array.type):
+            list_columns[name] = array.to_pylist()
+        arrays.append(array)
+    batch = pyarrow.RecordBatch.from_arrays(arrays, names=batch.schema.names)
+    df = batch.to_pandas(types_mapper=_get_pandas_dtype)
+    for name, values in list_columns.items():
+        df[name] = pandas.Series(values, index=df.index, dtype=object)
+    return parse_date_columns(df, unparsed_date_columns)
+
+
+def _get_pandas_dtype(arrow_type):
+    return {
+        pyarrow.string(): pandas.StringDtype(),
+        pyarrow.int64(): pandas.Int64Dtype(),
+        pyarrow.int8(): pandas.Int8Dtype(),
+        pyarrow.float64(): pandas.Float64Dtype(),
+        pyarrow.bool_(): pandas.BooleanDtype(),
+    }.get(arrow_type)
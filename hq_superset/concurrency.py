@@ -0,0 +1,561 @@
+"""
+Limits on the number of UCR imports that run at the same time, and the
+order in which waiting imports run
+
+An import task holds a slot for the whole import. There are
+``HQ_IMPORT_CONCURRENCY`` slots in total, and
+``HQ_IMPORT_CONCURRENCY_PER_DOMAIN`` slots for each domain, so that
+importing all the data sources of a domain does not overwhelm CommCare
+HQ or the HQ database. A task that cannot get a slot is retried later.
+
+Slots are PostgreSQL session-level advisory locks in the HQ database.
+They are held by a connection that stays open during the import, and if
+a worker dies, its connection is closed and its slots are freed. The
+task also holds a lock for the data source, so that only one import of
+it runs at a time, and so that the dispatcher can tell which imports
+are running.
+
+Imports that are queued with ``queue_import()`` wait in the import
+queue until ``start_queued_imports()`` gives them a turn. Domains take
+turns, so that a domain with many imports waiting does not hold up the
+imports of other domains.
+"""
+import logging
+import time
+import zlib
+from collections import Counter, deque
+from contextlib import contextmanager
+
+import sqlalchemy
+from flask import current_app
+from sqlalchemy.sql import text
+from superset import db
+
+from .loaders import supports_copy
+from .metrics import ImportMetrics
+from .models import ImportQueueItem
+from .utils import get_hq_database
+
+# Default limits. Override with ``HQ_IMPORT_CONCURRENCY`` and
+# ``HQ_IMPORT_CONCURRENCY_PER_DOMAIN`` in superset_config.py.
+IMPORT_CONCURRENCY = 4
+IMPORT_CONCURRENCY_PER_DOMAIN = 2
+# Seconds before a task that could not get a slot is retried
+IMPORT_SLOT_RETRY_DELAY = 30
+# Relative shares of slots, by domain. Domains have a weight of 1 by
+# default. Override with ``HQ_IMPORT_DOMAIN_WEIGHTS``.
+IMPORT_DOMAIN_WEIGHTS = {}
+# Seconds that the task of a started import has to take its slot. After
+# that, if the import is not running, its task is taken to be lost, e.g.
+# because its worker died, and the import is queued again.
+IMPORT_START_TIMEOUT = 15 * 60
+# Seconds after which a started import is queued again if the HQ
+# database is not PostgreSQL, and running imports cannot be seen
+IMPORT_QUEUE_TIMEOUT = 24 * 60 * 60
+# Times an import is started before it is removed from the queue, so
+# that an import that kills its worker is not retried forever
+IMPORT_MAX_ATTEMPTS = 3
+
+GLOBAL_SLOTS_NAME = 'hq_superset.import'
+DATASOURCE_LOCK_NAME = 'hq_superset.import.datasource'
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def import_slot(domain, datasource_id=None):
+    """
+    Yields True if a slot is free for an import for ``domain``, and
+    holds it until the context exits. Yields False if all the slots, or
+    all the domain's slots, are taken.
+
+    If ``datasource_id`` is given, the data source's lock is held too,
+    and False is yielded if another import of it is running.
+
+    Imports are not limited if the HQ database is not PostgreSQL.
+    """
+    database = get_hq_database()
+    if not supports_copy(database):
+        yield True
+        return
+
+    locks = [get_datasource_lock(datasource_id)] if datasource_id else []
+    with database.get_sqla_engine_with_context() as engine:
+        with hold_slots(engine, locks + [
+            (
+                GLOBAL_SLOTS_NAME,
+                current_app.config.get(
+                    'HQ_IMPORT_CONCURRENCY',
+                    IMPORT_CONCURRENCY,
+                ),
+            ),
+            (
+                f'{GLOBAL_SLOTS_NAME}:{domain}',
+                current_app.config.get(
+                    'HQ_IMPORT_CONCURRENCY_PER_DOMAIN',
+                    IMPORT_CONCURRENCY_PER_DOMAIN,
+                ),
+            ),
+        ]) as acquired:
+            yield acquired
+
+
+@contextmanager
+def datasource_lock(datasource_id):
+    """
+    Yields True if no import of the data source is running, and holds
+    its lock until the context exits, so that none starts. Yields False
+    if an import of it is running.
+
+    Yields True if the HQ database is not PostgreSQL.
+    """
+    database = get_hq_database()
+    if not supports_copy(database):
+        yield True
+        return
+
+    with database.get_sqla_engine_with_context() as engine:
+        with hold_slots(engine, [get_datasource_lock(datasource_id)]) as acquired:
+            yield acquired
+
+
+@contextmanager
+def hold_slots(engine, slots):
+    """
+    Takes one slot of each of ``slots``, a list of ``(name, limit)``
+    tuples, and yields True, or yields False if any of them has no free
+    slot. Slots are held until the context exits.
+
+    ``slots`` can also include ``(lock_class, key)`` tuples of integers,
+    for a single lock.
+    """
+    # Locks are held between transactions, so the connection must not
+    # be left idle in a transaction for the length of an import
+    connection = engine.connect().execution_options(
+        isolation_level='AUTOCOMMIT',
+    )
+    try:
+        acquired = all(
+            _try_lock_slot(connection, name, limit) for name, limit in slots
+        )
+        if not acquired:
+            # Free any slots that were taken, for other imports to use
+            _unlock_all(connection)
+        yield acquired
+    finally:
+        _unlock_all(connection)
+        connection.close()
+
+
+def _unlock_all(connection):
+    try:
+        connection.execute(text('SELECT pg_advisory_unlock_all()'))
+    except sqlalchemy.exc.DBAPIError:
+        # The connection is broken. Its locks were freed with it.
+        connection.invalidate()
+
+
+def _try_lock_slot(connection, name, limit):
+    if isinstance(name, int):
+        lock_class, slots = name, [limit]
+    else:
+        lock_class, slots = get_lock_class(name), range(limit)
+    for slot in slots:
+        if connection.execute(
+            text('SELECT pg_try_advisory_lock(:lock_class, :slot)'),
+            {'lock_class': lock_class, 'slot': slot},
+        ).scalar():
+            return True
+    return False
+
+
+def get_lock_class(name):
+    """
+    Returns a 32-bit signed integer for ``name``, to use as the first
+    key of an advisory lock.
+
+    >>> get_lock_class('hq_superset.import:demo')
+    -540309210
+
+    """
+    return _to_int32(zlib.crc32(name.encode('utf-8')))
+
+
+def _to_int32(key):
+    """
+    Returns the unsigned 32-bit integer ``key`` as a signed one.
+
+    >>> _to_int32(3754658086)
+    -540309210
+
+    """
+    return key - 2 ** 32 if key >= 2 ** 31 else key
+
+
+def get_datasource_lock(datasource_id):
+    """
+    Returns the ``(lock_class, key)`` of the advisory lock that the
+    import of a data source holds while it runs. Data sources whose IDs
+    have the same CRC share a lock, which only means that their imports
+    do not run at the same time.
+    """
+    return (
+        get_lock_class(DATASOURCE_LOCK_NAME),
+        get_lock_class(datasource_id),
+    )
+
+
+def get_held_locks():
+    """
+    Returns the set of ``(lock_class, key)`` advisory locks that are
+    held in the HQ database, or None if it is not PostgreSQL.
+    """
+    database = get_hq_database()
+    if not supports_copy(database):
+        return None
+    with database.get_sqla_engine_with_context() as engine:
+        with engine.connect() as connection:
+            rows = connection.execute(text(
+                "SELECT classid::bigint, objid::bigint FROM pg_locks "
+                "WHERE locktype = 'advisory' AND granted AND objsubid = 2 "
+                "AND database = ("
+                "  SELECT oid FROM pg_database "
+                "  WHERE datname = current_database()"
+                ")"
+            )).fetchall()
+    return {(_to_int32(c), _to_int32(k)) for c, k in rows}
+
+
+def is_import_running(datasource_id, held_locks):
+    """
+    Returns True if an import of the data source holds its lock, given
+    ``held_locks`` returned by ``get_held_locks()``.
+    """
+    return get_datasource_lock(datasource_id) in held_locks
+
+
+def count_held_slots(name, held_locks):
+    lock_class = get_lock_class(name)
+    return sum(1 for c, __ in held_locks if c == lock_class)
+
+
+def queue_import(
+    domain,
+    datasource_id,
+    user_id,
+    incremental=False,
+    subscription_urls=None,
+):
+    """
+    Adds an import of the data source to the import queue. Returns
+    False if the data source is already queued.
+
+    The import's task makes its requests to CommCare HQ with the
+    user's saved OAuth token (see ``oauth.SharedOAuthToken``), and
+    subscribes to changes with ``subscription_urls`` (see
+    ``services.get_subscription_urls()``).
+    """
+    if get_queued_import(domain, datasource_id):
+        return False
+    item = ImportQueueItem(
+        domain=domain,
+        datasource_id=datasource_id,
+        user_id=user_id,
+        incremental=incremental,
+        queued_at=time.time(),
+    )
+    if subscription_urls:
+        item.webhook_url = subscription_urls['webhook_url']
+        item.token_url = subscription_urls['token_url']
+    db.session.add(item)
+    db.session.commit()
+    return True
+
+
+def get_queued_import(domain, datasource_id):
+    return (
+        db.session.query(ImportQueueItem)
+        .filter_by(domain=domain, datasource_id=datasource_id)
+        .one_or_none()
+    )
+
+
+def start_queued_imports(start_import):
+    """
+    Starts waiting imports while there are free slots, in the order
+    given by ``choose_imports()``. ``start_import(item)`` queues the
+    Celery task of an ``ImportQueueItem``, and returns the task's ID.
+    Each import is claimed before its task is queued, so that
+    dispatchers that run at the same time do not start it twice.
+
+    Imports that hold slots without being in the queue, i.e. those run
+    by ``refresh_hq_datasource_task``, are counted as running.
+
+    Sends how long each import waited, and the queue depth and wait
+    time of each domain, to the metrics sink.
+    """
+    held_locks = get_held_locks()
+    _requeue_lost_imports(held_locks)
+    items = (
+        db.session.query(ImportQueueItem)
+        .order_by(ImportQueueItem.queued_at)
+        .all()
+    )
+    waiting = [item for item in items if not item.is_running]
+    running = Counter(item.domain for item in items if item.is_running)
+    total_running = sum(running.values())
+    if held_locks is not None:
+        # Imports that have been started, but have not taken their slots
+        # yet, and imports that hold slots
+        starting = [
+            item for item in items
+            if item.is_running
+            and not is_import_running(item.datasource_id, held_locks)
+        ]
+        running = Counter(item.domain for item in starting)
+        for domain in {item.domain for item in waiting}:
+            running[domain] += count_held_slots(
+                f'{GLOBAL_SLOTS_NAME}:{domain}',
+                held_locks,
+            )
+        total_running = len(starting) + count_held_slots(
+            GLOBAL_SLOTS_NAME,
+            held_locks,
+        )
+    free_slots = current_app.config.get(
+        'HQ_IMPORT_CONCURRENCY',
+        IMPORT_CONCURRENCY,
+    ) - total_running
+    chosen = choose_imports(
+        waiting,
+        running,
+        free_slots,
+        current_app.config.get(
+            'HQ_IMPORT_CONCURRENCY_PER_DOMAIN',
+            IMPORT_CONCURRENCY_PER_DOMAIN,
+        ),
+        current_app.config.get(
+            'HQ_IMPORT_DOMAIN_WEIGHTS',
+            IMPORT_DOMAIN_WEIGHTS,
+        ),
+    )
+    for item in chosen:
+        if not _claim_import(item):
+            # Another dispatcher started it
+            continue
+        try:
+            item.task_id = start_import(item)
+        except Exception:
+            item.started_at = None
+            db.session.commit()
+            raise
+        db.session.commit()
+        ImportMetrics(item.domain, item.datasource_id).send(
+            'wait',
+            seconds=item.started_at - item.queued_at,
+        )
+    for domain in {item.domain for item in items}:
+        send_queue_metrics(domain, [i for i in items if i.domain == domain])
+
+
+def _claim_import(item):
+    """
+    Marks a waiting import as started, and returns True, unless it has
+    already been started, e.g. by a dispatcher running at the same
+    time.
+    """
+    started_at = time.time()
+    claimed = (
+        db.session.query(ImportQueueItem)
+        .filter(ImportQueueItem.id == item.id)
+        .filter(ImportQueueItem.started_at.is_(None))
+        .update(
+            {
+                'started_at': started_at,
+                'attempts': ImportQueueItem.attempts + 1,
+            },
+            synchronize_session=False,
+        )
+    )
+    db.session.commit()
+    if claimed:
+        db.session.refresh(item)
+    return bool(claimed)
+
+
+def take_queued_import(domain, datasource_id, task_id):
+    """
+    Returns the data source's queued import, and records that the task
+    ``task_id`` is running it. Returns None if it is not in the queue,
+    e.g. because the task was delivered again after its import was
+    queued again and run by another task.
+
+    Must be called while holding the data source's lock (see
+    ``import_slot()``), so that no other task is running the import.
+    """
+    item = get_queued_import(domain, datasource_id)
+    if item is None:
+        return None
+    if item.task_id != task_id:
+        # The import was queued again, or given to another task that
+        # has not started it yet. That task will find it gone.
+        if not item.is_running:
+            item.attempts += 1
+        item.started_at = time.time()
+        item.task_id = task_id
+        db.session.commit()
+    return item
+
+
+def finish_queued_import(domain, datasource_id):
+    """
+    Removes a finished import from the import queue.
+    """
+    db.session.query(ImportQueueItem).filter_by(
+        domain=domain,
+        datasource_id=datasource_id,
+    ).delete()
+    db.session.commit()
+    send_queue_metrics(domain, get_queued_imports(domain))
+
+
+def get_queued_datasource_ids():
+    """
+    Returns the IDs of the data sources whose imports are waiting or
+    running.
+    """
+    return {
+        datasource_id for datasource_id, in
+        db.session.query(ImportQueueItem.datasource_id)
+    }
+
+
+def get_queued_imports(domain):
+    """
+    Returns the domain's imports that are waiting or running, in the
+    order they were queued.
+    """
+    return (
+        db.session.query(ImportQueueItem)
+        .filter_by(domain=domain)
+        .order_by(ImportQueueItem.queued_at)
+        .all()
+    )
+
+
+def send_queue_metrics(domain, items):
+    """
+    Sends the number of waiting and running imports of ``domain``, and
+    how long its oldest waiting import has waited.
+    """
+    now = time.time()
+    waiting = [item for item in items if not item.is_running]
+    ImportMetrics(domain).send(
+        'queue',
+        waiting=len(waiting),
+        running=len(items) - len(waiting),
+        max_wait_seconds=max(
+            (now - item.queued_at for item in waiting),
+            default=0,
+        ),
+    )
+
+
+def choose_imports(waiting, running, slots, limit_per_domain, weights=None):
+    """
+    Returns the imports in ``waiting`` to start, in the order to start
+    them, given ``slots`` free slots. ``waiting`` is in the order the
+    imports were queued, and ``running`` counts the running imports of
+    each domain.
+
+    The next import is the oldest import of the domain with the fewest
+    running imports relative to its weight in ``weights``, unless the
+    domain already has ``limit_per_domain`` running imports. Weights
+    must be greater than 0.
+
+    >>> from collections import namedtuple
+    >>> Import = namedtuple('Import', 'domain datasource_id')
+    >>> waiting = [
+    ...     Import('big', 'a'),
+    ...     Import('big', 'b'),
+    ...     Import('big', 'c'),
+    ...     Import('small', 'd'),
+    ... ]
+    >>> imports = choose_imports(waiting, {'big': 1}, 3, 2)
+    >>> [i.datasource_id for i in imports]
+    ['d', 'a']
+
+    """
+    weights = weights or {}
+    invalid = {d: w for d, w in weights.items() if not w > 0}
+    if invalid:
+        raise ValueError(
+            f"Import domain weights must be greater than 0: {invalid}"
+        )
+    running = Counter(running)
+    queues = {}
+    for position, item in enumerate(waiting):
+        queues.setdefault(item.domain, deque()).append((position, item))
+
+    def turn(domain):
+        next_position = queues[domain][0][0]
+        return running[domain] / weights.get(domain, 1), next_position
+
+    chosen = []
+    while len(chosen) < slots:
+        domains = [
+            domain for domain, queue in queues.items()
+            if queue and running[domain] < limit_per_domain
+        ]
+        if not domains:
+            break
+        domain = min(domains, key=turn)
+        chosen.append(queues[domain].popleft()[1])
+        running[domain] += 1
+    return chosen
+
+
+def _requeue_lost_imports(held_locks):
+    """
+    Queues started imports again if their tasks have been lost, e.g.
+    because their worker died, or have finished without removing them
+    from the queue. Imports that have been started
+    ``IMPORT_MAX_ATTEMPTS`` times are removed instead.
+
+    A task is taken to be lost if its import is not running
+    ``IMPORT_START_TIMEOUT`` seconds after it was started, or if
+    ``held_locks`` is None and running imports cannot be seen, after
+    ``IMPORT_QUEUE_TIMEOUT`` seconds.
+    """
+    from celery.result import AsyncResult
+
+    started = (
+        db.session.query(ImportQueueItem)
+        .filter(ImportQueueItem.started_at.isnot(None))
+        .all()
+    )
+    now = time.time()
+    for item in started:
+        if held_locks is None:
+            lost = item.started_at < now - IMPORT_QUEUE_TIMEOUT
+        elif is_import_running(item.datasource_id, held_locks):
+            continue
+        else:
+            lost = item.started_at < now - IMPORT_START_TIMEOUT
+        if not lost and item.task_id:
+            # Imports without a task ID are still being started
+            lost = AsyncResult(item.task_id).ready()
+        if not lost:
+            continue
+        if item.attempts >= IMPORT_MAX_ATTEMPTS:
+            logger.error(
+                "Removing %s from the import queue after %s attempts",
+                item.datasource_id,
+                item.attempts,
+            )
+            db.session.delete(item)
+        else:
+            logger.warning("Queuing lost import %s again", item.datasource_id)
+            item.started_at = None
+            item.task_id = None
+    db.session.commit()
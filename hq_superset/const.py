@@ -2,3 +2,23 @@
 HQ_DATABASE_NAME = "HQ Data"
 
 OAUTH2_DATABASE_NAME = "oauth2-server-data"
+
+# Celery queue for UCR imports. Imports can run for a long time, so they
+# have their own queue and workers, and do not hold up SQL Lab queries
+# and other interactive tasks on Superset's default queue.
+IMPORT_QUEUE_NAME = "hq_imports"
+
+# Routes hq_superset's import tasks to IMPORT_QUEUE_NAME. Use it for
+# `task_routes` in the Celery config.
+TASK_ROUTES = {
+    "refresh_hq_datasource_task": {"queue": IMPORT_QUEUE_NAME},
+    "import_hq_datasource_task": {"queue": IMPORT_QUEUE_NAME},
+}
+
+# Priorities of import tasks. Celery's Redis transport takes tasks with
+# lower numbers first.
+IMPORT_PRIORITY_HIGH = 0  # Small exports and incremental refreshes
+IMPORT_PRIORITY_LOW = 6  # Full imports of large exports
+
+# Exports smaller than this are imported with IMPORT_PRIORITY_HIGH
+SMALL_IMPORT_LIMIT_IN_BYTES = 100_000_000  # ~100MB
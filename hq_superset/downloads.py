@@ -0,0 +1,258 @@
+"""
+Downloads of large exports in parallel segments, using HTTP Range
+requests
+
+The file is split into segments of ``SEGMENT_SIZE`` bytes. Segments are
+fetched over several connections at once, and written into place in a
+file that is preallocated to the full size. Completed segments are
+recorded in a state file next to it. If a download is interrupted, the
+next download of the same export only fetches the segments that are
+missing.
+
+Every range request carries the export's ETag or Last-Modified date in
+an "If-Range" header. If the export changes on the server, the server
+returns all of the new export instead of the range, and
+``ContentChanged`` is raised, so that segments of different exports are
+never mixed.
+"""
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SIZE = 64 * 1024 * 1024  # 64MB
+SEGMENT_RETRIES = 3
+WRITE_CHUNK_SIZE = 1024 * 1024  # 1MB
+
+
+class ContentChanged(Exception):
+    """
+    The file changed on the server since its download started.
+    """
+
+
+class RangeSupport(NamedTuple):
+    size: int
+    validator: str
+
+
+def get_range_support(response) -> Optional[RangeSupport]:
+    """
+    Returns the size of the file in ``response`` and its validator (its
+    ETag, or failing that its Last-Modified date) if the server accepts
+    byte range requests for it. Otherwise returns None.
+
+    >>> class Response:
+    ...     headers = {
+    ...         'Accept-Ranges': 'bytes',
+    ...         'Content-Length': '1024',
+    ...         'ETag': '"abc"',
+    ...     }
+    >>> get_range_support(Response())
+    RangeSupport(size=1024, validator='"abc"')
+    >>> Response.headers['ETag'] = 'W/"abc"'  # A weak ETag
+    >>> get_range_support(Response()) is None
+    True
+
+    """
+    headers = response.headers
+    if headers.get('Accept-Ranges') != 'bytes':
+        return None
+    if headers.get('Content-Encoding', 'identity') != 'identity':
+        # Ranges would be of the encoded file
+        return None
+    try:
+        size = int(headers['Content-Length'])
+    except (KeyError, ValueError):
+        return None
+    # Weak ETags can't be used in If-Range headers
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return RangeSupport(size, etag)
+    if headers.get('Last-Modified'):
+        return RangeSupport(size, headers['Last-Modified'])
+    return None
+
+
+def get_segments(size, segment_size=SEGMENT_SIZE):
+    """
+    Returns the first and last byte of each segment of a file of
+    ``size`` bytes.
+
+    >>> get_segments(10, segment_size=4)
+    [(0, 3), (4, 7), (8, 9)]
+
+    """
+    return [
+        (start, min(start + segment_size, size) - 1)
+        for start in range(0, size, segment_size)
+    ]
+
+
+class SegmentedDownload:
+    """
+    A download of the file at ``url`` to ``path``, and a record of its
+    completed segments in "<path>.json".
+    """
+
+    def __init__(self, path, url, size, validator, segment_size=SEGMENT_SIZE):
+        self.path = path
+        self.state_path = f'{path}.json'
+        self.size = size
+        self.segments = get_segments(size, segment_size)
+        self.completed = set()
+        # Identifies the export. The segments of an earlier download are
+        # only used if it matches.
+        self._key = {
+            'url': url,
+            'size': size,
+            'validator': validator,
+            'segment_size': segment_size,
+        }
+        self._lock = threading.Lock()
+
+    @property
+    def validator(self):
+        return self._key['validator']
+
+    def load(self):
+        """
+        Loads the completed segments of an earlier download of the same
+        export, and returns the number of bytes they hold. Otherwise
+        preallocates the file, and returns 0.
+        """
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = None
+        if (
+            state
+            and state.get('key') == self._key
+            and os.path.exists(self.path)
+            and os.path.getsize(self.path) == self.size
+        ):
+            self.completed = set(state['completed'])
+            return sum(
+                end - start + 1
+                for i, (start, end) in enumerate(self.segments)
+                if i in self.completed
+            )
+        self.completed = set()
+        with open(self.path, 'wb') as f:
+            f.truncate(self.size)
+        self._save()
+        return 0
+
+    def remaining(self):
+        return [
+            i for i in range(len(self.segments)) if i not in self.completed
+        ]
+
+    def mark_complete(self, index):
+        with self._lock:
+            self.completed.add(index)
+            self._save()
+
+    def finish(self, path):
+        """
+        Moves the completed download to ``path``.
+        """
+        os.replace(self.path, path)
+        os.remove(self.state_path)
+
+    def discard(self):
+        for path in (self.path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _save(self):
+        # Write a new file and rename it, so that the state file is
+        # never left half-written
+        temp_path = f'{self.state_path}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'key': self._key, 'completed': sorted(self.completed)}, f)
+        os.replace(temp_path, self.state_path)
+
+
+def download_segments(download, get, connections):
+    """
+    Fetches the segments of ``download`` that are missing, over
+    ``connections`` connections at once. ``get(headers)`` returns a
+    streamed response for a request with ``headers``. A segment whose
+    connection fails is retried up to ``SEGMENT_RETRIES`` times.
+
+    Returns the number of bytes fetched. Raises ``ContentChanged`` if
+    the file changed on the server.
+    """
+    failed = threading.Event()
+
+    def fetch(index):
+        if failed.is_set():
+            # Leave the rest for the next download
+            return 0
+        start, end = download.segments[index]
+        for attempt in range(1, SEGMENT_RETRIES + 1):
+            try:
+                _fetch_segment(download, start, end, get)
+                break
+            except requests.exceptions.RequestException as err:
+                if attempt == SEGMENT_RETRIES:
+                    failed.set()
+                    raise
+                logger.warning(
+                    "Retrying bytes %s-%s of %s: %s",
+                    start, end, download.path, err,
+                )
+            except Exception:
+                failed.set()
+                raise
+        download.mark_complete(index)
+        return end - start + 1
+
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        return sum(executor.map(fetch, download.remaining()))
+
+
+def _fetch_segment(download, start, end, get):
+    response = get({
+        'Range': f'bytes={start}-{end}',
+        'If-Range': download.validator,
+        'Accept-Encoding': 'identity',
+    })
+    try:
+        if response.status_code == 200:
+            # The If-Range validator did not match
+            raise ContentChanged(f"Expected bytes {start}-{end}, got all")
+        if response.status_code != 206:
+            raise requests.exceptions.HTTPError(
+                f"HTTP status {response.status_code} for bytes "
+                f"{start}-{end}",
+                response=response,
+            )
+        expected_size = end - start + 1
+        size = 0
+        with open(download.path, 'r+b') as f:
+            f.seek(start)
+            for chunk in response.iter_content(chunk_size=WRITE_CHUNK_SIZE):
+                size += len(chunk)
+                if size > expected_size:
+                    # Don't overwrite the next segment
+                    break
+                f.write(chunk)
+            # The segment is recorded as complete next. Make sure it is
+            # on disk first.
+            f.flush()
+            os.fsync(f.fileno())
+    finally:
+        response.close()
+    if size != expected_size:
+        raise requests.exceptions.ConnectionError(
+            f"Expected {expected_size} bytes, received {size}"
+        )
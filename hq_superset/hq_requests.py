@@ -1,15 +1,21 @@
 import superset
-from hq_superset.oauth import get_valid_cchq_oauth_token
+from hq_superset.oauth import OAuthToken, get_valid_cchq_oauth_token
 
 
 class HQRequest:
 
-    def __init__(self, url):
+    def __init__(self, url, token=None):
         self.url = url
+        # Pass ``token``, an OAuth response or an ``OAuthToken``, to
+        # make requests outside of the user's session, e.g. from other
+        # threads or from Celery tasks
+        self.token = token
 
     @property
     def oauth_token(self):
-        return get_valid_cchq_oauth_token()
+        if isinstance(self.token, OAuthToken):
+            return self.token.get()
+        return self.token or get_valid_cchq_oauth_token()
 
     @property
     def commcare_provider(self):
@@ -23,8 +29,16 @@ class HQRequest:
     def absolute_url(self):
         return f"{self.api_base_url}{self.url}"
 
-    def get(self):
-        return self.commcare_provider.get(self.url, token=self.oauth_token)
+    def get(self, stream=False, headers=None):
+        # With ``stream=True`` the response body is not read until it
+        # is iterated, e.g. with ``response.iter_content()``
+        kwargs = {'headers': headers} if headers else {}
+        return self.commcare_provider.get(
+            self.url,
+            token=self.oauth_token,
+            stream=stream,
+            **kwargs,
+        )
 
     def post(self, data):
         return self.commcare_provider.post(self.url, data=data, token=self.oauth_token)
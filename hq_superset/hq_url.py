@@ -1,6 +1,7 @@
 """
 Functions that return URLs on CommCare HQ
 """
+from urllib.parse import urlencode
 
 
 def datasource_details(domain, datasource_id):
@@ -11,11 +12,15 @@ def datasource_list(domain):
     return f"a/{domain}/api/v0.5/ucr_data_source/"
 
 
-def datasource_export(domain, datasource_id):
-    return (
+def datasource_export(domain, datasource_id, since=None, export_format="csv"):
+    url = (
         f"a/{domain}/configurable_reports/data_sources/export/{datasource_id}/"
-        "?format=csv"
+        f"?format={export_format}"
     )
+    if since:
+        # Only export rows inserted at or after ``since``
+        url += "&" + urlencode({"inserted_at-gte": since.isoformat(sep=" ")})
+    return url
 
 
 def datasource_subscribe(domain, datasource_id):
@@ -0,0 +1,789 @@
+"""
+Functions for writing parsed UCR data to the HQ database
+"""
+import csv
+import datetime
+import io
+import logging
+import uuid
+from functools import partial
+
+import pandas
+import sqlalchemy
+from sqlalchemy.sql import text
+
+from .pipeline import consume_in_parallel
+from .utils import convert_to_array, map_distinct_values
+
+logger = logging.getLogger(__name__)
+
+# Imports are loaded into a staging table, which then replaces the live
+# table, so that dashboards never show partially imported data
+STAGING_TABLE_SUFFIX = '_staging'
+# Records the rows that have been loaded into a staging table, so that
+# an interrupted import can be resumed
+CHECKPOINT_TABLE_SUFFIX = '_checkpoints'
+
+# Partitioned tables have a partition for each month, and a default
+# partition for rows with no date
+PARTITION_INFIX = '_p'
+DEFAULT_PARTITION_SUFFIX = '_default'
+
+
+def supports_copy(database):
+    """
+    Returns True if UCR data can be bulk-loaded into ``database`` using
+    PostgreSQL's ``COPY FROM STDIN``.
+    """
+    return database.backend == 'postgresql'
+
+
+def create_table(
+    database,
+    table,
+    df,
+    dtype=None,
+    unlogged=False,
+    partition_column=None,
+):
+    """
+    Drops ``table`` if it exists, and creates it with columns for the
+    data types of ``df``, as ``df.to_sql()`` would.
+
+    If ``unlogged`` is True, ``table`` is created as an ``UNLOGGED``
+    table (see ``set_table_logged()``).
+
+    If ``partition_column`` is given, ``table`` is partitioned by month
+    of ``partition_column``. Only its default partition, for rows where
+    ``partition_column`` is NULL, is created. Use
+    ``create_partitions()`` to create a partition for each month.
+    """
+    with database.get_sqla_engine_with_context() as engine:
+        preparer = engine.dialect.identifier_preparer
+        create_stmt = pandas.io.sql.get_schema(
+            df,
+            table.table,
+            con=engine,
+            dtype=dtype,
+            schema=table.schema,
+        )
+        if unlogged:
+            create_stmt = create_stmt.replace(
+                'CREATE TABLE', 'CREATE UNLOGGED TABLE', 1
+            )
+        if partition_column:
+            create_stmt = (
+                f'{create_stmt.rstrip()} '
+                f'PARTITION BY RANGE ({preparer.quote(partition_column)})'
+            )
+        with engine.begin() as connection:
+            connection.execute(
+                text(f'DROP TABLE IF EXISTS {quote_table(engine, table)}')
+            )
+            connection.execute(text(create_stmt))
+            if partition_column:
+                default_partition = quote_name(
+                    engine,
+                    f'{table.table}{DEFAULT_PARTITION_SUFFIX}',
+                    table.schema,
+                )
+                connection.execute(text(
+                    f'CREATE TABLE {default_partition} '
+                    f'PARTITION OF {quote_table(engine, table)} DEFAULT'
+                ))
+
+
+def get_partition_column(database, table):
+    """
+    Returns the name of the column that ``table`` is partitioned by, or
+    None if it is not partitioned.
+    """
+    with database.get_sqla_engine_with_context() as engine:
+        with engine.connect() as connection:
+            return connection.execute(
+                text(
+                    'SELECT a.attname '
+                    'FROM pg_partitioned_table p '
+                    'JOIN pg_attribute a ON a.attrelid = p.partrelid '
+                    'AND a.attnum = p.partattrs[0] '
+                    'WHERE p.partrelid = to_regclass(:table_name)'
+                ),
+                {'table_name': quote_table(engine, table)},
+            ).scalar()
+
+
+def get_partition_months(values):
+    """
+    Returns the first day of each month of the dates in ``values``.
+
+    >>> sorted(get_partition_months(['2024-01-31', None, '2023-12-25']))
+    [datetime.date(2023, 12, 1), datetime.date(2024, 1, 1)]
+
+    """
+    dates = pandas.to_datetime(pandas.Series(values), errors='coerce')
+    return {
+        month.start_time.date()
+        for month in dates.dropna().dt.to_period('M').unique()
+    }
+
+
+def create_partitions(database, table, months):
+    """
+    Creates a partition of ``table`` for each month in ``months``, if it
+    does not exist yet. Partitions are named after their table and
+    month, e.g. "{table}_p202401".
+    """
+    with database.get_sqla_engine_with_context() as engine:
+        with engine.begin() as connection:
+            for month in sorted(months):
+                next_month = (month + datetime.timedelta(days=32)).replace(day=1)
+                partition = quote_name(
+                    engine,
+                    f'{table.table}{PARTITION_INFIX}{month:%Y%m}',
+                    table.schema,
+                )
+                connection.execute(text(
+                    f'CREATE TABLE IF NOT EXISTS {partition} '
+                    f'PARTITION OF {quote_table(engine, table)} '
+                    f"FOR VALUES FROM ('{month.isoformat()}') "
+                    f"TO ('{next_month.isoformat()}')"
+                ))
+
+
+def _rename_partitions(connection, engine, table, old_prefix):
+    """
+    Renames the partitions of ``table`` whose names start with
+    ``old_prefix`` so that they start with the name of ``table``.
+    """
+    preparer = engine.dialect.identifier_preparer
+    partitions = connection.execute(
+        text(
+            'SELECT c.relname '
+            'FROM pg_inherits i '
+            'JOIN pg_class c ON c.oid = i.inhrelid '
+            'WHERE i.inhparent = to_regclass(:table_name)'
+        ),
+        {'table_name': quote_table(engine, table)},
+    ).scalars().all()
+    for partition in partitions:
+        if not partition.startswith(old_prefix):
+            continue
+        new_name = table.table + partition[len(old_prefix):]
+        connection.execute(text(
+            f'ALTER TABLE {quote_name(engine, partition, table.schema)} '
+            f'RENAME TO {preparer.quote(new_name)}'
+        ))
+
+
+def drop_table(database, table):
+    with database.get_sqla_engine_with_context() as engine:
+        with engine.begin() as connection:
+            connection.execute(
+                text(f'DROP TABLE IF EXISTS {quote_table(engine, table)}')
+            )
+
+
+def swap_tables(database, staging_table, table):
+    """
+    Replaces ``table`` with ``staging_table`` in a single transaction,
+    so that readers see either all of the old data or all of the new.
+    ``staging_table`` must be in the same schema as ``table``.
+    """
+    with database.get_sqla_engine_with_context() as engine:
+        preparer = engine.dialect.identifier_preparer
+        with engine.begin() as connection:
+            connection.execute(
+                text(f'DROP TABLE IF EXISTS {quote_table(engine, table)}')
+            )
+            connection.execute(text(
+                f'ALTER TABLE {quote_table(engine, staging_table)} '
+                f'RENAME TO {preparer.quote(table.table)}'
+            ))
+            if database.backend == 'postgresql':
+                # Partitions are named after their table
+                _rename_partitions(
+                    connection, engine, table, staging_table.table
+                )
+
+
+def create_table_like(database, table, like_table, unlogged=False):
+    """
+    Drops ``table`` if it exists, and creates it with the same columns
+    as ``like_table``.
+    """
+    create = 'CREATE UNLOGGED TABLE' if unlogged else 'CREATE TABLE'
+    with database.get_sqla_engine_with_context() as engine:
+        with engine.begin() as connection:
+            connection.execute(
+                text(f'DROP TABLE IF EXISTS {quote_table(engine, table)}')
+            )
+            connection.execute(text(
+                f'{create} {quote_table(engine, table)} '
+                f'(LIKE {quote_table(engine, like_table)} INCLUDING DEFAULTS)'
+            ))
+
+
+def set_table_logged(database, table):
+    """
+    Makes an ``UNLOGGED`` table a regular table.
+
+    Writes to an unlogged table skip PostgreSQL's write-ahead log, which
+    makes bulk loads much faster, but an unlogged table is emptied if
+    the server crashes, and is not replicated. Setting it as logged
+    writes the whole table to the write-ahead log once.
+    """
+    with database.get_sqla_engine_with_context() as engine:
+        with engine.begin() as connection:
+            connection.execute(text(
+                f'ALTER TABLE {quote_table(engine, table)} SET LOGGED'
+            ))
+
+
+def merge_tables(database, staging_table, table, key='doc_id'):
+    """
+    Replaces the rows of ``table`` that have the same ``key`` as rows
+    in ``staging_table`` with the rows of ``staging_table``, and drops
+    ``staging_table``, in a single transaction. ``staging_table`` must
+    have the same columns as ``table``.
+    """
+    with database.get_sqla_engine_with_context() as engine:
+        preparer = engine.dialect.identifier_preparer
+        table_name = quote_table(engine, table)
+        staging_table_name = quote_table(engine, staging_table)
+        key = preparer.quote(key)
+        with engine.begin() as connection:
+            connection.execute(text(
+                f'DELETE FROM {table_name} '
+                f'WHERE {key} IN (SELECT {key} FROM {staging_table_name})'
+            ))
+            connection.execute(text(
+                f'INSERT INTO {table_name} SELECT * FROM {staging_table_name}'
+            ))
+            connection.execute(text(f'DROP TABLE {staging_table_name}'))
+
+
+def update_columns(database, staging_table, table, columns, key='doc_id'):
+    """
+    Sets ``columns`` of the rows of ``table`` to their values in the
+    rows of ``staging_table`` with the same ``key``, and drops
+    ``staging_table``, in a single transaction. ``key`` must be unique
+    in ``staging_table``.
+
+    Meant for filling in columns that have just been added to ``table``
+    (see ``alter_table()``). Their values are NULL, so rows whose new
+    values are all NULL are not updated.
+    """
+    with database.get_sqla_engine_with_context() as engine:
+        preparer = engine.dialect.identifier_preparer
+        staging_table_name = quote_table(engine, staging_table)
+        key = preparer.quote(key)
+        assignments = ', '.join(
+            f'{preparer.quote(c)} = s.{preparer.quote(c)}' for c in columns
+        )
+        not_null = ' OR '.join(
+            f's.{preparer.quote(c)} IS NOT NULL' for c in columns
+        )
+        with engine.begin() as connection:
+            connection.execute(text(
+                f'UPDATE {quote_table(engine, table)} AS t '
+                f'SET {assignments} '
+                f'FROM {staging_table_name} AS s '
+                f'WHERE t.{key} = s.{key} AND ({not_null})'
+            ))
+            connection.execute(text(f'DROP TABLE {staging_table_name}'))
+
+
+def get_pg_column_types(column_dtypes, date_columns, array_columns):
+    """
+    Returns the PostgreSQL data types of the columns that
+    ``create_table()`` creates for the columns returned by
+    ``get_column_dtypes()``, as ``format_type()`` names them.
+
+    >>> get_pg_column_types(
+    ...     {'doc_id': 'string', 'count': 'Int64'},
+    ...     ['inserted_at'],
+    ...     ['tags'],
+    ... )  # doctest: +NORMALIZE_WHITESPACE
+    {'doc_id': 'text', 'count': 'bigint',
+     'inserted_at': 'timestamp without time zone', 'tags': 'text[]'}
+
+    """
+    pg_types = {
+        'string': 'text',
+        'Int64': 'bigint',
+        'Float64': 'double precision',
+        'Int8': 'smallint',
+    }
+    column_types = {
+        column: pg_types[dtype] for column, dtype in column_dtypes.items()
+    }
+    column_types.update({
+        column: 'timestamp without time zone' for column in date_columns
+    })
+    column_types.update({column: 'text[]' for column in array_columns})
+    return column_types
+
+
+def get_column_types(database, table):
+    """
+    Returns the PostgreSQL data types of the columns of ``table``, as
+    ``format_type()`` names them, or an empty dictionary if ``table``
+    does not exist.
+    """
+    with database.get_sqla_engine_with_context() as engine:
+        with engine.connect() as connection:
+            rows = connection.execute(
+                text(
+                    'SELECT attname, format_type(atttypid, atttypmod) '
+                    'FROM pg_attribute '
+                    'WHERE attrelid = to_regclass(:table_name) '
+                    'AND attnum > 0 AND NOT attisdropped '
+                    'ORDER BY attnum'
+                ),
+                {'table_name': quote_table(engine, table)},
+            ).fetchall()
+    return {column: column_type for column, column_type in rows}
+
+
+def alter_table(
+    database,
+    table,
+    add_columns=None,
+    drop_columns=(),
+    retype_columns=None,
+):
+    """
+    Adds, drops and changes the types of columns of ``table`` in place,
+    in a single transaction. ``add_columns`` and ``retype_columns`` map
+    column names to PostgreSQL data types.
+
+    Adding a column with no default and dropping a column only change
+    the catalog, however large ``table`` is. Changing the type of a
+    column rewrites ``table``. If a column's values cannot be cast to
+    its new type, it is dropped and added again, empty.
+
+    Returns the names of the columns that were added empty, and need to
+    be filled in (see ``update_columns()``).
+    """
+    add_columns = dict(add_columns or {})
+    retype_columns = retype_columns or {}
+    with database.get_sqla_engine_with_context() as engine:
+        preparer = engine.dialect.identifier_preparer
+        table_name = quote_table(engine, table)
+        with engine.begin() as connection:
+            for column in drop_columns:
+                connection.execute(text(
+                    f'ALTER TABLE {table_name} '
+                    f'DROP COLUMN {preparer.quote(column)}'
+                ))
+            for column, column_type in retype_columns.items():
+                quoted = preparer.quote(column)
+                try:
+                    with connection.begin_nested():
+                        connection.execute(text(
+                            f'ALTER TABLE {table_name} '
+                            f'ALTER COLUMN {quoted} TYPE {column_type} '
+                            f'USING {quoted}::{column_type}'
+                        ))
+                except sqlalchemy.exc.DBAPIError as err:
+                    logger.info(
+                        "Unable to cast %s.%s to %s. Reloading it: %s",
+                        table.table, column, column_type, err,
+                    )
+                    connection.execute(text(
+                        f'ALTER TABLE {table_name} DROP COLUMN {quoted}'
+                    ))
+                    add_columns[column] = column_type
+            for column, column_type in add_columns.items():
+                connection.execute(text(
+                    f'ALTER TABLE {table_name} '
+                    f'ADD COLUMN {preparer.quote(column)} {column_type}'
+                ))
+    return list(add_columns)
+
+
+def get_table_columns(database, table):
+    """
+    Returns the names of the columns of ``table``, or an empty list if
+    it does not exist.
+    """
+    with database.get_sqla_engine_with_context() as engine:
+        inspector = sqlalchemy.inspect(engine)
+        if not inspector.has_table(table.table, schema=table.schema):
+            return []
+        return [
+            column['name']
+            for column in inspector.get_columns(table.table, schema=table.schema)
+        ]
+
+
+def get_max_value(database, table, column):
+    with database.get_sqla_engine_with_context() as engine:
+        preparer = engine.dialect.identifier_preparer
+        with engine.connect() as connection:
+            return connection.execute(text(
+                f'SELECT max({preparer.quote(column)}) '
+                f'FROM {quote_table(engine, table)}'
+            )).scalar()
+
+
+def create_indexes(
+    database,
+    table,
+    index_columns,
+    brin_columns=(),
+    primary_key_columns=(),
+    workers=1,
+):
+    """
+    Creates a btree index on ``table`` for each of ``index_columns``, a
+    BRIN index for each of ``brin_columns``, and a primary key on
+    ``primary_key_columns``, and then analyzes the table. Meant to be
+    called after the table has been bulk-loaded, which is much faster
+    than maintaining indexes while rows are inserted.
+
+    The indexes are built over ``workers`` connections in parallel. If
+    the primary key can't be created, e.g. because its values are not
+    unique, its first column gets a btree index instead.
+    """
+    with database.get_sqla_engine_with_context() as engine:
+        preparer = engine.dialect.identifier_preparer
+        table_name = quote_table(engine, table)
+
+        def btree_index(column):
+            return (
+                f'CREATE INDEX {get_index_name()} '
+                f'ON {table_name} ({preparer.quote(column)})'
+            )
+
+        statements = []
+        primary_key_statement = None
+        if primary_key_columns:
+            columns = ', '.join(preparer.quote(c) for c in primary_key_columns)
+            primary_key_statement = (
+                f'ALTER TABLE {table_name} '
+                f"ADD CONSTRAINT {get_index_name('pk')} "
+                f'PRIMARY KEY ({columns})'
+            )
+            statements.append(primary_key_statement)
+        for column in index_columns:
+            statements.append(btree_index(column))
+        for column in brin_columns:
+            statements.append(
+                f'CREATE INDEX {get_index_name()} '
+                f'ON {table_name} USING brin ({preparer.quote(column)})'
+            )
+        failed_statements = []
+
+        def execute(statement):
+            if not _execute_index_statement(engine, statement):
+                failed_statements.append(statement)
+
+        consume_in_parallel(execute, statements, workers=workers)
+        if (
+            primary_key_statement in failed_statements
+            and primary_key_columns[0] not in index_columns
+        ):
+            # e.g. doc_id is left out of ``index_columns`` when the
+            # primary key starts with it
+            _execute_index_statement(
+                engine,
+                btree_index(primary_key_columns[0]),
+            )
+        with engine.begin() as connection:
+            connection.execute(text(f'ANALYZE {table_name}'))
+
+
+def get_indexed_columns(database, table):
+    """
+    Returns the names of the columns of ``table`` that are the first
+    column of an index or of its primary key.
+    """
+    with database.get_sqla_engine_with_context() as engine:
+        inspector = sqlalchemy.inspect(engine)
+        indexes = inspector.get_indexes(table.table, schema=table.schema)
+        primary_key = inspector.get_pk_constraint(
+            table.table,
+            schema=table.schema,
+        )
+    columns = {
+        index['column_names'][0]
+        for index in indexes
+        if index['column_names'] and index['column_names'][0]
+    }
+    if primary_key['constrained_columns']:
+        columns.add(primary_key['constrained_columns'][0])
+    return columns
+
+
+def _execute_index_statement(engine, statement):
+    """
+    Executes ``statement``, and returns whether it succeeded.
+    """
+    try:
+        with engine.begin() as connection:
+            connection.execute(text(statement))
+    except sqlalchemy.exc.DBAPIError as err:
+        # e.g. The values of a primary key column are not unique. The
+        # data is still usable without the index.
+        logger.warning("Unable to create index: %s: %s", statement, err)
+        return False
+    return True
+
+
+def get_index_name(prefix='ix'):
+    """
+    Returns a unique name for an index. Index names must be unique in a
+    schema, and indexes keep their names when a staging table replaces
+    a live table, so they are not named after the table.
+    """
+    return f'{prefix}_{uuid.uuid4().hex}'
+
+
+def get_staging_table_name(table_name):
+    return f'{table_name}{STAGING_TABLE_SUFFIX}'
+
+
+def get_checkpoint_table_name(table_name):
+    return f'{table_name}{CHECKPOINT_TABLE_SUFFIX}'
+
+
+def create_checkpoint_table(database, checkpoint_table, unlogged=False):
+    """
+    Drops ``checkpoint_table`` if it exists, and creates it. It records
+    the rows of an export file that have been loaded into a staging
+    table (see ``copy_dataframes()``).
+
+    If the staging table is ``UNLOGGED``, ``checkpoint_table`` should
+    be too, so that both are emptied if the database server crashes.
+    """
+    create = 'CREATE UNLOGGED TABLE' if unlogged else 'CREATE TABLE'
+    with database.get_sqla_engine_with_context() as engine:
+        table_name = quote_table(engine, checkpoint_table)
+        with engine.begin() as connection:
+            connection.execute(text(f'DROP TABLE IF EXISTS {table_name}'))
+            connection.execute(text(
+                f'{create} {table_name} ('
+                'export_file TEXT NOT NULL, '
+                'start_row BIGINT NOT NULL, '
+                'end_row BIGINT NOT NULL)'
+            ))
+
+
+def get_checkpoints(database, checkpoint_table, export_file):
+    """
+    Returns the ranges of rows of ``export_file`` that have been loaded,
+    as a sorted list of ``(start_row, end_row)`` tuples. Returns an
+    empty list if ``checkpoint_table`` does not exist.
+    """
+    with database.get_sqla_engine_with_context() as engine:
+        inspector = sqlalchemy.inspect(engine)
+        if not inspector.has_table(
+            checkpoint_table.table,
+            schema=checkpoint_table.schema,
+        ):
+            return []
+        with engine.connect() as connection:
+            rows = connection.execute(
+                text(
+                    'SELECT start_row, end_row '
+                    f'FROM {quote_table(engine, checkpoint_table)} '
+                    'WHERE export_file = :export_file '
+                    'ORDER BY start_row'
+                ),
+                {'export_file': export_file},
+            ).fetchall()
+    return [(start_row, end_row) for start_row, end_row in rows]
+
+
+def get_unloaded_ranges(start_row, end_row, checkpoints):
+    """
+    Returns the ranges of rows from ``start_row`` to ``end_row`` that
+    are not in ``checkpoints``, as returned by ``get_checkpoints()``.
+
+    >>> get_unloaded_ranges(0, 100, [(0, 20), (50, 60), (90, 200)])
+    [(20, 50), (60, 90)]
+    >>> get_unloaded_ranges(0, 100, [])
+    [(0, 100)]
+
+    """
+    ranges = []
+    for loaded_start, loaded_end in checkpoints:
+        if loaded_end <= start_row or loaded_start >= end_row:
+            continue
+        if loaded_start > start_row:
+            ranges.append((start_row, loaded_start))
+        start_row = max(start_row, loaded_end)
+    if start_row < end_row:
+        ranges.append((start_row, end_row))
+    return ranges
+
+
+def copy_dataframes(
+    database,
+    table,
+    dataframes,
+    writers=1,
+    checkpoint_table=None,
+    export_file=None,
+):
+    """
+    Appends the rows of each DataFrame in ``dataframes`` to ``table``
+    using ``COPY FROM STDIN``, over ``writers`` connections in
+    parallel.
+
+    Each DataFrame is committed separately, so ``table`` should be a
+    staging table that is dropped if this raises an exception.
+
+    If ``checkpoint_table`` is given, the index of each DataFrame must
+    be the row numbers of its rows in ``export_file``, in one unbroken
+    range. The range is recorded in ``checkpoint_table`` in the same
+    transaction as the rows, so an interrupted import can be resumed
+    without loading any rows twice.
+    """
+    with database.get_sqla_engine_with_context() as engine:
+        # The engine is opened here, in the calling thread, because
+        # Superset needs the Flask app context to open it. Each writer
+        # thread uses its own connection.
+        consume_in_parallel(
+            partial(
+                _copy_dataframe,
+                engine,
+                table,
+                checkpoint_table=checkpoint_table,
+                export_file=export_file,
+            ),
+            dataframes,
+            workers=writers,
+        )
+
+
+def _copy_dataframe(
+    engine,
+    table,
+    df,
+    checkpoint_table=None,
+    export_file=None,
+):
+    buffer = io.StringIO()
+    write_copy_csv(df, buffer)
+    buffer.seek(0)
+    preparer = engine.dialect.identifier_preparer
+    columns = ', '.join(preparer.quote(str(c)) for c in df.columns)
+    copy_sql = (
+        f'COPY {quote_table(engine, table)} ({columns}) '
+        'FROM STDIN WITH (FORMAT csv)'
+    )
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.copy_expert(copy_sql, buffer)
+            if checkpoint_table is not None and len(df):
+                cursor.execute(
+                    f'INSERT INTO {quote_table(engine, checkpoint_table)} '
+                    '(export_file, start_row, end_row) VALUES (%s, %s, %s)',
+                    (export_file, int(df.index[0]), int(df.index[-1]) + 1),
+                )
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+
+def write_copy_csv(df, buffer):
+    """
+    Writes ``df`` to ``buffer`` in the CSV format expected by
+    ``COPY ... WITH (FORMAT csv)``. Missing values are written as
+    unquoted empty fields, which ``COPY`` loads as NULL. Array columns
+    must already be PostgreSQL array literals (see
+    ``to_pg_array_literals()``).
+
+    >>> df = pandas.DataFrame({
+    ...     'doc_id': pandas.Series(['a1', None], dtype='string'),
+    ...     'count': pandas.Series([1, None], dtype='Int64'),
+    ...     'tags': ['{"x","y"}', '{}'],
+    ... })
+    >>> buffer = io.StringIO()
+    >>> write_copy_csv(df, buffer)
+    >>> print(buffer.getvalue())
+    a1,1,"{""x"",""y""}"
+    ,,{}
+    <BLANKLINE>
+
+    """
+    df.to_csv(
+        buffer,
+        header=False,
+        index=False,
+        na_rep='',
+        quoting=csv.QUOTE_MINIMAL,
+        lineterminator='\n',
+    )
+
+
+def to_pg_array_literals(values):
+    """
+    Converts a column of lists exported by CommCare HQ directly to
+    PostgreSQL array literals, decoding each distinct value only once.
+
+    >>> to_pg_array_literals(["['a', 'b']", "[None]", None]).tolist()
+    ['{"a","b"}', '{}', '{}']
+
+    """
+    return map_distinct_values(
+        values,
+        lambda value: to_pg_array_literal(convert_to_array(value)),
+        na_value='{}',
+    )
+
+
+def lists_to_pg_array_literals(values):
+    """
+    Converts a column of lists, e.g. from a columnar export, to
+    PostgreSQL array literals. Missing values are converted to empty
+    arrays, as they are by ``to_pg_array_literals()``.
+
+    >>> lists_to_pg_array_literals([['a', 'b'], None]).tolist()
+    ['{"a","b"}', '{}']
+
+    """
+    return pandas.Series(values, dtype=object).map(
+        to_pg_array_literal
+    ).fillna('{}')
+
+
+def to_pg_array_literal(values):
+    """
+    Returns a PostgreSQL array literal for a list of values.
+
+    >>> to_pg_array_literal(['hello', 'world'])
+    '{"hello","world"}'
+    >>> to_pg_array_literal(['hello', None, 1])
+    '{"hello",NULL,"1"}'
+    >>> to_pg_array_literal([])
+    '{}'
+
+    """
+    if not isinstance(values, (list, tuple)):
+        return None
+    return '{' + ','.join(_pg_array_element(v) for v in values) + '}'
+
+
+def _pg_array_element(value):
+    if value is None:
+        return 'NULL'
+    escaped = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{escaped}"'
+
+
+def quote_table(engine, table):
+    return quote_name(engine, table.table, table.schema)
+
+
+def quote_name(engine, name, schema=None):
+    preparer = engine.dialect.identifier_preparer
+    if schema:
+        return f'{preparer.quote_schema(schema)}.{preparer.quote(name)}'
+    return preparer.quote(name)
@@ -0,0 +1,198 @@
+"""
+Metrics for UCR imports
+
+Each stage of an import -- downloading the export, fetching the data
+source definition, parsing, loading, building indexes, and syncing the
+dataset's metadata -- sends its metrics to the sink set by
+``HQ_IMPORT_METRICS_SINK`` in ``superset_config``. Metrics are tagged
+with the domain and the data source ID. The import queue sends metrics
+of each domain, tagged with the domain only.
+
+A sink is an object with a ``send(stage, metrics, tags)`` method.
+``LoggingMetricsSink`` is used by default.
+"""
+import json
+import logging
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+from flask import current_app
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+
+
+class LoggingMetricsSink:
+    """
+    Logs the metrics of each stage as a line of JSON.
+    """
+
+    def send(self, stage, metrics, tags):
+        logger.info(
+            "Import metrics: %s",
+            json.dumps({'stage': stage, **tags, **metrics}, sort_keys=True),
+        )
+
+
+class StatsLoggerMetricsSink:
+    """
+    Sends metrics to Superset's ``STATS_LOGGER``, e.g. a
+    ``StatsdStatsLogger``. Superset's stats loggers do not support
+    tags, so metrics are aggregated across data sources. Durations are
+    sent as "<stage>.duration" timings, in milliseconds like
+    Superset's own timings.
+    """
+
+    def __init__(self, prefix='hq_import'):
+        self.prefix = prefix
+
+    def send(self, stage, metrics, tags):
+        from superset.extensions import stats_logger_manager
+
+        stats_logger = stats_logger_manager.instance
+        for name, value in metrics.items():
+            if name == 'seconds':
+                stats_logger.timing(
+                    f'{self.prefix}.{stage}.duration',
+                    value * 1000,
+                )
+            else:
+                stats_logger.gauge(f'{self.prefix}.{stage}.{name}', value)
+
+
+class PrometheusMetricsSink:
+    """
+    Pushes the metrics of each stage to a Prometheus Pushgateway at
+    ``gateway``, e.g. "pushgateway:9091", as gauges. Requires the
+    ``prometheus_client`` package.
+
+    Celery runs imports in short-lived worker processes, which
+    Prometheus can't scrape, so metrics are pushed instead. Each push
+    replaces the last metrics of the same stage and domain. Gauges are
+    labelled with the stage and the domain, but not the data source, so
+    that the number of time series stays small.
+    """
+
+    def __init__(self, gateway, job='hq_import', prefix='hq_import'):
+        if prometheus_client is None:
+            raise ImportError(
+                'PrometheusMetricsSink requires prometheus_client'
+            )
+        self.gateway = gateway
+        self.job = job
+        self.prefix = prefix
+
+    def send(self, stage, metrics, tags):
+        registry = prometheus_client.CollectorRegistry()
+        for name, value in metrics.items():
+            prometheus_client.Gauge(
+                f'{self.prefix}_{name}',
+                f'UCR import metric: {name}',
+                registry=registry,
+            ).set(value)
+        prometheus_client.push_to_gateway(
+            self.gateway,
+            job=self.job,
+            registry=registry,
+            grouping_key={'stage': stage, 'domain': tags['domain']},
+        )
+
+
+def get_metrics_sink():
+    sink = current_app.config.get('HQ_IMPORT_METRICS_SINK')
+    return sink if sink is not None else LoggingMetricsSink()
+
+
+class ImportMetrics:
+    """
+    Sends the metrics of the stages of importing a data source.
+
+    >>> class PrintSink:
+    ...     def send(self, stage, metrics, tags):
+    ...         print(stage, sorted(metrics), tags['datasource_id'])
+    >>> metrics = ImportMetrics('demo', 'abc123', sink=PrintSink())
+    >>> with metrics.measure('load') as load_metrics:
+    ...     load_metrics['rows'] = 1000
+    load ['rows', 'rows_per_second', 'seconds'] abc123
+
+    """
+
+    def __init__(self, domain, datasource_id=None, sink=None):
+        # Metrics without a data source are metrics of the domain
+        self.tags = {'domain': domain}
+        if datasource_id is not None:
+            self.tags['datasource_id'] = datasource_id
+        self.sink = sink if sink is not None else get_metrics_sink()
+
+    @contextmanager
+    def measure(self, stage, **metrics):
+        """
+        Yields a dictionary of metrics for ``stage``. When the stage is
+        done, the time it took is added as "seconds", and the metrics
+        are sent. If the stage raises an exception, nothing is sent.
+        """
+        start = time.perf_counter()
+        yield metrics
+        metrics['seconds'] = time.perf_counter() - start
+        self.send(stage, **metrics)
+
+    def send(self, stage, **metrics):
+        """
+        Sends ``metrics`` for ``stage``. Rates are added for "rows" and
+        "bytes" if "seconds" is given.
+        """
+        seconds = metrics.get('seconds')
+        if seconds:
+            for name in ('rows', 'bytes'):
+                if name in metrics:
+                    metrics[f'{name}_per_second'] = metrics[name] / seconds
+        try:
+            self.sink.send(stage, metrics, self.tags)
+        except Exception:  # pylint: disable=broad-except
+            # Metrics must never break an import
+            logger.exception("Unable to send metrics for stage %s", stage)
+
+
+def measure_dataframes(dataframes, metrics):
+    """
+    Yields ``dataframes``, adding their number of rows to
+    ``metrics['rows']``, and the time taken to produce them to
+    ``metrics['seconds']``.
+
+    >>> import pandas
+    >>> metrics = {}
+    >>> dfs = [pandas.DataFrame({'a': [1, 2]}), pandas.DataFrame({'a': [3]})]
+    >>> _ = list(measure_dataframes(dfs, metrics))
+    >>> metrics['rows']
+    3
+
+    """
+    metrics.setdefault('rows', 0)
+    metrics.setdefault('seconds', 0.0)
+    dataframes = iter(dataframes)
+    while True:
+        start = time.perf_counter()
+        try:
+            df = next(dataframes)
+        except StopIteration:
+            return
+        metrics['seconds'] += time.perf_counter() - start
+        metrics['rows'] += len(df)
+        yield df
+
+
+def get_peak_rss():
+    """
+    Returns the peak resident set size of this process, in bytes, over
+    its lifetime. It can't be reset, so a worker process that has run
+    several imports reports the peak of all of them, not of the last.
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
@@ -0,0 +1,47 @@
+"""Added import queue
+
+Revision ID: 3f1c2a9b7d45
+Revises: 56d0467ff6ff
+Create Date: 2026-10-17 09:12:31.482201
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f1c2a9b7d45'
+down_revision: Union[str, None] = '56d0467ff6ff'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'hq_import_queue',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('domain', sa.String(length=255), nullable=False),
+        sa.Column('datasource_id', sa.String(length=255), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('incremental', sa.Boolean(), nullable=False),
+        sa.Column('queued_at', sa.Float(), nullable=False),
+        sa.Column('started_at', sa.Float(), nullable=True),
+        sa.Column('task_id', sa.String(length=255), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('domain', 'datasource_id'),
+        info={'bind_key': 'oauth2-server-data'},
+    )
+    op.create_index(
+        op.f('ix_hq_import_queue_domain'),
+        'hq_import_queue',
+        ['domain'],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(
+        op.f('ix_hq_import_queue_domain'), table_name='hq_import_queue'
+    )
+    op.drop_table('hq_import_queue')
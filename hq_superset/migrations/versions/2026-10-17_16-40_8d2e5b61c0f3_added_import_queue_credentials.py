@@ -0,0 +1,38 @@
+"""Added import queue credentials
+
+Revision ID: 8d2e5b61c0f3
+Revises: 3f1c2a9b7d45
+Create Date: 2026-10-17 16:40:12.906114
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8d2e5b61c0f3'
+down_revision: Union[str, None] = '3f1c2a9b7d45'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        'hq_import_queue',
+        sa.Column('oauth_token', sa.Text(), nullable=True),
+    )
+    op.add_column(
+        'hq_import_queue',
+        sa.Column('webhook_url', sa.String(length=2048), nullable=True),
+    )
+    op.add_column(
+        'hq_import_queue',
+        sa.Column('token_url', sa.String(length=2048), nullable=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('hq_import_queue', 'token_url')
+    op.drop_column('hq_import_queue', 'webhook_url')
+    op.drop_column('hq_import_queue', 'oauth_token')
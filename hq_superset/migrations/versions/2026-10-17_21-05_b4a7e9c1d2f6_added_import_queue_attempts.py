@@ -0,0 +1,28 @@
+"""Added import queue attempts
+
+Revision ID: b4a7e9c1d2f6
+Revises: 8d2e5b61c0f3
+Create Date: 2026-10-17 21:05:47.318529
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b4a7e9c1d2f6'
+down_revision: Union[str, None] = '8d2e5b61c0f3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        'hq_import_queue',
+        sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('hq_import_queue', 'attempts')
@@ -0,0 +1,51 @@
+"""Added user OAuth token
+
+Revision ID: e6f1a3c8b520
+Revises: b4a7e9c1d2f6
+Create Date: 2026-10-17 22:30:18.604217
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e6f1a3c8b520'
+down_revision: Union[str, None] = 'b4a7e9c1d2f6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    user_oauth_token = op.create_table(
+        'hq_user_oauth_token',
+        sa.Column('user_id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('oauth_token', sa.Text(), nullable=False),
+        sa.PrimaryKeyConstraint('user_id'),
+        info={'bind_key': 'oauth2-server-data'},
+    )
+    # Keep the tokens of imports that are already queued. They are
+    # encrypted with the same keys. A user's queued imports share the
+    # same token, so the last one queued is as good as any.
+    rows = op.get_bind().execute(sa.text(
+        'SELECT user_id, oauth_token FROM hq_import_queue '
+        'WHERE user_id IS NOT NULL AND oauth_token IS NOT NULL '
+        'ORDER BY queued_at'
+    )).fetchall()
+    tokens = {user_id: oauth_token for user_id, oauth_token in rows}
+    if tokens:
+        op.bulk_insert(user_oauth_token, [
+            {'user_id': user_id, 'oauth_token': oauth_token}
+            for user_id, oauth_token in tokens.items()
+        ])
+    op.drop_column('hq_import_queue', 'oauth_token')
+
+
+def downgrade() -> None:
+    # Imports that are queued when this is run lose their tokens
+    op.add_column(
+        'hq_import_queue',
+        sa.Column('oauth_token', sa.Text(), nullable=True),
+    )
+    op.drop_table('hq_user_oauth_token')
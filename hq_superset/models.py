@@ -1,3 +1,4 @@
+import json
 import time
 from dataclasses import dataclass
 from typing import Any
@@ -9,9 +10,16 @@ from authlib.integrations.sqla_oauth2 import (
 from cryptography.fernet import MultiFernet
 from sqlalchemy import update
 from superset import db
+from superset.sql_parse import Table
 
 from .const import OAUTH2_DATABASE_NAME
 from .exceptions import TableMissing
+from .loaders import (
+    create_partitions,
+    get_partition_column,
+    get_partition_months,
+    supports_copy,
+)
 from .utils import cast_data_for_table, get_fernet_keys, get_hq_database
 
 
@@ -38,6 +46,10 @@ class DataSetChange:
         except StopIteration:
             raise TableMissing(f'{self.data_source_id} table not found.')
         table = sqla_table.get_sqla_table_object()
+        rows = list(cast_data_for_table(self.data, table))
+
+        if rows and supports_copy(database):
+            self._create_partitions(database, sqla_table, rows)
 
         with (
             database.get_sqla_engine_with_context() as engine,
@@ -46,11 +58,27 @@ class DataSetChange:
         ):
             delete_stmt = table.delete().where(table.c.doc_id == self.doc_id)
             connection.execute(delete_stmt)
-            if self.data:
-                rows = list(cast_data_for_table(self.data, table))
+            if rows:
                 insert_stmt = table.insert().values(rows)
                 connection.execute(insert_stmt)
 
+    @staticmethod
+    def _create_partitions(database, sqla_table, rows):
+        """
+        Rows can only be inserted into a partitioned table if it has
+        partitions for them.
+        """
+        table = Table(table=sqla_table.table_name, schema=sqla_table.schema)
+        partition_column = get_partition_column(database, table)
+        if partition_column:
+            create_partitions(
+                database,
+                table,
+                get_partition_months(
+                    [row.get(partition_column) for row in rows]
+                ),
+            )
+
 
 class OAuth2Client(db.Model, OAuth2ClientMixin):
     __bind_key__ = OAUTH2_DATABASE_NAME
@@ -100,3 +128,69 @@ class OAuth2Token(db.Model, OAuth2TokenMixin):
     def domain(self):
         client = OAuth2Client.get_by_client_id(self.client_id)
         return client.domain
+
+
+class ImportQueueItem(db.Model):
+    """
+    An import of a data source that is waiting for its turn to run, or
+    is running (see ``hq_superset.concurrency``)
+    """
+    __bind_key__ = OAUTH2_DATABASE_NAME
+    __tablename__ = 'hq_import_queue'
+    __table_args__ = (
+        db.UniqueConstraint('domain', 'datasource_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    domain = db.Column(db.String(255), nullable=False, index=True)
+    datasource_id = db.Column(db.String(255), nullable=False)
+    user_id = db.Column(db.Integer, nullable=True)
+    incremental = db.Column(db.Boolean, nullable=False, default=False)
+    queued_at = db.Column(db.Float, nullable=False)
+    started_at = db.Column(db.Float, nullable=True)
+    task_id = db.Column(db.String(255), nullable=True)
+    # Times the import has been started. Lost imports are queued again
+    # until they reach ``concurrency.IMPORT_MAX_ATTEMPTS``.
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+    # The task runs outside of the user's session and of the web
+    # request, so the view that queues the import saves the URLs to
+    # subscribe to changes with. The task uses the user's
+    # ``UserOAuthToken``.
+    webhook_url = db.Column(db.String(2048), nullable=True)
+    token_url = db.Column(db.String(2048), nullable=True)
+
+    @property
+    def is_running(self):
+        return self.started_at is not None
+
+    def get_subscription_urls(self):
+        if not (self.webhook_url and self.token_url):
+            return None
+        return {'webhook_url': self.webhook_url, 'token_url': self.token_url}
+
+
+class UserOAuthToken(db.Model):
+    """
+    A user's CommCare HQ OAuth response (encrypted), shared by their
+    session and their import tasks (see ``oauth.SharedOAuthToken``)
+    """
+    __bind_key__ = OAUTH2_DATABASE_NAME
+    __tablename__ = 'hq_user_oauth_token'
+
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    oauth_token = db.Column(db.Text, nullable=False)
+
+    def get_oauth_token(self):
+        fernet = MultiFernet(get_fernet_keys())
+        plaintext_bytes = fernet.decrypt(self.oauth_token.encode('utf-8'))
+        return json.loads(plaintext_bytes.decode('utf-8'))
+
+    def set_oauth_token(self, oauth_response):
+        fernet = MultiFernet(get_fernet_keys())
+        plaintext_bytes = json.dumps(oauth_response).encode('utf-8')
+        self.oauth_token = fernet.encrypt(plaintext_bytes).decode('utf-8')
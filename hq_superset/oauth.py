@@ -1,8 +1,10 @@
 import logging
+import threading
 import time
 
 import superset
 from flask import flash, session
+from flask_login import current_user
 from requests.exceptions import HTTPError
 from superset.security import SupersetSecurityManager
 
@@ -68,20 +70,143 @@ def get_valid_cchq_oauth_token():
             "the user didn't do an OAuth Login yet"
         )
 
-    # If token hasn't expired yet, return it
+    if current_user and current_user.is_authenticated:
+        # The user's import tasks use the same token. Whichever refreshes
+        # it first saves the new token for the other.
+        token = SharedOAuthToken(current_user.get_id(), oauth_response)
+    else:
+        token = OAuthToken(oauth_response)
+    # If the token has expired, get a new token using refresh_token
+    valid_response = token.get()
+    if valid_response != oauth_response:
+        superset.appbuilder.sm.set_oauth_session("commcare", valid_response)
+    return valid_response
+
+
+def is_token_expired(oauth_response):
     expires_at = oauth_response.get("expires_at")
-    if expires_at and expires_at > int(time.time()):
+    return not (expires_at and expires_at > int(time.time()))
+
+
+def is_newer_token(oauth_response, other):
+    """
+    Returns True if ``oauth_response`` was issued after ``other``, i.e.
+    it expires later.
+
+    >>> is_newer_token({'expires_at': 1650872906}, {'expires_at': 1650872006})
+    True
+    >>> is_newer_token({'expires_at': 1650872906}, {})
+    True
+
+    """
+    return (oauth_response.get("expires_at") or 0) > (other.get("expires_at") or 0)
+
+
+class OAuthToken:
+    """
+    A user's OAuth token, for requests to CommCare HQ from outside of
+    their session, e.g. from Celery tasks.
+
+    The access token is refreshed when it expires. Subclasses can
+    override ``refresh()`` to save the new token, because a refresh
+    token can only be used once.
+    """
+
+    def __init__(self, oauth_response):
+        self.oauth_response = oauth_response
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if is_token_expired(self.oauth_response):
+                self.oauth_response = self.refresh()
+            return self.oauth_response
+
+    def refresh(self):
+        refresh_token = self.oauth_response.get("refresh_token")
+        if not refresh_token:
+            raise OAuthSessionExpired(
+                "access_token is expired but a refresh_token is not found in oauth_response"
+            )
+        return refresh_and_fetch_token(refresh_token)
+
+
+class SharedOAuthToken(OAuthToken):
+    """
+    A user's OAuth token, shared by their session and their import
+    tasks, and saved in ``UserOAuthToken``.
+
+    A refresh token can only be used once, so the saved token is locked
+    while it is refreshed, and whoever refreshes it first saves the new
+    token for the others to use.
+    """
+
+    def __init__(self, user_id, oauth_response=None):
+        saved = get_saved_oauth_token(user_id)
+        if saved and (
+            oauth_response is None
+            or is_newer_token(saved, oauth_response)
+        ):
+            oauth_response = saved
+        super().__init__(oauth_response or {})
+        self.user_id = user_id
+
+    def refresh(self):
+        saved_token = _get_user_oauth_token(self.user_id, for_update=True)
+        try:
+            if saved_token is not None:
+                saved = saved_token.get_oauth_token()
+                if is_newer_token(saved, self.oauth_response):
+                    # Refreshed by someone else in the meantime
+                    self.oauth_response = saved
+                    if not is_token_expired(saved):
+                        return saved
+            oauth_response = super().refresh()
+            _set_user_oauth_token(self.user_id, saved_token, oauth_response)
+        finally:
+            # Also releases the lock if the refresh failed
+            superset.db.session.commit()
         return oauth_response
 
-    # If the token has expired, get a new token using refresh_token
-    refresh_token = oauth_response.get("refresh_token")
-    if not refresh_token:
-        raise OAuthSessionExpired(
-            "access_token is expired but a refresh_token is not found in oauth_response"
-        )
-    refresh_response = refresh_and_fetch_token(refresh_token)
-    superset.appbuilder.sm.set_oauth_session("commcare", refresh_response)
-    return refresh_response
+
+def get_saved_oauth_token(user_id):
+    saved_token = _get_user_oauth_token(user_id)
+    return saved_token.get_oauth_token() if saved_token else None
+
+
+def save_oauth_token(user_id, oauth_response):
+    """
+    Saves the user's token for their import tasks to use, unless a
+    newer one has been saved already (see ``SharedOAuthToken``).
+    """
+    saved_token = _get_user_oauth_token(user_id, for_update=True)
+    try:
+        if saved_token is None or is_newer_token(
+            oauth_response,
+            saved_token.get_oauth_token(),
+        ):
+            _set_user_oauth_token(user_id, saved_token, oauth_response)
+    finally:
+        superset.db.session.commit()
+
+
+def _get_user_oauth_token(user_id, for_update=False):
+    # superset_config.py imports this module, before models can be
+    from .models import UserOAuthToken
+
+    query = superset.db.session.query(UserOAuthToken).filter_by(user_id=user_id)
+    if for_update:
+        query = query.with_for_update()
+    return query.one_or_none()
+
+
+def _set_user_oauth_token(user_id, saved_token, oauth_response):
+    from .models import UserOAuthToken
+
+    if saved_token is None:
+        saved_token = UserOAuthToken(user_id=user_id)
+        superset.db.session.add(saved_token)
+    saved_token.set_oauth_token(oauth_response)
 
 
 def refresh_and_fetch_token(refresh_token):
@@ -0,0 +1,225 @@
+"""
+Helpers for running the stages of a data source import concurrently.
+
+Each stage runs in its own thread and hands its output to the next
+stage through a bounded queue. A fast stage cannot race ahead of a slow
+one and fill up memory, and the import as a whole takes about as long
+as its slowest stage, instead of the sum of all of them.
+"""
+import io
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+
+PIPELINE_QUEUE_SIZE = 4
+READ_BLOCK_SIZE = 1024 * 1024  # 1MB
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class Stage:
+    """
+    Iterates ``iterable`` in a background thread. Iterating the stage
+    yields the items of ``iterable``, in order. An exception raised by
+    ``iterable`` is re-raised in the consuming thread.
+
+    Use it as a context manager so that the background thread is
+    stopped if the consumer stops early:
+
+    >>> with Stage(range(3)) as numbers:
+    ...     list(numbers)
+    [0, 1, 2]
+
+    """
+
+    def __init__(self, iterable, maxsize=PIPELINE_QUEUE_SIZE, name=None):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(iterable,),
+            name=name,
+            daemon=True,
+        )
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        self.start()
+        while True:
+            item = self._queue.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.exception
+            yield item
+
+    def start(self):
+        if self._thread.ident is None:
+            self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+        if self._thread.ident is not None:
+            self._thread.join()
+
+    def _run(self, iterable):
+        try:
+            for item in iterable:
+                if not self._put(item):
+                    return
+        except BaseException as err:  # pylint: disable=broad-except
+            self._put(_Failure(err))
+        else:
+            self._put(_DONE)
+        finally:
+            # Close a generator in the thread that ran it, so that any
+            # files it opened are closed when the stage is
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                close()
+
+    def _put(self, item):
+        """
+        Waits for room in the queue. Returns False if the stage was
+        closed while waiting.
+        """
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+class MergeStage(Stage):
+    """
+    Iterates each of ``iterables`` in its own background thread, e.g. to
+    parse the files of an export in parallel. Iterating the stage yields
+    the items of all of them, in the order that they are produced. An
+    exception raised by any of them is re-raised in the consuming
+    thread.
+
+    >>> with MergeStage([range(3), range(3, 5)]) as numbers:
+    ...     sorted(numbers)
+    [0, 1, 2, 3, 4]
+
+    """
+
+    def __init__(self, iterables, maxsize=PIPELINE_QUEUE_SIZE, name=None):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._stopped = threading.Event()
+        self._threads = [
+            threading.Thread(
+                target=self._run,
+                args=(iterable,),
+                name=f"{name} {i}" if name else None,
+                daemon=True,
+            )
+            for i, iterable in enumerate(iterables)
+        ]
+
+    def __iter__(self):
+        self.start()
+        running = len(self._threads)
+        while running:
+            item = self._queue.get()
+            if item is _DONE:
+                running -= 1
+                continue
+            if isinstance(item, _Failure):
+                raise item.exception
+            yield item
+
+    def start(self):
+        for thread in self._threads:
+            if thread.ident is None:
+                thread.start()
+
+    def close(self):
+        self._stopped.set()
+        for thread in self._threads:
+            if thread.ident is not None:
+                thread.join()
+
+
+class StreamStage(io.RawIOBase):
+    """
+    A read-only binary stream that reads ``fileobj`` block by block in
+    a background thread, e.g. to decompress a zip archive member while
+    its contents are being parsed.
+
+    >>> with StreamStage(io.BytesIO(b'abc'), block_size=2) as stream:
+    ...     stream.read()
+    b'abc'
+
+    """
+
+    def __init__(self, fileobj, block_size=READ_BLOCK_SIZE, name=None):
+        super().__init__()
+        blocks = iter(partial(fileobj.read, block_size), b'')
+        self._stage = Stage(blocks, name=name)
+        self._blocks = iter(self._stage)
+        self._block = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._block:
+            try:
+                self._block = memoryview(next(self._blocks))
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self._block))
+        buffer[:size] = self._block[:size]
+        self._block = self._block[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._stage.close()
+        super().close()
+
+
+def consume_in_parallel(func, iterable, workers):
+    """
+    Calls ``func(item)`` for each item of ``iterable`` in ``workers``
+    threads. Items are taken from ``iterable`` only as workers become
+    free, so at most ``workers`` items are being processed at a time.
+
+    If ``func`` raises an exception, no more items are processed, and
+    the exception is re-raised once the items that were already being
+    processed are done.
+
+    >>> results = []
+    >>> consume_in_parallel(results.append, range(5), workers=2)
+    >>> sorted(results)
+    [0, 1, 2, 3, 4]
+
+    """
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = set()
+    try:
+        for item in iterable:
+            if len(pending) >= workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            pending.add(executor.submit(func, item))
+        for future in pending:
+            future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
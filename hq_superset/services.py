@@ -1,55 +1,399 @@
+import itertools
+import json
 import logging
 import os
+import shutil
+import time
 import uuid
+from dataclasses import dataclass
 from datetime import datetime
+from typing import Optional
 
 import pandas
 import sqlalchemy
 import superset
 from flask import g, current_app, request
 from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql import text
 from superset import db
 from superset.connectors.sqla.models import SqlaTable
 from superset.extensions import cache_manager
 from superset.sql_parse import Table
 
+from . import arrow, downloads
+from .concurrency import datasource_lock, get_queued_datasource_ids
 from .exceptions import HQAPIException
 from .hq_requests import HQRequest
 from .hq_url import datasource_details, datasource_export, datasource_subscribe
+from .loaders import (
+    CHECKPOINT_TABLE_SUFFIX,
+    STAGING_TABLE_SUFFIX,
+    alter_table,
+    copy_dataframes,
+    create_checkpoint_table,
+    create_indexes,
+    create_partitions,
+    create_table,
+    create_table_like,
+    drop_table,
+    get_checkpoint_table_name,
+    get_checkpoints,
+    get_column_types,
+    get_indexed_columns,
+    get_max_value,
+    get_partition_column,
+    get_partition_months,
+    get_pg_column_types,
+    get_staging_table_name,
+    get_table_columns,
+    get_unloaded_ranges,
+    lists_to_pg_array_literals,
+    merge_tables,
+    set_table_logged,
+    supports_copy,
+    swap_tables,
+    to_pg_array_literals,
+    update_columns,
+)
+from .metrics import ImportMetrics, get_peak_rss, measure_dataframes
 from .models import OAuth2Client
+from .pipeline import PIPELINE_QUEUE_SIZE, MergeStage
 from .utils import (
-    convert_to_array,
+    DOMAIN_PREFIX,
+    ChunkSizer,
+    convert_to_arrays,
+    detect_export_format,
     get_column_dtypes,
+    get_columnar_file,
     get_datasource_file,
+    get_datasource_fingerprint,
+    get_datasource_parts,
+    get_export_format,
     get_hq_database,
+    get_index_columns,
     get_schema_name_for_domain,
     generate_secret,
-    parse_date,
+    parse_date_columns,
 )
 
 logger = logging.getLogger(__name__)
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB
+DOWNLOAD_PROGRESS_INTERVAL = 100 * 1024 * 1024  # Log every 100MB
+# Default number of connections used to download an export in segments,
+# if CommCare HQ accepts range requests for it. Override with
+# ``HQ_DOWNLOAD_CONNECTIONS``. 1 downloads exports in a single request.
+DOWNLOAD_CONNECTIONS = 4
+# Seconds after which exports in ``SHARED_DIR`` that have not been
+# changed are deleted, e.g. if the worker that was importing them was
+# killed. Must be longer than the Celery broker's visibility timeout,
+# after which the task of a killed worker is delivered again.
+STALE_EXPORT_AGE = 24 * 60 * 60
+# Default memory available to each import for chunks of parsed data.
+# Override with ``HQ_IMPORT_MEMORY_BUDGET`` in superset_config.py.
+IMPORT_MEMORY_BUDGET = 256 * 1024 * 1024  # 256MB
+# Default number of connections each import uses to load data into the
+# HQ database in parallel. Override with ``HQ_IMPORT_WRITERS``.
+IMPORT_WRITERS = 2
+# Default number of the CSV files of a multi-file export that each
+# import parses at the same time. Override with ``HQ_IMPORT_PARSERS``.
+IMPORT_PARSERS = os.cpu_count() or 1
+# For checkpoints, the rows of the files of a multi-file export are
+# numbered from the file's position in the archive times this
+PART_ROW_OFFSET = 2 ** 40
+# Whether imports load data into UNLOGGED staging tables, and whether
+# the tables are left unlogged when they go live. Override with
+# ``HQ_IMPORT_UNLOGGED_STAGING`` and ``HQ_IMPORT_KEEP_UNLOGGED``.
+IMPORT_UNLOGGED_STAGING = False
+IMPORT_KEEP_UNLOGGED = False
 
-def download_and_subscribe_to_datasource(domain, datasource_id):
-    hq_request = HQRequest(url=datasource_export(domain, datasource_id))
-    response = hq_request.get()
+# Formats to request UCR exports in, in order of preference. Override
+# with ``HQ_EXPORT_FORMATS``, e.g. ``['parquet', 'csv']``.
+EXPORT_FORMATS = ['csv']
+
+# The key in ``SqlaTable.extra`` of the fingerprint of the last export
+# that was imported, see ``get_datasource_fingerprint()``
+FINGERPRINT_KEY = 'hq_export_fingerprint'
+# Part of the fingerprint. Increment it when a change to imports changes
+# the tables they create, e.g. their indexes, so that data sources whose
+# exports have not changed are imported again.
+IMPORT_TABLE_VERSION = 1
+# The key in ``SqlaTable.extra`` of the columns that a migration added
+# to the dataset's table, and that have not been backfilled yet
+BACKFILL_KEY = 'hq_pending_backfill'
+
+
+def download_and_subscribe_to_datasource(
+    domain,
+    datasource_id,
+    since=None,
+    token=None,
+    subscription_urls=None,
+):
+    """
+    Downloads the data source's export to ``SHARED_DIR``, in the first
+    format in ``get_export_formats()`` that CommCare HQ offers, and
+    subscribes to changes to the data source.
+
+    Outside of the user's session, e.g. in Celery tasks, pass the
+    user's ``token`` (see ``HQRequest``) and ``subscription_urls``.
+
+    Returns the path of the export and its size. Its file extension
+    gives its format (see ``get_export_format()``).
+    """
+    export_formats = get_export_formats()
+    for export_format in export_formats:
+        hq_request = HQRequest(url=datasource_export(
+            domain,
+            datasource_id,
+            since=since,
+            export_format=export_format,
+        ), token=token)
+        response = hq_request.get(stream=True)
+        if response.status_code == 200:
+            break
+        response.close()
+        if export_format != export_formats[-1]:
+            logger.info(
+                "Unable to export %s as %s: HTTP status %s. "
+                "Trying the next format.",
+                datasource_id,
+                export_format,
+                response.status_code,
+            )
+    try:
+        if response.status_code != 200:
+            raise HQAPIException("Error downloading the UCR export from HQ")
+
+        path = get_export_path(datasource_id, export_format)
+        partial_path = f"{path}.part"
+        metrics = ImportMetrics(domain, datasource_id)
+        with metrics.measure('download') as download_metrics:
+            size, resumed_size = download_export(
+                hq_request, response, path, partial_path, label=datasource_id
+            )
+            download_metrics['bytes'] = size - resumed_size
+            download_metrics['resumed_bytes'] = resumed_size
+    finally:
+        response.close()
+
+    # CommCare HQ may ignore the requested format, and send a zipped CSV
+    detected_format = detect_export_format(path)
+    if detected_format and detected_format != export_format:
+        logger.info(
+            "Requested %s as %s, received %s",
+            datasource_id, export_format, detected_format,
+        )
+        detected_path = get_export_path(datasource_id, detected_format)
+        os.replace(path, detected_path)
+        path = detected_path
+    elif detected_format is None and export_format != 'csv':
+        os.remove(path)
+        raise HQAPIException(
+            f"Unrecognised {export_format} export of {datasource_id}"
+        )
+
+    subscribe_to_hq_datasource(
+        domain, datasource_id, token=token, subscription_urls=subscription_urls
+    )
+
+    return path, size
+
+
+def get_export_path(datasource_id, export_format):
+    """
+    Returns the path in ``SHARED_DIR`` to download the data source's
+    export to. Its file extension gives the export's format (see
+    ``get_export_format()``).
+
+    The path is not timestamped, so that a retried import replaces the
+    export of the attempt before it, and the next download of the
+    export can find its segments if this one is interrupted.
+    """
+    extension = 'zip' if export_format == 'csv' else export_format
+    return os.path.join(
+        superset.config.SHARED_DIR,
+        f"{datasource_id}.{extension}",
+    )
 
-    if response.status_code != 200:
-        raise HQAPIException("Error downloading the UCR export from HQ")
 
-    filename = f"{datasource_id}_{datetime.now()}.zip"
-    path = os.path.join(superset.config.SHARED_DIR, filename)
+def download_export(hq_request, response, path, partial_path, label=''):
+    """
+    Downloads the export in ``response``, the response to
+    ``hq_request``, to ``path``.
+
+    If CommCare HQ accepts range requests for the export, and it is
+    larger than one segment, it is fetched in segments over
+    ``HQ_DOWNLOAD_CONNECTIONS`` connections at once (see
+    ``hq_superset.downloads``). Segments are written to
+    ``partial_path``. If the download is interrupted, the next download
+    of the same export only fetches the segments that are missing.
+
+    Returns the size of the export, and the number of its bytes that
+    were downloaded by an earlier, interrupted download.
+    """
+    connections = current_app.config.get(
+        'HQ_DOWNLOAD_CONNECTIONS', DOWNLOAD_CONNECTIONS
+    )
+    range_support = downloads.get_range_support(response)
+    if (
+        connections < 2
+        or range_support is None
+        or range_support.size <= downloads.SEGMENT_SIZE
+    ):
+        return stream_response_to_file(response, path, label), 0
+    response.close()
+
+    download = downloads.SegmentedDownload(
+        partial_path,
+        hq_request.url,
+        range_support.size,
+        range_support.validator,
+    )
+    resumed_size = download.load()
+    if resumed_size:
+        logger.info(
+            "Resuming download of %s: %s of %s bytes already downloaded",
+            label, resumed_size, range_support.size,
+        )
+    # Segments are fetched in other threads, outside of the app context
+    # and the user's session
+    app = current_app._get_current_object()
+    token = hq_request.token or hq_request.oauth_token
+
+    def get(headers):
+        with app.app_context():
+            segment_request = HQRequest(url=hq_request.url, token=token)
+            return segment_request.get(stream=True, headers=headers)
+
+    try:
+        downloads.download_segments(download, get, connections)
+    except downloads.ContentChanged:
+        logger.info(
+            "The export of %s changed during its download. "
+            "Downloading it again.",
+            label,
+        )
+        download.discard()
+        response = hq_request.get(stream=True)
+        try:
+            if response.status_code != 200:
+                raise HQAPIException("Error downloading the UCR export from HQ")
+            return stream_response_to_file(response, path, label), 0
+        finally:
+            response.close()
+    download.finish(path)
+    logger.info("Downloaded %s: %s bytes", label, range_support.size)
+    return range_support.size, resumed_size
+
+
+def stream_response_to_file(response, path, label=''):
+    """
+    Writes the body of ``response`` to ``path`` one chunk at a time, so
+    that memory use stays flat regardless of the size of the download.
+
+    Returns the number of bytes written.
+    """
+    total_size = response.headers.get('Content-Length')
+    size = 0
+    next_progress_report = DOWNLOAD_PROGRESS_INTERVAL
     with open(path, "wb") as f:
-        f.write(response.content)
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            f.write(chunk)
+            size += len(chunk)
+            if size >= next_progress_report:
+                logger.info(
+                    "Downloading %s: %s of %s bytes",
+                    label, size, total_size or "unknown",
+                )
+                next_progress_report += DOWNLOAD_PROGRESS_INTERVAL
+    logger.info("Downloaded %s: %s bytes", label, size)
+    return size
+
+
+def remove_stale_exports():
+    """
+    Deletes the exports, partial downloads and extracted files in
+    ``SHARED_DIR`` that have not been changed for ``STALE_EXPORT_AGE``
+    seconds, and drops staging and checkpoint tables. They are left
+    behind by imports that did not finish.
+
+    The files and tables of data sources that are in the import queue
+    are kept, so that their imports can resume from their checkpoints,
+    and so are those of imports that are running.
+    """
+    queued = get_queued_datasource_ids()
+    shared_dir = superset.config.SHARED_DIR
+    if os.path.isdir(shared_dir):
+        cutoff = time.time() - STALE_EXPORT_AGE
+        for entry in os.scandir(shared_dir):
+            # Files are named after their data source (see
+            # ``get_export_path()``)
+            datasource_id = entry.name.split('.')[0]
+            if datasource_id in queued:
+                continue
+            try:
+                if entry.stat().st_mtime >= cutoff:
+                    continue
+                with datasource_lock(datasource_id) as acquired:
+                    if not acquired:
+                        # Being imported
+                        continue
+                    if entry.is_dir():
+                        shutil.rmtree(entry.path)
+                    else:
+                        os.remove(entry.path)
+            except FileNotFoundError:
+                # Removed by its import in the meantime
+                continue
+            logger.info("Removed stale export %s", entry.path)
+    remove_orphaned_tables(queued)
 
-    subscribe_to_hq_datasource(domain, datasource_id)
 
-    return path, len(response.content)
+def remove_orphaned_tables(queued):
+    """
+    Drops the staging and checkpoint tables of data sources that are
+    not being imported, and whose IDs are not in ``queued``. Only
+    PostgreSQL databases are checked, because running imports cannot be
+    seen otherwise.
+    """
+    database = get_hq_database()
+    if not supports_copy(database):
+        return
+    with database.get_sqla_engine_with_context() as engine:
+        with engine.connect() as connection:
+            rows = connection.execute(
+                text(
+                    'SELECT table_schema, table_name '
+                    'FROM information_schema.tables '
+                    'WHERE table_schema LIKE :pattern'
+                ),
+                {'pattern': f'{DOMAIN_PREFIX}%'},
+            ).fetchall()
+    for schema, table_name in rows:
+        suffix = next((
+            s for s in (STAGING_TABLE_SUFFIX, CHECKPOINT_TABLE_SUFFIX)
+            if table_name.endswith(s)
+        ), None)
+        if suffix is None:
+            continue
+        datasource_id = table_name[:-len(suffix)]
+        if datasource_id in queued:
+            continue
+        with datasource_lock(datasource_id) as acquired:
+            if not acquired:
+                continue
+            drop_table(database, Table(table=table_name, schema=schema))
+        logger.info("Dropped orphaned table %s.%s", schema, table_name)
 
 
-def get_datasource_defn(domain, datasource_id):
-    hq_request = HQRequest(url=datasource_details(domain, datasource_id))
-    response = hq_request.get()
+def get_datasource_defn(domain, datasource_id, token=None):
+    hq_request = HQRequest(
+        url=datasource_details(domain, datasource_id),
+        token=token,
+    )
+    with ImportMetrics(domain, datasource_id).measure('definition'):
+        response = hq_request.get()
     if response.status_code != 200:
         raise HQAPIException(
             "Error downloading the UCR definition from HQ: "
@@ -58,6 +402,219 @@ def get_datasource_defn(domain, datasource_id):
     return response.json()
 
 
+def get_incremental_refresh_start(domain, datasource_id, datasource_defn):
+    """
+    Returns the latest ``inserted_at`` value in the data source's table,
+    so that only rows inserted since then need to be imported.
+
+    Returns None if the whole data source needs to be imported, e.g.
+    because it has not been imported yet, or its columns have changed.
+    """
+    database = get_hq_database()
+    if not supports_copy(database):
+        return None
+    table = Table(
+        table=datasource_id,
+        schema=get_schema_name_for_domain(domain),
+    )
+    column_dtypes, date_columns, array_columns = get_column_dtypes(
+        datasource_defn
+    )
+    defn_columns = {*column_dtypes, *date_columns, *array_columns}
+    if set(get_table_columns(database, table)) != defn_columns:
+        return None
+    since = get_max_value(database, table, 'inserted_at')
+    if not isinstance(since, datetime):
+        return None
+    return since
+
+
+@dataclass
+class DatasourceMigration:
+    """
+    The changes that ``migrate_datasource_table()`` makes to a data
+    source's table, returned by ``get_datasource_migration()``
+    """
+    add_columns: dict
+    drop_columns: list
+    retype_columns: dict
+    # Columns added by an earlier migration whose backfill did not
+    # complete
+    pending_columns: list
+
+    @property
+    def alters_table(self):
+        return bool(self.add_columns or self.drop_columns or self.retype_columns)
+
+    @property
+    def backfill_columns(self):
+        """
+        The columns that may need to be loaded from a full export.
+        Columns that can be cast in place turn out not to need it.
+        """
+        return list(dict.fromkeys([
+            *self.pending_columns,
+            *self.add_columns,
+            *self.retype_columns,
+        ]))
+
+
+def get_datasource_migration(domain, datasource_id, datasource_defn):
+    """
+    Returns the ``DatasourceMigration`` that matches the data source's
+    table to the columns of ``datasource_defn``, without altering the
+    table. Returns None if the table needs a full refresh instead, e.g.
+    because it has not been imported yet, or its rows cannot be matched
+    to the rows of an export by ``doc_id``.
+    """
+    database = get_hq_database()
+    sqla_table = get_datasource_sqla_table(domain, datasource_id)
+    if sqla_table is None:
+        return None
+    if not supports_copy(database):
+        return None
+    if datasource_defn.get('base_item_expression'):
+        # Data sources with a base item expression have a row for each
+        # item of a document, so ``doc_id`` does not identify a row
+        return None
+    table = Table(
+        table=datasource_id,
+        schema=get_schema_name_for_domain(domain),
+    )
+    table_types = get_column_types(database, table)
+    if 'doc_id' not in table_types:
+        return None
+    defn_types = get_pg_column_types(*get_column_dtypes(datasource_defn))
+    add_columns = {
+        column: column_type
+        for column, column_type in defn_types.items()
+        if column not in table_types
+    }
+    drop_columns = [c for c in table_types if c not in defn_types]
+    retype_columns = {
+        column: column_type
+        for column, column_type in defn_types.items()
+        if column in table_types and table_types[column] != column_type
+    }
+    partition_column = get_partition_column(database, table)
+    if partition_column and (
+        partition_column in drop_columns
+        or partition_column in retype_columns
+    ):
+        return None
+    # Unless they have since been dropped
+    pending_columns = [
+        c for c in sqla_table.extra_dict.get(BACKFILL_KEY, [])
+        if c in defn_types
+    ]
+    return DatasourceMigration(
+        add_columns,
+        drop_columns,
+        retype_columns,
+        pending_columns,
+    )
+
+
+def migrate_datasource_table(domain, datasource_id, datasource_defn):
+    """
+    Alters the data source's table in place to match the columns of
+    ``datasource_defn``: Columns that have been removed from the data
+    source are dropped, new columns are added, and columns whose data
+    types have changed are cast.
+
+    This can rewrite the whole table while holding an exclusive lock on
+    it, so it is called by ``refresh_hq_datasource()``, in the import,
+    rather than before the export is downloaded.
+
+    Returns the names of the columns that need to be loaded from a full
+    export, with ``refresh_hq_datasource(..., backfill_columns=...)``,
+    which is an empty list if the table already matches. Returns None if
+    the table needs a full refresh instead (see
+    ``get_datasource_migration()``).
+
+    The columns are recorded in the dataset until they are backfilled,
+    so that if the backfill fails, they are returned again next time.
+    """
+    migration = get_datasource_migration(
+        domain, datasource_id, datasource_defn
+    )
+    if migration is None:
+        return None
+    if not migration.alters_table:
+        return migration.pending_columns
+    add_columns = migration.add_columns
+    drop_columns = migration.drop_columns
+    retype_columns = migration.retype_columns
+    pending_columns = migration.pending_columns
+    sqla_table = get_datasource_sqla_table(domain, datasource_id)
+    table = Table(
+        table=datasource_id,
+        schema=get_schema_name_for_domain(domain),
+    )
+    logger.info(
+        "Migrating %s: adding %s, dropping %s, casting %s",
+        datasource_id,
+        list(add_columns),
+        drop_columns,
+        list(retype_columns),
+    )
+    # Record the columns that might need a backfill before the table is
+    # altered, in case the migration is interrupted
+    set_pending_backfill(
+        sqla_table,
+        [*pending_columns, *add_columns, *retype_columns],
+    )
+    added_columns = alter_table(
+        get_hq_database(),
+        table,
+        add_columns,
+        drop_columns,
+        retype_columns,
+    )
+    return set_pending_backfill(
+        sqla_table,
+        [*pending_columns, *added_columns],
+    )
+
+
+def set_pending_backfill(sqla_table, columns):
+    """
+    Records ``columns`` as the columns of the dataset's table that need
+    to be backfilled, and returns them, without duplicates.
+    """
+    columns = list(dict.fromkeys(columns))
+    sqla_table.extra = json.dumps({
+        **sqla_table.extra_dict,
+        BACKFILL_KEY: columns,
+    })
+    db.session.commit()
+    return columns
+
+
+def get_datasource_sqla_table(domain, datasource_id):
+    return (
+        db.session.query(SqlaTable)
+        .filter_by(
+            table_name=datasource_id,
+            schema=get_schema_name_for_domain(domain),
+            database_id=get_hq_database().id,
+        )
+        .one_or_none()
+    )
+
+
+def is_datasource_up_to_date(domain, datasource_id, fingerprint):
+    """
+    Returns True if the last import of the data source was of an export
+    with the same fingerprint, and its table does not need to be
+    reloaded.
+    """
+    sqla_table = get_datasource_sqla_table(domain, datasource_id)
+    if sqla_table is None:
+        return False
+    return sqla_table.extra_dict.get(FINGERPRINT_KEY) == fingerprint
+
+
 def refresh_hq_datasource(
     domain,
     datasource_id,
@@ -65,62 +622,462 @@ def refresh_hq_datasource(
     file_path,
     datasource_defn,
     user_id=None,
+    incremental=False,
+    fingerprint=None,
+    backfill_columns=None,
 ):
     """
     Pulls the data from CommCare HQ and creates/replaces the
     corresponding Superset dataset
+
+    Data is loaded into a staging table, which replaces the dataset's
+    table only after all the data has been loaded. The ``SqlaTable``
+    is kept, so charts that use the dataset continue to work.
+
+    If ``incremental`` is True, ``file_path`` only contains new and
+    updated rows (see ``get_incremental_refresh_start()``). They replace
+    the rows in the dataset's table with the same ``doc_id``.
+
+    A full refresh that was interrupted, e.g. by a worker restart, is
+    resumed if it is retried with the same export, identified by its
+    ``fingerprint``, or failing that by the name of ``file_path``. Rows
+    that have already been loaded into the staging table are skipped.
+
+    Data sources listed in ``HQ_PARTITIONED_DATASOURCES`` are stored in
+    tables partitioned by month (see ``create_partitions()``).
+
+    ``fingerprint`` is stored with the dataset, so that the next refresh
+    can be skipped if the export has not changed (see
+    ``is_datasource_up_to_date()``).
+
+    If ``backfill_columns`` is given, ``file_path`` is a full export.
+    The dataset's table is migrated first (see
+    ``migrate_datasource_table()``), and then only the columns that the
+    migration added are loaded from the export.
     """
     # See `CsvToDatabaseView.form_post()` in
     # https://github.com/apache/superset/blob/master/superset/views/database/views.py
 
-    def dataframe_to_sql(df, replace=False):
+    def dataframes_to_sql(dataframes):
+        """
+        Upload Pandas DataFrames ``dataframes`` to ``database``.
+        """
+        if not incremental and not checkpoints:
+            first_df = next(dataframes, None)
+            if first_df is None:
+                # The export has no rows. Its table still replaces the
+                # dataset's table.
+                first_df = get_empty_dataframe()
+            dataframes = itertools.chain([first_df], dataframes)
+            if use_copy:
+                create_table(
+                    database,
+                    staging_table,
+                    first_df,
+                    dtype=sql_converters,
+                    unlogged=unlogged_staging,
+                    # A backfill's staging table is not partitioned.
+                    # Its rows update the dataset's table.
+                    partition_column=(
+                        None if backfill_columns else partition_column
+                    ),
+                )
+                if resumable:
+                    create_checkpoint_table(
+                        database,
+                        checkpoint_table,
+                        unlogged=unlogged_staging,
+                    )
+        if use_copy:
+            if partition_column and not backfill_columns:
+                dataframes = create_partitions_for_chunks(dataframes)
+            # Array columns have already been converted to PostgreSQL
+            # array literals by ``parse_chunk()``
+            copy_dataframes(
+                database,
+                staging_table,
+                dataframes,
+                writers=import_writers,
+                checkpoint_table=checkpoint_table if resumable else None,
+                export_file=export_file,
+            )
+            return
+
+        # Fall back to INSERT statements for databases other than
+        # PostgreSQL
+        for i, df in enumerate(dataframes):
+            database.db_engine_spec.df_to_sql(
+                database,
+                staging_table,
+                df,
+                to_sql_kwargs={
+                    "if_exists": "replace" if i == 0 else "append",
+                    "dtype": sql_converters,
+                    "index": False,
+                },
+            )
+
+    def get_empty_dataframe():
+        """
+        Returns a DataFrame with the columns of the export, and no rows,
+        typed as ``parse_chunk()`` would type them.
+        """
+        columns = read_columns or [
+            'doc_id',
+            'inserted_at',
+            *(
+                ind['column_id']
+                for ind in datasource_defn['configured_indicators']
+            ),
+        ]
+        return pandas.DataFrame({
+            column: pandas.Series(
+                dtype=(
+                    'datetime64[ns]' if column in date_columns
+                    else column_dtypes.get(column, 'string')
+                ),
+            )
+            for column in columns
+        })
+
+    def create_partitions_for_chunks(dataframes):
+        """
+        Creates the partitions for the rows of each DataFrame in
+        ``dataframes`` before it is loaded.
+        """
+        # An incremental refresh loads into a staging table that is not
+        # partitioned, and then merges into the dataset's table
+        partitioned_table = csv_table if incremental else staging_table
+        months = set()
+        for df in dataframes:
+            new_months = get_partition_months(df[partition_column]) - months
+            if new_months:
+                create_partitions(database, partitioned_table, new_months)
+                months |= new_months
+            yield df
+
+    def skip_loaded_rows(dataframes, start_row=0):
         """
-        Upload Pandas DataFrame ``df`` to ``database``.
+        If the import is resumable, numbers the rows of each DataFrame
+        in ``dataframes`` by their row in the export file, starting at
+        ``start_row``, and drops the rows that were loaded before the
+        import was interrupted.
         """
-        database.db_engine_spec.df_to_sql(
-            database,
-            csv_table,
-            df,
-            to_sql_kwargs={
-                "if_exists": "replace" if replace else "append",
-                "dtype": sql_converters,
-                "index": False,
-            },
+        if not resumable:
+            yield from dataframes
+            return
+        for df in dataframes:
+            end_row = start_row + len(df)
+            df.index = pandas.RangeIndex(start_row, end_row)
+            ranges = get_unloaded_ranges(start_row, end_row, checkpoints)
+            if not len(df) or ranges == [(start_row, end_row)]:
+                # Nothing to skip. ``parse_chunk()`` assigns to columns,
+                # so avoid handing it a slice.
+                yield df
+            else:
+                for range_start, range_end in ranges:
+                    yield df.iloc[
+                        range_start - start_row:range_end - start_row
+                    ].copy()
+            start_row = end_row
+
+    def parse_chunk(df):
+        df = parse_date_columns(df, date_columns)
+        if decode_arrays:
+            for column in array_columns:
+                df[column] = decode_arrays(df[column])
+        return df
+
+    if backfill_columns:
+        # ``backfill_columns`` are the columns that might need it.
+        # Columns that can be cast in place don't.
+        backfill_columns = migrate_datasource_table(
+            domain, datasource_id, datasource_defn
         )
+        if backfill_columns == []:
+            logger.info("%s has no columns to backfill", datasource_id)
+            return
+        # If ``backfill_columns`` is None, the table can no longer be
+        # migrated, and the full export replaces it.
 
     database = get_hq_database()
     schema = get_schema_name_for_domain(domain)
     csv_table = Table(table=datasource_id, schema=schema)
+    staging_table = Table(
+        table=get_staging_table_name(datasource_id),
+        schema=schema,
+    )
+    checkpoint_table = Table(
+        table=get_checkpoint_table_name(datasource_id),
+        schema=schema,
+    )
+    # Identifies the export in the checkpoint table. A retried import
+    # downloads the export again, and resumes if its contents are the
+    # same.
+    export_file = fingerprint or os.path.basename(file_path)
+    export_format = get_export_format(file_path)
+    use_copy = supports_copy(database)
     column_dtypes, date_columns, array_columns = get_column_dtypes(
         datasource_defn
     )
-    converters = {
-        column_name: convert_to_array for column_name in array_columns
-    }
+    # The columns to read from the export, if not all of them
+    read_columns = None
+    if backfill_columns:
+        # Only read the columns that are needed to fill in the new
+        # columns
+        read_columns = ['doc_id', *backfill_columns]
+        column_dtypes = {
+            c: t for c, t in column_dtypes.items() if c in read_columns
+        }
+        date_columns = [c for c in date_columns if c in read_columns]
+        array_columns = [c for c in array_columns if c in read_columns]
+    # Read arrays as strings, and decode them a column at a time
+    column_dtypes.update({
+        column_name: 'string' for column_name in array_columns
+    })
+    if export_format == 'csv':
+        decode_arrays = to_pg_array_literals if use_copy else convert_to_arrays
+    else:
+        # Columnar exports have arrays as lists already
+        decode_arrays = lists_to_pg_array_literals if use_copy else None
     sql_converters = {
         # Assumes all array values will be of type TEXT
         column_name: postgresql.ARRAY(sqlalchemy.types.TEXT)
         for column_name in array_columns
     }
 
+    import_writers = (
+        current_app.config.get('HQ_IMPORT_WRITERS', IMPORT_WRITERS)
+        if use_copy else 1
+    )
+    partition_column = None
+    if use_copy:
+        if incremental or backfill_columns:
+            partition_column = get_partition_column(database, csv_table)
+        else:
+            partition_column = get_datasource_partition_column(
+                datasource_id,
+                date_columns,
+            )
+    # Partitioned tables are not unlogged, because partitions do not
+    # inherit UNLOGGED from their table
+    unlogged_staging = (
+        use_copy
+        and not (partition_column and not incremental and not backfill_columns)
+        and current_app.config.get(
+            'HQ_IMPORT_UNLOGGED_STAGING',
+            IMPORT_UNLOGGED_STAGING,
+        )
+    )
+    # Full refreshes record which rows have been loaded, so that if the
+    # worker is restarted, the retried task resumes where it stopped
+    resumable = use_copy and not incremental and not backfill_columns
+    checkpoints = []
+    if resumable:
+        checkpoints = get_checkpoints(database, checkpoint_table, export_file)
+        if checkpoints and not get_table_columns(database, staging_table):
+            checkpoints = []
+        if checkpoints:
+            logger.info(
+                "Resuming import of %s: %s rows already loaded",
+                datasource_id,
+                sum(end_row - start_row for start_row, end_row in checkpoints),
+            )
+    keep_unlogged = current_app.config.get(
+        'HQ_IMPORT_KEEP_UNLOGGED',
+        IMPORT_KEEP_UNLOGGED,
+    )
+    # The CSV files of a multi-file export are parsed in parallel
+    csv_parts = []
+    if export_format == 'csv':
+        csv_parts = get_datasource_parts(file_path)
+    parsers = max(1, min(
+        len(csv_parts),
+        current_app.config.get('HQ_IMPORT_PARSERS', IMPORT_PARSERS),
+    ))
+    # Chunks in memory at the same time: those waiting in the pipeline
+    # queue, the chunks being parsed, and for each writer, the chunk
+    # being loaded and its COPY buffer
+    chunk_sizer = ChunkSizer(
+        column_dtypes,
+        date_columns,
+        array_columns,
+        memory_budget=current_app.config.get(
+            'HQ_IMPORT_MEMORY_BUDGET',
+            IMPORT_MEMORY_BUDGET,
+        ),
+        chunks_in_memory=PIPELINE_QUEUE_SIZE + parsers + 2 * import_writers,
+    )
+    # Chunks are parsed in other threads, outside of the app context
+    csv_engine = get_csv_engine()
+
+    def read_export_chunks(parser=0):
+        """
+        Yields the chunks of the export that ``parser`` reads. If the
+        export has several CSV files, each parser reads every
+        ``parsers``-th file. Otherwise there is one parser.
+        """
+        if len(csv_parts) > 1:
+            for part in range(parser, len(csv_parts), parsers):
+                part_file = get_datasource_file(file_path, csv_parts[part])
+                with part_file as csv_file:
+                    yield from skip_loaded_rows(
+                        read_csv_chunks(csv_file),
+                        start_row=part * PART_ROW_OFFSET,
+                    )
+            return
+
+        if export_format == 'csv':
+            with get_datasource_file(file_path) as csv_file:
+                yield from skip_loaded_rows(read_csv_chunks(csv_file))
+            return
+
+        # Columnar exports are typed, and are not parsed
+        with get_columnar_file(file_path) as columnar_path:
+            yield from skip_loaded_rows(arrow.read_columnar_chunks(
+                columnar_path,
+                export_format,
+                column_dtypes,
+                date_columns,
+                array_columns,
+                batch_size=chunk_sizer.chunk_size,
+                columns=read_columns,
+            ))
+
+    def read_csv_chunks(csv_file):
+        if csv_engine == 'pyarrow':
+            yield from arrow.read_csv_chunks(
+                csv_file,
+                column_dtypes,
+                date_columns,
+                array_columns,
+                # Parsed data takes up several times the memory of the
+                # CSV data it was parsed from
+                block_size=chunk_sizer.chunk_memory_budget // 4,
+                columns=read_columns,
+            )
+            return
+
+        reader = pandas.read_csv(
+            chunksize=chunk_sizer.chunk_size,
+            filepath_or_buffer=csv_file,
+            encoding="utf-8",
+            keep_default_na=True,
+            dtype=column_dtypes,
+            usecols=read_columns,
+            iterator=True,
+            low_memory=True,
+        )
+        for df in reader:
+            # Adjust the size of the next chunk to the measured size of
+            # this one
+            reader.chunksize = chunk_sizer.update(df)
+            yield df
+
+    metrics = ImportMetrics(domain, datasource_id)
+    import_start = time.perf_counter()
     try:
-        with get_datasource_file(file_path) as csv_file:
-            dataframes = pandas.read_csv(
-                chunksize=10000,
-                filepath_or_buffer=csv_file,
-                encoding="utf-8",
-                parse_dates=date_columns,
-                date_parser=parse_date,
-                keep_default_na=True,
-                dtype=column_dtypes,
-                converters=converters,
-                iterator=True,
-                low_memory=True,
+        if incremental:
+            # Load into a table with the same columns as the dataset's.
+            # Its rows are copied into the dataset's table, so it never
+            # needs to be logged.
+            create_table_like(
+                database,
+                staging_table,
+                csv_table,
+                unlogged=unlogged_staging,
             )
-            dataframe_to_sql(next(dataframes), replace=True)
-            for df in dataframes:
-                dataframe_to_sql(df, replace=False)
+        parser_metrics = [{} for _ in range(parsers)]
+        with metrics.measure('load') as load_metrics:
+            # Parse chunks in background threads while earlier chunks
+            # are being written to the database
+            with MergeStage(
+                [
+                    measure_dataframes(
+                        (parse_chunk(df) for df in read_export_chunks(parser)),
+                        parser_metrics[parser],
+                    )
+                    for parser in range(parsers)
+                ],
+                name=f"parse {datasource_id}",
+            ) as parsed:
+                dataframes_to_sql(iter(parsed))
+            load_metrics['rows'] = sum(
+                m.get('rows', 0) for m in parser_metrics
+            )
+        # The time spent reading and parsing, which overlaps with
+        # loading, summed over parsers
+        metrics.send(
+            'parse',
+            rows=load_metrics['rows'],
+            seconds=sum(m.get('seconds', 0.0) for m in parser_metrics),
+            parsers=parsers,
+        )
+        index_columns, brin_columns, primary_key_columns = get_index_columns(
+            datasource_defn
+        )
+        if partition_column and primary_key_columns:
+            # The primary key of a partitioned table must include the
+            # partition column. Index the first primary key column
+            # instead.
+            if primary_key_columns[0] not in index_columns:
+                index_columns.insert(0, primary_key_columns[0])
+            primary_key_columns = []
+        if incremental or backfill_columns:
+            if backfill_columns:
+                with metrics.measure('backfill'):
+                    update_columns(
+                        database,
+                        staging_table,
+                        csv_table,
+                        backfill_columns,
+                    )
+            else:
+                with metrics.measure('merge'):
+                    merge_tables(database, staging_table, csv_table)
+            # Tables imported before their indexes were defined get them
+            # now. An existing table does not get a primary key, because
+            # its rows may not be unique.
+            indexed_columns = get_indexed_columns(database, csv_table)
+            index_columns = [
+                c for c in index_columns if c not in indexed_columns
+            ]
+            brin_columns = [
+                c for c in brin_columns if c not in indexed_columns
+            ]
+            if index_columns or brin_columns:
+                create_indexes(
+                    database,
+                    csv_table,
+                    index_columns,
+                    brin_columns,
+                    workers=import_writers,
+                )
+        else:
+            if unlogged_staging and not keep_unlogged:
+                # Before the indexes are built, so that they are not
+                # rewritten
+                set_table_logged(database, staging_table)
+            if use_copy:
+                # Indexes are built after the data has been loaded,
+                # instead of being updated for every row. They stay
+                # with the staging table when it replaces the dataset's
+                # table.
+                with metrics.measure('indexes'):
+                    create_indexes(
+                        database,
+                        staging_table,
+                        index_columns,
+                        brin_columns,
+                        primary_key_columns,
+                        workers=import_writers,
+                    )
+            with metrics.measure('swap'):
+                swap_tables(database, staging_table, csv_table)
+            if resumable:
+                drop_table(database, checkpoint_table)
 
+        metadata_start = time.perf_counter()
         sqla_table = (
             db.session.query(SqlaTable)
             .filter_by(
@@ -149,29 +1106,250 @@ def refresh_hq_datasource(
             sqla_table.schema = csv_table.schema
             sqla_table.fetch_metadata()
             db.session.add(sqla_table)
+        if partition_column:
+            # Time filters on this column let PostgreSQL skip partitions
+            sqla_table.main_dttm_col = partition_column
+        # Incremental refreshes and backfills have no fingerprint, and
+        # clear the fingerprint of the last full refresh
+        extra = {**sqla_table.extra_dict, FINGERPRINT_KEY: fingerprint}
+        if not incremental:
+            # Full refreshes and backfills load every pending column
+            extra.pop(BACKFILL_KEY, None)
+        sqla_table.extra = json.dumps(extra)
         db.session.commit()
+        metrics.send('metadata', seconds=time.perf_counter() - metadata_start)
+        metrics.send(
+            'import',
+            seconds=time.perf_counter() - import_start,
+            rows=load_metrics['rows'],
+            # Since the worker started, not just during this import
+            worker_peak_rss_bytes=get_peak_rss(),
+        )
     except Exception as ex:  # pylint: disable=broad-except
         db.session.rollback()
+        drop_table(database, staging_table)
+        drop_table(database, checkpoint_table)
         raise ex
 
 
-def subscribe_to_hq_datasource(domain, datasource_id):
-    client = _get_or_create_oauth2client(domain)
-    hq_request = HQRequest(url=datasource_subscribe(domain, datasource_id))
-    scheme = _get_url_scheme()
-    webhook_url = current_app.url_for(
-        'DataSetChangeAPI.post_dataset_change',
-        _external=True,
-        _scheme=scheme,
+@dataclass
+class DatasourceExport:
+    """
+    An export downloaded by ``download_datasource_export()``, and how to
+    refresh the dataset with it
+    """
+    path: str
+    size: int
+    incremental: bool = False
+    fingerprint: Optional[str] = None
+    backfill_columns: Optional[list[str]] = None
+
+
+def download_datasource_export(
+    domain,
+    datasource_id,
+    datasource_defn,
+    incremental=False,
+    token=None,
+    subscription_urls=None,
+):
+    """
+    Downloads the export that the data source's dataset needs to be
+    refreshed, and returns a ``DatasourceExport``.
+
+    If ``incremental`` is True, only rows that were added or changed
+    since the last refresh are downloaded. If the data source's columns
+    have changed, a full export is downloaded, and
+    ``DatasourceExport.backfill_columns`` is set, so that the import
+    migrates the dataset's table and loads the new columns. Falls back
+    to a full refresh if an incremental one is not possible.
+
+    Returns None, and deletes the export, if a full export has not
+    changed since the last refresh.
+    """
+    since = None
+    backfill_columns = None
+    if incremental:
+        # If the data source's columns have changed, the dataset's table
+        # is altered in place instead of being reloaded. New columns
+        # are loaded from a full export, and new rows are imported by
+        # the next incremental refresh. The table is only altered by
+        # ``refresh_hq_datasource()``, not here: This can run in a web
+        # request, and altering the table can take a while.
+        migration = get_datasource_migration(
+            domain, datasource_id, datasource_defn
+        )
+        if migration is not None:
+            backfill_columns = migration.backfill_columns
+        if not backfill_columns:
+            since = get_incremental_refresh_start(
+                domain, datasource_id, datasource_defn
+            )
+        incremental = since is not None
+    path, size = download_and_subscribe_to_datasource(
+        domain,
+        datasource_id,
+        since=since,
+        token=token,
+        subscription_urls=subscription_urls,
+    )
+    fingerprint = None
+    if not incremental and not backfill_columns:
+        fingerprint = get_datasource_fingerprint(
+            path,
+            datasource_defn,
+            get_import_settings(datasource_id),
+        )
+        if is_datasource_up_to_date(domain, datasource_id, fingerprint):
+            os.remove(path)
+            return None
+    return DatasourceExport(
+        path,
+        size,
+        incremental,
+        fingerprint,
+        backfill_columns,
+    )
+
+
+def import_hq_datasource(
+    domain,
+    datasource_id,
+    user_id,
+    incremental=False,
+    token=None,
+    subscription_urls=None,
+):
+    """
+    Fetches the data source's definition and export from CommCare HQ,
+    and creates or refreshes its dataset. Skips the import if the export
+    has not changed since the last one.
+
+    Runs in Celery tasks, outside of the user's session and the web
+    request, so requests to CommCare HQ are made with the user's
+    ``token``, and ``subscription_urls`` are given.
+    """
+    datasource_defn = get_datasource_defn(domain, datasource_id, token)
+    export = download_datasource_export(
+        domain,
+        datasource_id,
+        datasource_defn,
+        incremental,
+        token,
+        subscription_urls,
+    )
+    if export is None:
+        logger.info("%s is already up to date", datasource_id)
+        return
+    try:
+        refresh_hq_datasource(
+            domain,
+            datasource_id,
+            datasource_defn['display_name'],
+            export.path,
+            datasource_defn,
+            user_id,
+            export.incremental,
+            export.fingerprint,
+            export.backfill_columns,
+        )
+    finally:
+        os.remove(export.path)
+
+
+def get_import_settings(datasource_id):
+    """
+    Returns the settings that change the table that the data source is
+    imported into. They are part of its fingerprint, so that an export
+    that has not changed is imported again after they change.
+    """
+    return {
+        'version': IMPORT_TABLE_VERSION,
+        'partition_column': current_app.config.get(
+            'HQ_PARTITIONED_DATASOURCES',
+            {},
+        ).get(datasource_id),
+        # Whether the table is left unlogged
+        'unlogged': bool(
+            current_app.config.get(
+                'HQ_IMPORT_UNLOGGED_STAGING',
+                IMPORT_UNLOGGED_STAGING,
+            )
+            and current_app.config.get(
+                'HQ_IMPORT_KEEP_UNLOGGED',
+                IMPORT_KEEP_UNLOGGED,
+            )
+        ),
+    }
+
+
+def get_datasource_partition_column(datasource_id, date_columns):
+    """
+    Returns the date column to partition the data source's table by, if
+    it is set in ``HQ_PARTITIONED_DATASOURCES``.
+    """
+    partition_columns = current_app.config.get(
+        'HQ_PARTITIONED_DATASOURCES',
+        {},
+    )
+    partition_column = partition_columns.get(datasource_id)
+    if partition_column and partition_column not in date_columns:
+        logger.warning(
+            "Unable to partition %s by %r: It is not a date column",
+            datasource_id,
+            partition_column,
+        )
+        return None
+    return partition_column
+
+
+def get_export_formats():
+    """
+    Returns the formats to request UCR exports from CommCare HQ in, in
+    order of preference. Columnar formats are only requested if PyArrow
+    is installed, and CSV is always the last resort.
+    """
+    export_formats = current_app.config.get(
+        'HQ_EXPORT_FORMATS',
+        EXPORT_FORMATS,
     )
-    token_url = current_app.url_for(
-        'OAuth.issue_access_token',
-        _external=True,
-        _scheme=scheme,
+    if not arrow.is_pyarrow_available():
+        export_formats = [f for f in export_formats if f == 'csv']
+    if 'csv' not in export_formats:
+        export_formats = [*export_formats, 'csv']
+    return export_formats
+
+
+def get_csv_engine():
+    """
+    Returns the CSV parser to use for UCR imports: "pandas" or
+    "pyarrow". Falls back to "pandas" if PyArrow is not installed.
+    """
+    csv_engine = current_app.config.get('HQ_IMPORT_CSV_ENGINE', 'pandas')
+    if csv_engine == 'pyarrow' and not arrow.is_pyarrow_available():
+        logger.warning(
+            "HQ_IMPORT_CSV_ENGINE is 'pyarrow' but PyArrow is not "
+            "installed. Using pandas."
+        )
+        return 'pandas'
+    return csv_engine
+
+
+def subscribe_to_hq_datasource(
+    domain,
+    datasource_id,
+    token=None,
+    subscription_urls=None,
+):
+    client = _get_or_create_oauth2client(domain)
+    hq_request = HQRequest(
+        url=datasource_subscribe(domain, datasource_id),
+        token=token,
     )
+    subscription_urls = subscription_urls or get_subscription_urls()
     response = hq_request.post({
-        'webhook_url': webhook_url,
-        'token_url': token_url,
+        'webhook_url': subscription_urls['webhook_url'],
+        'token_url': subscription_urls['token_url'],
         'client_id': client.client_id,
         'client_secret': client.get_client_secret(),
     })
@@ -187,6 +1365,27 @@ def subscribe_to_hq_datasource(domain, datasource_id):
         )
 
 
+def get_subscription_urls():
+    """
+    Returns the URLs that CommCare HQ sends changes to data sources to,
+    and gets access tokens from. They are built from the current web
+    request, so tasks are given them by the view that queues them.
+    """
+    scheme = _get_url_scheme()
+    return {
+        'webhook_url': current_app.url_for(
+            'DataSetChangeAPI.post_dataset_change',
+            _external=True,
+            _scheme=scheme,
+        ),
+        'token_url': current_app.url_for(
+            'OAuth.issue_access_token',
+            _external=True,
+            _scheme=scheme,
+        ),
+    }
+
+
 def _get_url_scheme():
     scheme = 'https'
     # Allow "http" for localhost only. Use request.server because
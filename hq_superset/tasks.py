@@ -1,15 +1,134 @@
+import logging
 import os
 
 from superset.extensions import celery_app
 
-from .services import AsyncImportHelper, refresh_hq_datasource
+from .concurrency import (
+    IMPORT_SLOT_RETRY_DELAY,
+    finish_queued_import,
+    import_slot,
+    start_queued_imports,
+    take_queued_import,
+)
+from .const import (
+    IMPORT_PRIORITY_HIGH,
+    IMPORT_PRIORITY_LOW,
+    SMALL_IMPORT_LIMIT_IN_BYTES,
+)
+from .oauth import SharedOAuthToken
+from .services import (
+    AsyncImportHelper,
+    import_hq_datasource,
+    refresh_hq_datasource,
+    remove_stale_exports,
+)
 
+logger = logging.getLogger(__name__)
 
-@celery_app.task(name='refresh_hq_datasource_task')
-def refresh_hq_datasource_task(domain, datasource_id, display_name, export_path, datasource_defn, user_id):
-    try:
-        refresh_hq_datasource(domain, datasource_id, display_name, export_path, datasource_defn, user_id)
-    except Exception:
+
+@celery_app.task(name='refresh_hq_datasource_task', bind=True, max_retries=None)
+def refresh_hq_datasource_task(self, domain, datasource_id, display_name, export_path, datasource_defn, user_id, incremental=False, fingerprint=None, backfill_columns=None):
+    if not os.path.exists(export_path):
+        # E.g. the broker delivered this task again long after its
+        # worker died, and the export was removed as stale
+        logger.warning("The export of %s is gone: %s", datasource_id, export_path)
         AsyncImportHelper(domain, datasource_id).mark_as_complete()
-        raise
+        return
+    # The export is not removed as stale while the task is retried, or
+    # while it runs, because it holds the data source's lock
+    os.utime(export_path)
+    with import_slot(domain, datasource_id) as acquired:
+        if not acquired:
+            raise self.retry(countdown=IMPORT_SLOT_RETRY_DELAY)
+        try:
+            refresh_hq_datasource(domain, datasource_id, display_name, export_path, datasource_defn, user_id, incremental, fingerprint, backfill_columns)
+        except Exception:
+            AsyncImportHelper(domain, datasource_id).mark_as_complete()
+            raise
     os.remove(export_path)
+
+
+@celery_app.task(name='import_hq_datasource_task', bind=True, max_retries=None)
+def import_hq_datasource_task(self, domain, datasource_id, user_id, incremental=False):
+    try:
+        with import_slot(domain, datasource_id) as acquired:
+            if not acquired:
+                raise self.retry(countdown=IMPORT_SLOT_RETRY_DELAY)
+            # The subscription URLs were saved with the queued import,
+            # and the user's token was saved, by the view that queued it
+            item = take_queued_import(domain, datasource_id, self.request.id)
+            if item is None:
+                # E.g. the broker delivered this task again after its
+                # worker died, and the import was queued again and run
+                # by another task
+                logger.info("%s is not in the import queue", datasource_id)
+                return
+            try:
+                import_hq_datasource(
+                    domain,
+                    datasource_id,
+                    item.user_id,
+                    item.incremental,
+                    token=SharedOAuthToken(item.user_id),
+                    subscription_urls=item.get_subscription_urls(),
+                )
+            except Exception:
+                AsyncImportHelper(domain, datasource_id).mark_as_complete()
+                raise
+            finally:
+                finish_queued_import(domain, datasource_id)
+    finally:
+        # Give the slot to the next import in the queue
+        dispatch_imports()
+
+
+@celery_app.task(name='dispatch_hq_imports_task')
+def dispatch_hq_imports_task():
+    # Runs periodically, to start imports that were missed, and to
+    # clean up the exports of imports that did not finish, e.g. if a
+    # worker died
+    dispatch_imports()
+    remove_stale_exports()
+
+
+def dispatch_imports():
+    """
+    Starts the queued imports that have free slots.
+    """
+    start_queued_imports(_start_import)
+
+
+def get_import_priority(size=None, incremental=False):
+    """
+    Returns the Celery priority of an import task. Small exports and
+    incremental refreshes go ahead of large imports that are waiting on
+    the import queue. If ``size`` is not known, only incremental
+    refreshes are treated as small.
+
+    >>> get_import_priority(size=1_000_000)
+    0
+    >>> get_import_priority(size=2_000_000_000)
+    6
+    >>> get_import_priority(incremental=True)
+    0
+
+    """
+    if incremental:
+        return IMPORT_PRIORITY_HIGH
+    if size is not None and size < SMALL_IMPORT_LIMIT_IN_BYTES:
+        return IMPORT_PRIORITY_HIGH
+    return IMPORT_PRIORITY_LOW
+
+
+def _start_import(item):
+    task_id = import_hq_datasource_task.apply_async(
+        args=(
+            item.domain,
+            item.datasource_id,
+            item.user_id,
+            item.incremental,
+        ),
+        priority=get_import_priority(incremental=item.incremental),
+    ).task_id
+    AsyncImportHelper(item.domain, item.datasource_id).mark_as_in_progress(task_id)
+    return task_id
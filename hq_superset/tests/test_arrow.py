@@ -0,0 +1,112 @@
+import doctest
+import io
+
+import pandas
+import pytest
+
+from hq_superset.utils import get_column_dtypes, parse_date_columns
+
+from .const import TEST_DATASOURCE
+
+pytest.importorskip('pyarrow')
+
+TEST_UCR_CSV = b"""\
+doc_id,inserted_at,data_visit_date_eaece89e,data_visit_number_33d63739,data_lmp_date_5e24b993,data_visit_comment_fb984fda
+a1,2021-12-20 10:15:00.123456,2022-01-19,100,2022-02-20,some_text
+a2,2021-12-22 11:00:00,2022-02-19,,not a date,"with, comma"
+a3,2021-12-22 11:00:00,,10,,
+"""
+
+
+def test_read_csv_chunks_matches_pandas():
+    from hq_superset.arrow import read_csv_chunks
+
+    column_dtypes, date_columns, array_columns = get_column_dtypes(
+        TEST_DATASOURCE
+    )
+    expected = parse_date_columns(
+        pandas.read_csv(io.BytesIO(TEST_UCR_CSV), dtype=column_dtypes),
+        date_columns,
+    )
+    chunks = read_csv_chunks(
+        io.BytesIO(TEST_UCR_CSV),
+        column_dtypes,
+        date_columns,
+        array_columns,
+        block_size=1024,
+    )
+    df = pandas.concat(chunks, ignore_index=True)
+    pandas.testing.assert_frame_equal(df, expected)
+
+
+@pytest.mark.parametrize('export_format', ['parquet', 'arrow'])
+def test_read_columnar_chunks_matches_csv(tmp_path, export_format):
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    from hq_superset.arrow import read_columnar_chunks
+
+    column_dtypes, date_columns, array_columns = get_column_dtypes(
+        TEST_DATASOURCE
+    )
+    csv_data = TEST_UCR_CSV.replace(b'not a date', b'')
+    expected = parse_date_columns(
+        pandas.read_csv(io.BytesIO(csv_data), dtype=column_dtypes),
+        date_columns,
+    )
+    # The export is typed, but with types that differ from the ones
+    # the data source definition maps to
+    table = pyarrow.Table.from_pandas(expected, preserve_index=False)
+    table = table.set_column(
+        table.schema.get_field_index('data_visit_number_33d63739'),
+        'data_visit_number_33d63739',
+        table['data_visit_number_33d63739'].cast(pyarrow.int32()),
+    )
+    path = tmp_path / f'export.{export_format}'
+    if export_format == 'parquet':
+        pyarrow.parquet.write_table(table, path)
+    else:
+        with pyarrow.ipc.new_file(path, table.schema) as writer:
+            writer.write_table(table, max_chunksize=2)
+
+    chunks = read_columnar_chunks(
+        str(path),
+        export_format,
+        column_dtypes,
+        date_columns,
+        array_columns,
+        batch_size=2,
+    )
+    df = pandas.concat(chunks, ignore_index=True)
+    pandas.testing.assert_frame_equal(df, expected)
+
+
+def test_read_columnar_chunks_arrays(tmp_path):
+    import pyarrow
+    import pyarrow.parquet
+
+    from hq_superset.arrow import read_columnar_chunks
+
+    table = pyarrow.table({
+        'doc_id': ['a1', 'a2'],
+        'tags': pyarrow.array([['x', 'y'], None], pyarrow.list_(pyarrow.string())),
+    })
+    path = tmp_path / 'export.parquet'
+    pyarrow.parquet.write_table(table, path)
+    chunks = read_columnar_chunks(
+        str(path),
+        'parquet',
+        {'doc_id': 'string', 'tags': 'string'},
+        [],
+        ['tags'],
+        batch_size=10,
+    )
+    df = pandas.concat(chunks)
+    assert df['tags'].tolist() == [['x', 'y'], None]
+
+
+def test_doctests():
+    import hq_superset.arrow
+    results = doctest.testmod(hq_superset.arrow)
+    assert results.failed == 0
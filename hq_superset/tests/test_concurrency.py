@@ -0,0 +1,161 @@
+import doctest
+import time
+from collections import namedtuple
+from unittest.mock import Mock, patch
+
+import pytest
+from superset import db
+
+from hq_superset.concurrency import (
+    IMPORT_MAX_ATTEMPTS,
+    IMPORT_START_TIMEOUT,
+    choose_imports,
+    finish_queued_import,
+    get_queued_import,
+    import_slot,
+    queue_import,
+    start_queued_imports,
+)
+from hq_superset.models import ImportQueueItem
+
+from .base_test import HQDBTestCase
+
+Import = namedtuple('Import', 'domain datasource_id')
+
+
+class TestImportSlot(HQDBTestCase):
+
+    def test_import_slot(self):
+        with patch.dict(self.app.config, {
+            'HQ_IMPORT_CONCURRENCY': 2,
+            'HQ_IMPORT_CONCURRENCY_PER_DOMAIN': 1,
+        }):
+            with import_slot('test1') as acquired:
+                self.assertTrue(acquired)
+                # The domain's only slot is taken
+                with import_slot('test1') as acquired:
+                    self.assertFalse(acquired)
+                with import_slot('test2') as acquired:
+                    self.assertTrue(acquired)
+                    # All slots are taken
+                    with import_slot('test3') as acquired:
+                        self.assertFalse(acquired)
+            # Slots are freed when the context exits
+            with import_slot('test3') as acquired:
+                self.assertTrue(acquired)
+
+    def test_import_slot_datasource(self):
+        with import_slot('test1', 'ucr1') as acquired:
+            self.assertTrue(acquired)
+            # The data source is already being imported
+            with import_slot('test1', 'ucr1') as acquired:
+                self.assertFalse(acquired)
+            with import_slot('test1', 'ucr2') as acquired:
+                self.assertTrue(acquired)
+
+
+class TestStartQueuedImports(HQDBTestCase):
+
+    def tearDown(self):
+        finish_queued_import('test1', 'ucr1')
+        super().tearDown()
+
+    def test_import_is_started_once(self):
+        queue_import('test1', 'ucr1', None)
+
+        def choose_imports_concurrently(waiting, *args):
+            # Another dispatcher starts the import after this one has
+            # read the queue
+            db.session.query(ImportQueueItem).update(
+                {'started_at': 1, 'task_id': 'task1'},
+                synchronize_session=False,
+            )
+            db.session.commit()
+            return waiting
+
+        start_import = Mock(return_value='task2')
+        with patch(
+            'hq_superset.concurrency.choose_imports',
+            side_effect=choose_imports_concurrently,
+        ):
+            start_queued_imports(start_import)
+        start_import.assert_not_called()
+        self.assertEqual(get_queued_import('test1', 'ucr1').task_id, 'task1')
+
+    def test_unqueued_imports_hold_slots(self):
+        queue_import('test1', 'ucr1', None)
+        start_import = Mock(return_value='task1')
+        with (
+            patch.dict(self.app.config, {'HQ_IMPORT_CONCURRENCY_PER_DOMAIN': 1}),
+            # An import by ``refresh_hq_datasource_task``
+            import_slot('test1', 'ucr2'),
+        ):
+            start_queued_imports(start_import)
+        start_import.assert_not_called()
+
+    def test_lost_import_is_queued_again(self):
+        self._start_lost_import(attempts=1)
+        start_import = Mock(return_value='task2')
+        start_queued_imports(start_import)
+        start_import.assert_called_once()
+        item = get_queued_import('test1', 'ucr1')
+        self.assertEqual(item.task_id, 'task2')
+        self.assertEqual(item.attempts, 2)
+
+    def test_running_import_is_not_queued_again(self):
+        self._start_lost_import(attempts=1)
+        start_import = Mock(return_value='task2')
+        with import_slot('test1', 'ucr1'):
+            start_queued_imports(start_import)
+        start_import.assert_not_called()
+        self.assertEqual(get_queued_import('test1', 'ucr1').task_id, 'task1')
+
+    def test_lost_import_is_removed_after_max_attempts(self):
+        self._start_lost_import(attempts=IMPORT_MAX_ATTEMPTS)
+        start_import = Mock(return_value='task2')
+        start_queued_imports(start_import)
+        start_import.assert_not_called()
+        self.assertIsNone(get_queued_import('test1', 'ucr1'))
+
+    def _start_lost_import(self, attempts):
+        queue_import('test1', 'ucr1', None)
+        item = get_queued_import('test1', 'ucr1')
+        item.started_at = time.time() - IMPORT_START_TIMEOUT - 1
+        item.task_id = 'task1'
+        item.attempts = attempts
+        db.session.commit()
+
+
+def test_choose_imports_weights():
+    waiting = [
+        Import('big', 'a'),
+        Import('big', 'b'),
+        Import('big', 'c'),
+        Import('small', 'd'),
+        Import('small', 'e'),
+    ]
+    imports = choose_imports(
+        waiting,
+        running={},
+        slots=4,
+        limit_per_domain=3,
+        weights={'big': 2},
+    )
+    assert [i.datasource_id for i in imports] == ['a', 'd', 'b', 'c']
+
+
+def test_choose_imports_invalid_weights():
+    with pytest.raises(ValueError):
+        choose_imports(
+            [Import('big', 'a')],
+            running={},
+            slots=1,
+            limit_per_domain=1,
+            weights={'big': 0},
+        )
+
+
+def test_doctests():
+    import hq_superset.concurrency
+    results = doctest.testmod(hq_superset.concurrency)
+    assert results.failed == 0
@@ -0,0 +1,129 @@
+import doctest
+import re
+
+import pytest
+import requests
+
+from hq_superset.downloads import (
+    ContentChanged,
+    SegmentedDownload,
+    download_segments,
+)
+
+CONTENT = bytes(range(256)) * 40  # 10240 bytes
+SEGMENT_SIZE = 1024
+
+
+class RangeResponse:
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class RangeServer:
+    """
+    Serves ``content`` in ranges, like a server that accepts range
+    requests
+    """
+
+    def __init__(self, content, etag='"v1"'):
+        self.content = content
+        self.etag = etag
+        self.requested = []
+        self.failures = {}
+
+    def get(self, headers):
+        if headers['If-Range'] != self.etag:
+            return RangeResponse(200, self.content)
+        start, end = map(int, re.match(
+            r'bytes=(\d+)-(\d+)', headers['Range']
+        ).groups())
+        self.requested.append(start)
+        if self.failures.get(start):
+            self.failures[start] -= 1
+            # The connection drops half way through the range
+            return RangeResponse(206, self.content[start:(start + end) // 2])
+        return RangeResponse(206, self.content[start:end + 1])
+
+
+def get_download(tmp_path, etag='"v1"'):
+    return SegmentedDownload(
+        str(tmp_path / 'export.zip.part'),
+        'export/',
+        len(CONTENT),
+        etag,
+        segment_size=SEGMENT_SIZE,
+    )
+
+
+def test_download_segments(tmp_path):
+    server = RangeServer(CONTENT)
+    download = get_download(tmp_path)
+    assert download.load() == 0
+    assert download_segments(download, server.get, connections=4) == len(CONTENT)
+    download.finish(str(tmp_path / 'export.zip'))
+    assert (tmp_path / 'export.zip').read_bytes() == CONTENT
+    assert sorted(server.requested) == list(range(0, len(CONTENT), SEGMENT_SIZE))
+    assert not (tmp_path / 'export.zip.part.json').exists()
+
+
+def test_download_segments_retries(tmp_path):
+    server = RangeServer(CONTENT)
+    server.failures = {2048: 2}
+    download = get_download(tmp_path)
+    download.load()
+    download_segments(download, server.get, connections=4)
+    download.finish(str(tmp_path / 'export.zip'))
+    assert (tmp_path / 'export.zip').read_bytes() == CONTENT
+    assert server.requested.count(2048) == 3
+
+
+def test_download_segments_resumes(tmp_path):
+    server = RangeServer(CONTENT)
+    # The segment at 2048 fails every time
+    server.failures = {2048: 100}
+    download = get_download(tmp_path)
+    download.load()
+    with pytest.raises(requests.exceptions.ConnectionError):
+        download_segments(download, server.get, connections=1)
+
+    # The next download only fetches the missing segments
+    server.failures = {}
+    server.requested = []
+    download = get_download(tmp_path)
+    assert download.load() == 2048
+    download_segments(download, server.get, connections=4)
+    download.finish(str(tmp_path / 'export.zip'))
+    assert (tmp_path / 'export.zip').read_bytes() == CONTENT
+    assert 0 not in server.requested
+    assert 1024 not in server.requested
+    assert 2048 in server.requested
+
+
+def test_download_starts_over_for_new_export(tmp_path):
+    download = get_download(tmp_path)
+    download.load()
+    download.mark_complete(0)
+    assert get_download(tmp_path, etag='"v2"').load() == 0
+
+
+def test_download_segments_content_changed(tmp_path):
+    server = RangeServer(CONTENT, etag='"v2"')
+    download = get_download(tmp_path, etag='"v1"')
+    download.load()
+    with pytest.raises(ContentChanged):
+        download_segments(download, server.get, connections=4)
+    assert not download.completed
+
+
+def test_doctests():
+    import hq_superset.downloads
+    results = doctest.testmod(hq_superset.downloads)
+    assert results.failed == 0
@@ -0,0 +1,69 @@
+import doctest
+
+from sqlalchemy.sql import text
+from superset.sql_parse import Table
+
+from hq_superset.loaders import (
+    create_indexes,
+    get_indexed_columns,
+    to_pg_array_literal,
+    to_pg_array_literals,
+)
+
+from .base_test import HQDBTestCase
+
+
+def test_pg_array_literal_escapes_elements():
+    assert to_pg_array_literal(['a "b"', 'c\\d', 'e,f']) == (
+        '{"a \\"b\\"","c\\\\d","e,f"}'
+    )
+
+
+def test_pg_array_literal_not_a_list():
+    assert to_pg_array_literal(None) is None
+
+
+def test_pg_array_literals_from_hq_lists():
+    values = ["['a \"b\"', 'c']", "('d', 'e')", "[None]", None]
+    assert to_pg_array_literals(values).tolist() == [
+        '{"a \\"b\\"","c"}',
+        '{"d","e"}',
+        '{}',
+        '{}',
+    ]
+
+
+class TestCreateIndexes(HQDBTestCase):
+
+    def test_create_indexes_duplicate_primary_key(self):
+        table = Table(table='duplicate_doc_ids', schema='hqdomain_test1')
+        with self.hq_db.get_sqla_engine_with_context() as engine:
+            with engine.begin() as connection:
+                connection.execute(text(
+                    'CREATE SCHEMA IF NOT EXISTS hqdomain_test1'
+                ))
+                connection.execute(text(
+                    'CREATE TABLE hqdomain_test1.duplicate_doc_ids AS '
+                    "SELECT 'a1' AS doc_id UNION ALL SELECT 'a1'"
+                ))
+        try:
+            create_indexes(
+                self.hq_db,
+                table,
+                index_columns=[],
+                primary_key_columns=['doc_id'],
+            )
+            # doc_id is indexed without the primary key
+            self.assertIn('doc_id', get_indexed_columns(self.hq_db, table))
+        finally:
+            with self.hq_db.get_sqla_engine_with_context() as engine:
+                with engine.begin() as connection:
+                    connection.execute(text(
+                        'DROP TABLE hqdomain_test1.duplicate_doc_ids'
+                    ))
+
+
+def test_doctests():
+    import hq_superset.loaders
+    results = doctest.testmod(hq_superset.loaders)
+    assert results.failed == 0
@@ -0,0 +1,98 @@
+import doctest
+import sys
+import types
+from unittest.mock import Mock
+
+import pandas
+import pytest
+
+from hq_superset.metrics import (
+    ImportMetrics,
+    PrometheusMetricsSink,
+    StatsLoggerMetricsSink,
+    measure_dataframes,
+)
+
+
+class ListSink:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, stage, metrics, tags):
+        self.sent.append((stage, metrics, tags))
+
+
+class FailingSink:
+    def send(self, stage, metrics, tags):
+        raise ConnectionError('metrics server is down')
+
+
+def test_metrics_are_tagged():
+    sink = ListSink()
+    metrics = ImportMetrics('demo', 'abc123', sink=sink)
+    metrics.send('download', bytes=2000, seconds=2.0)
+    assert sink.sent == [(
+        'download',
+        {'bytes': 2000, 'seconds': 2.0, 'bytes_per_second': 1000.0},
+        {'domain': 'demo', 'datasource_id': 'abc123'},
+    )]
+
+
+def test_failed_stage_is_not_sent():
+    sink = ListSink()
+    metrics = ImportMetrics('demo', 'abc123', sink=sink)
+    with pytest.raises(ValueError):
+        with metrics.measure('load'):
+            raise ValueError('bad chunk')
+    assert sink.sent == []
+
+
+def test_sink_errors_are_ignored():
+    metrics = ImportMetrics('demo', 'abc123', sink=FailingSink())
+    with metrics.measure('load') as load_metrics:
+        load_metrics['rows'] = 10
+
+
+def test_prometheus_sink_pushes_metrics(monkeypatch):
+    prometheus_client = pytest.importorskip('prometheus_client')
+    pushed = []
+    monkeypatch.setattr(
+        prometheus_client,
+        'push_to_gateway',
+        lambda gateway, **kwargs: pushed.append((gateway, kwargs)),
+    )
+    sink = PrometheusMetricsSink('pushgateway:9091')
+    ImportMetrics('demo', 'abc123', sink=sink).send('load', rows=10)
+    ImportMetrics('demo', 'def456', sink=sink).send('load', rows=20)
+
+    gateway, kwargs = pushed[-1]
+    assert gateway == 'pushgateway:9091'
+    assert kwargs['grouping_key'] == {'stage': 'load', 'domain': 'demo'}
+    # The data source is not a label
+    assert kwargs['registry'].get_sample_value('hq_import_rows') == 20
+
+
+def test_stats_logger_sink_sends_milliseconds(monkeypatch):
+    stats_logger = Mock()
+    monkeypatch.setitem(sys.modules, 'superset.extensions', types.SimpleNamespace(
+        stats_logger_manager=types.SimpleNamespace(instance=stats_logger),
+    ))
+    sink = StatsLoggerMetricsSink()
+    ImportMetrics('demo', 'abc123', sink=sink).send('load', rows=10, seconds=2.5)
+
+    stats_logger.timing.assert_called_once_with('hq_import.load.duration', 2500)
+    stats_logger.gauge.assert_any_call('hq_import.load.rows', 10)
+
+
+def test_measure_dataframes():
+    metrics = {}
+    dataframes = (pandas.DataFrame({'a': range(n)}) for n in (3, 4))
+    assert [len(df) for df in measure_dataframes(dataframes, metrics)] == [3, 4]
+    assert metrics['rows'] == 7
+    assert metrics['seconds'] >= 0
+
+
+def test_doctests():
+    import hq_superset.metrics
+    results = doctest.testmod(hq_superset.metrics)
+    assert results.failed == 0
@@ -1,10 +1,19 @@
 import datetime
+import doctest
+import time
 from unittest.mock import patch
 
 from flask import session
+from superset import db
 
 from hq_superset.exceptions import OAuthSessionExpired
-from hq_superset.oauth import get_valid_cchq_oauth_token
+from hq_superset.models import UserOAuthToken
+from hq_superset.oauth import (
+    SharedOAuthToken,
+    get_saved_oauth_token,
+    get_valid_cchq_oauth_token,
+    save_oauth_token,
+)
 from hq_superset.utils import (
     SESSION_OAUTH_RESPONSE_KEY,
     SESSION_USER_DOMAINS_KEY,
@@ -110,3 +119,58 @@ class TestGetOAuthTokenGetter(SupersetTestCase):
             set_mock.assert_called_once_with(
                 "commcare", {"access_token": "new key"}
             )
+
+
+class TestSharedOAuthToken(SupersetTestCase):
+
+    def setUp(self):
+        super().setUp()
+        now = int(time.time())
+        self.expired = {
+            "access_token": "old key",
+            "refresh_token": "old refresh token",
+            "expires_at": now - 60,
+        }
+        self.refreshed = {
+            "access_token": "new key",
+            "refresh_token": "new refresh token",
+            "expires_at": now + 900,
+        }
+
+    def tearDown(self):
+        db.session.query(UserOAuthToken).delete()
+        db.session.commit()
+        super().tearDown()
+
+    def test_refresh_saves_token(self):
+        save_oauth_token(1, self.expired)
+        token = SharedOAuthToken(1)
+        with patch('hq_superset.oauth.refresh_and_fetch_token') as refresh_mock:
+            refresh_mock.return_value = self.refreshed
+            self.assertEqual(token.get(), self.refreshed)
+        refresh_mock.assert_called_once_with("old refresh token")
+        self.assertEqual(get_saved_oauth_token(1), self.refreshed)
+
+    def test_uses_token_refreshed_elsewhere(self):
+        save_oauth_token(1, self.expired)
+        token = SharedOAuthToken(1)
+        # e.g. The user's session refreshes the token
+        save_oauth_token(1, self.refreshed)
+        with patch('hq_superset.oauth.refresh_and_fetch_token') as refresh_mock:
+            self.assertEqual(token.get(), self.refreshed)
+        refresh_mock.assert_not_called()
+
+    def test_saved_token_is_newer(self):
+        save_oauth_token(1, self.refreshed)
+        save_oauth_token(1, self.expired)
+        self.assertEqual(get_saved_oauth_token(1), self.refreshed)
+        self.assertEqual(
+            SharedOAuthToken(1, self.expired).oauth_response,
+            self.refreshed,
+        )
+
+
+def test_doctests():
+    import hq_superset.oauth
+    results = doctest.testmod(hq_superset.oauth)
+    assert results.failed == 0
@@ -0,0 +1,103 @@
+import doctest
+import io
+import zipfile
+
+import pandas
+import pytest
+
+from hq_superset.pipeline import (
+    MergeStage,
+    Stage,
+    StreamStage,
+    consume_in_parallel,
+)
+
+
+def test_stage_reraises_exceptions():
+
+    def failing():
+        yield 1
+        raise ValueError('bad chunk')
+
+    with Stage(failing()) as items:
+        with pytest.raises(ValueError, match='bad chunk'):
+            list(items)
+
+
+def test_stage_stops_when_consumer_stops():
+    consumed = []
+    with Stage(iter(range(1000)), maxsize=2) as items:
+        for item in items:
+            consumed.append(item)
+            if item == 3:
+                break
+    assert consumed == [0, 1, 2, 3]
+
+
+def test_merge_stage_reraises_exceptions():
+
+    def failing():
+        yield 1
+        raise ValueError('bad part')
+
+    with MergeStage([iter(range(100)), failing()], maxsize=2) as items:
+        with pytest.raises(ValueError, match='bad part'):
+            list(items)
+
+
+def test_stream_stage_read_csv():
+    csv = b'doc_id,number\n' + b''.join(
+        f'a{i},{i}\n'.encode() for i in range(100)
+    )
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('export.csv', csv)
+    with (
+        zipfile.ZipFile(archive) as zf,
+        zf.open('export.csv') as member,
+        StreamStage(member, block_size=16) as stream,
+    ):
+        chunks = pandas.read_csv(
+            io.BufferedReader(stream),
+            encoding='utf-8',
+            chunksize=30,
+        )
+        with Stage(chunks) as parsed:
+            df = pandas.concat(parsed)
+    assert list(df['doc_id']) == [f'a{i}' for i in range(100)]
+
+
+def test_consume_in_parallel_stops_on_failure():
+    consumed = []
+
+    def consume(item):
+        if item == 2:
+            raise ValueError('bad chunk')
+        consumed.append(item)
+
+    with pytest.raises(ValueError, match='bad chunk'):
+        consume_in_parallel(consume, iter(range(1000)), workers=2)
+    assert len(consumed) < 10
+
+
+def test_stage_closes_generator():
+    closed = []
+
+    def numbers():
+        try:
+            yield from range(1000)
+        finally:
+            closed.append(True)
+
+    with Stage(numbers(), maxsize=2) as items:
+        for item in items:
+            if item == 3:
+                break
+    assert closed == [True]
+
+
+def test_doctests():
+    import hq_superset.pipeline
+    results = doctest.testmod(hq_superset.pipeline)
+    assert results.failed == 0
+
@@ -0,0 +1,42 @@
+import doctest
+from unittest.mock import patch
+
+from hq_superset.tasks import (
+    import_hq_datasource_task,
+    refresh_hq_datasource_task,
+)
+
+from .base_test import HQDBTestCase
+
+
+class TestImportHQDatasourceTask(HQDBTestCase):
+
+    def test_import_not_in_queue(self):
+        # E.g. the task was delivered again after its import was run by
+        # another task
+        with (
+            patch("hq_superset.tasks.import_hq_datasource") as import_mock,
+            patch("hq_superset.tasks.dispatch_imports"),
+        ):
+            import_hq_datasource_task.apply(args=('test1', 'ucr1', None)).get()
+        import_mock.assert_not_called()
+
+
+class TestRefreshHQDatasourceTask(HQDBTestCase):
+
+    def test_export_removed(self):
+        with (
+            patch("hq_superset.tasks.refresh_hq_datasource") as refresh_mock,
+            patch("hq_superset.tasks.AsyncImportHelper") as helper_mock,
+        ):
+            refresh_hq_datasource_task.apply(args=(
+                'test1', 'ucr1', 'ds1', '/no/such/export.zip', {}, None,
+            )).get()
+        refresh_mock.assert_not_called()
+        helper_mock.return_value.mark_as_complete.assert_called_once()
+
+
+def test_doctests():
+    import hq_superset.tasks
+    results = doctest.testmod(hq_superset.tasks)
+    assert results.failed == 0
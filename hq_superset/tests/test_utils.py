@@ -1,6 +1,19 @@
 import doctest
+from zipfile import ZipFile
 
-from hq_superset.utils import get_column_dtypes
+import pandas
+
+from hq_superset.utils import (
+    ChunkSizer,
+    convert_to_array,
+    convert_to_arrays,
+    detect_export_format,
+    get_column_dtypes,
+    get_datasource_fingerprint,
+    get_index_columns,
+    parse_date,
+    parse_dates,
+)
 
 from .const import TEST_DATASOURCE
 
@@ -20,6 +33,139 @@ def test_get_column_dtypes():
     }
 
 
+def test_get_index_columns():
+    datasource_defn = {
+        'configured_indicators': [
+            {'column_id': 'owner_id', 'create_index': True},
+            {'column_id': 'name'},
+        ]
+    }
+    assert get_index_columns(datasource_defn) == (
+        ['doc_id', 'owner_id'],
+        ['inserted_at'],
+        [],
+    )
+
+
+def test_get_index_columns_with_doc_id_primary_key():
+    datasource_defn = {
+        'configured_indicators': [
+            {'column_id': 'doc_id', 'is_primary_key': True},
+            {'column_id': 'repeat_iteration', 'is_primary_key': True},
+            {'column_id': 'owner_id', 'create_index': True},
+        ]
+    }
+    assert get_index_columns(datasource_defn) == (
+        ['owner_id'],
+        ['inserted_at'],
+        ['doc_id', 'repeat_iteration'],
+    )
+
+
+def test_datasource_fingerprint(tmp_path):
+    def write_export(path, csv_data):
+        with ZipFile(path, 'w') as zipfile:
+            zipfile.writestr('export.csv', csv_data)
+        return path
+
+    export = write_export(tmp_path / 'a.zip', 'doc_id\na1\n')
+    same_export = write_export(tmp_path / 'b.zip', 'doc_id\na1\n')
+    new_export = write_export(tmp_path / 'c.zip', 'doc_id\na1\na2\n')
+    fingerprint = get_datasource_fingerprint(export, TEST_DATASOURCE)
+
+    assert get_datasource_fingerprint(same_export, TEST_DATASOURCE) == fingerprint
+    assert get_datasource_fingerprint(new_export, TEST_DATASOURCE) != fingerprint
+    new_defn = {**TEST_DATASOURCE, 'configured_indicators': []}
+    assert get_datasource_fingerprint(export, new_defn) != fingerprint
+    new_settings = {'partition_column': 'inserted_at'}
+    assert get_datasource_fingerprint(
+        export, TEST_DATASOURCE, new_settings
+    ) != fingerprint
+
+
+def test_detect_export_format(tmp_path):
+    csv_zip = tmp_path / 'export.parquet'
+    with ZipFile(csv_zip, 'w') as zipfile:
+        zipfile.writestr('export.csv', 'doc_id\na1\n')
+    assert detect_export_format(csv_zip) == 'csv'
+
+    parquet_zip = tmp_path / 'export.zip'
+    with ZipFile(parquet_zip, 'w') as zipfile:
+        zipfile.writestr('export.parquet', b'PAR1...')
+    assert detect_export_format(parquet_zip) == 'parquet'
+
+    arrow_file = tmp_path / 'export.arrow'
+    arrow_file.write_bytes(b'ARROW1\x00\x00...')
+    assert detect_export_format(arrow_file) == 'arrow'
+
+    unknown = tmp_path / 'export.csv'
+    unknown.write_bytes(b'doc_id\na1\n')
+    assert detect_export_format(unknown) is None
+
+
+def test_chunk_size_is_smaller_for_wide_datasources():
+    narrow = ChunkSizer(
+        {'doc_id': 'string'}, ['inserted_at'], [],
+        memory_budget=100_000_000, chunks_in_memory=5,
+    )
+    wide = ChunkSizer(
+        {f'col{i}': 'string' for i in range(500)}, ['inserted_at'], [],
+        memory_budget=100_000_000, chunks_in_memory=5,
+    )
+    assert narrow.chunk_size > wide.chunk_size
+    assert wide.chunk_size >= ChunkSizer.min_chunk_size
+
+
+def test_chunk_size_adjusts_to_measured_rows():
+    sizer = ChunkSizer(
+        {'doc_id': 'string'}, [], [],
+        memory_budget=10_000_000, chunks_in_memory=1,
+    )
+    large_rows = pandas.DataFrame({'doc_id': ['x' * 100_000] * 10})
+    chunk_size = sizer.chunk_size
+    for __ in range(10):
+        assert sizer.update(large_rows) <= chunk_size
+        chunk_size = sizer.chunk_size
+    assert chunk_size == ChunkSizer.min_chunk_size
+
+
+def test_parse_dates_matches_parse_date():
+    values = [
+        '2022-02-24 12:29:19.450137',
+        '2022-02-24 12:29:19',
+        '2022-02-22',
+        None,
+    ]
+    expected = pandas.to_datetime([parse_date(v) for v in values])
+    assert list(parse_dates(values)) == list(expected)
+
+
+def test_parse_dates_leaves_non_dates_unchanged():
+    values = ['2022-02-22', 'not a date', None]
+    assert list(parse_dates(values)) == [parse_date(v) for v in values]
+
+
+def test_convert_to_arrays_matches_convert_to_array():
+    values = [
+        "['hello', 'world']",
+        "['it\\'s', 'say \"hi\"']",
+        "'hello', 'world'",
+        "[None]",
+        "[1, 2]",
+        "hello, world",
+        "[]",
+    ]
+    assert convert_to_arrays(values).tolist() == [
+        convert_to_array(v) for v in values
+    ]
+
+
+def test_convert_to_arrays_keeps_index():
+    values = pandas.Series(["['a']", "['b']"], index=[10000, 10001])
+    arrays = convert_to_arrays(values)
+    assert arrays.to_dict() == {10000: ['a'], 10001: ['b']}
+
+
 def test_doctests():
     import hq_superset.utils
     results = doctest.testmod(hq_superset.utils)
@@ -1,13 +1,20 @@
+import io
 import json
 import os
 import pickle
+import tempfile
+import time
+import zipfile
+from datetime import datetime
 from io import StringIO
-from unittest.mock import patch
+from unittest.mock import ANY, Mock, patch
 
 import jwt
+import sqlalchemy
 from flask import redirect, session
 from sqlalchemy.sql import text
 
+from hq_superset.const import IMPORT_PRIORITY_HIGH, IMPORT_PRIORITY_LOW
 from hq_superset.utils import (
     SESSION_USER_DOMAINS_KEY,
     get_schema_name_for_domain,
@@ -21,6 +28,7 @@ class MockResponse:
     def __init__(self, json_data, status_code):
         self.json_data = json_data
         self.status_code = status_code
+        self.headers = {}
 
     def json(self):
         return self.json_data
@@ -29,6 +37,14 @@ class MockResponse:
     def content(self):
         return pickle.dumps(self.json_data)
 
+    def iter_content(self, chunk_size=1):
+        content = self.content
+        for i in range(0, len(content), chunk_size):
+            yield content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
 
 class UserMock():
     user_id = '123'
@@ -83,7 +99,7 @@ class OAuthMock():
     def authorize_access_token(self):
         return {"access_token": "some-key"}
 
-    def get(self, url, token):
+    def get(self, url, token, **kwargs):
         return {
             'api/v0.5/identity/': MockResponse(self.user_json, 200),
             'api/v0.5/user_domains?feature_flag=superset-analytics&can_view_reports=true': MockResponse(self.domain_json, 200),
@@ -108,6 +124,19 @@ a3, 2021-11-22, 2022-01-19, 10, 2022-03-20, some_other_text2
 """
 
 
+TEST_UCR_CSV_DELTA = """\
+doc_id,inserted_at,data_visit_date_eaece89e,data_visit_number_33d63739,data_lmp_date_5e24b993,data_visit_comment_fb984fda
+a2, 2021-12-23, 2022-02-19, 11, 2022-03-20, some_other_text
+a3, 2021-12-23, 2022-01-19, 10, 2022-03-20, some_other_text2
+"""
+
+TEST_UCR_CSV_MIGRATED = """\
+doc_id,inserted_at,data_visit_date_eaece89e,data_visit_number_33d63739,data_lmp_date_5e24b993,data_risk_score
+a1, 2021-12-20, 2022-01-19, 100, 2022-02-20, 5
+a2, 2021-12-22, 2022-02-19, 10, 2022-03-20,
+"""
+
+
 class TestViews(HQDBTestCase):
 
     def setUp(self):
@@ -228,9 +257,75 @@ class TestViews(HQDBTestCase):
             refresh_mock.assert_called_once_with(
                 'test1',
                 ucr_id,
-                'ds1'
+                'ds1',
+                False,
             )
 
+    @patch('hq_superset.views.get_valid_cchq_oauth_token', return_value={})
+    def test_datasource_bulk_import(self, *args):
+        from hq_superset.concurrency import (
+            finish_queued_import,
+            get_queued_imports,
+        )
+        from hq_superset.tasks import dispatch_imports
+
+        client = self.app.test_client()
+        self.login(client)
+        client.get('/domain/select/test1/', follow_redirects=True)
+        with (
+            patch("hq_superset.tasks.import_hq_datasource_task") as task_mock,
+            patch("hq_superset.tasks.AsyncImportHelper"),
+            patch("hq_superset.views.AsyncImportHelper") as helper_mock,
+            patch.dict(
+                self.app.config,
+                {'HQ_IMPORT_CONCURRENCY_PER_DOMAIN': 1},
+            ),
+        ):
+            task_mock.apply_async.return_value.task_id = 'task1'
+            # ucr2 is already being imported
+            helper_mock.return_value.is_import_in_progress.side_effect = [
+                False,
+                True,
+                False,
+            ]
+            response = client.post(
+                '/hq_datasource/import/',
+                json={'datasource_ids': ['ucr1', 'ucr2', 'ucr3', 'ucr1']},
+            )
+            self.assertEqual(response.json, {'queued': ['ucr1', 'ucr3']})
+            # The domain has one slot, so ucr3 waits
+            task_mock.apply_async.assert_called_once_with(
+                args=('test1', 'ucr1', ANY, False),
+                priority=IMPORT_PRIORITY_LOW,
+            )
+            self.assertEqual(
+                [(i.datasource_id, i.is_running) for i in get_queued_imports('test1')],
+                [('ucr1', True), ('ucr3', False)],
+            )
+
+            finish_queued_import('test1', 'ucr1')
+            dispatch_imports()
+            task_mock.apply_async.assert_called_with(
+                args=('test1', 'ucr3', ANY, False),
+                priority=IMPORT_PRIORITY_LOW,
+            )
+            finish_queued_import('test1', 'ucr3')
+
+    def test_datasource_bulk_import_bad_request(self):
+        client = self.app.test_client()
+        self.login(client)
+        client.get('/domain/select/test1/', follow_redirects=True)
+        with patch("hq_superset.views.queue_import_tasks") as queue_mock:
+            for kwargs in [
+                {'json': ['ucr1']},
+                {'json': {'datasource_ids': 'ucr1'}},
+                {'json': {'datasource_ids': [1]}},
+                {'data': 'not json', 'content_type': 'application/json'},
+            ]:
+                response = client.post('/hq_datasource/import/', **kwargs)
+                self.assertEqual(response.status_code, 400, kwargs)
+            queue_mock.assert_not_called()
+
     @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
     @patch('hq_superset.services.subscribe_to_hq_datasource')
     @patch('hq_superset.views.os.remove')
@@ -248,14 +343,16 @@ class TestViews(HQDBTestCase):
         def _test_sync_or_async(ds_size, routing_method, user_id):
 
             with (
-                patch("hq_superset.views.download_and_subscribe_to_datasource") as download_ds_mock,
+                patch("hq_superset.services.download_and_subscribe_to_datasource") as download_ds_mock,
                 patch("hq_superset.views.get_datasource_defn") as ds_defn_mock,
+                patch("hq_superset.services.get_datasource_fingerprint") as fingerprint_mock,
                 patch(routing_method) as refresh_mock,
                 patch("hq_superset.views.g") as mock_g
             ):
                 mock_g.user = UserMock()
                 download_ds_mock.return_value = file_path, ds_size
                 ds_defn_mock.return_value = TEST_DATASOURCE
+                fingerprint_mock.return_value = 'fingerprint'
                 trigger_datasource_refresh(domain, ucr_id, ds_name)
                 refresh_mock.assert_called_once_with(
                     domain,
@@ -263,7 +360,10 @@ class TestViews(HQDBTestCase):
                     ds_name,
                     file_path,
                     TEST_DATASOURCE,
-                    user_id
+                    user_id,
+                    False,
+                    'fingerprint',
+                    None,
                 )
 
         # When datasource size is more than the limit, it should get
@@ -281,9 +381,184 @@ class TestViews(HQDBTestCase):
             None
         )
 
+    @patch('hq_superset.views.get_valid_cchq_oauth_token', return_value={})
+    def test_trigger_datasource_refresh_async_downloads(self, *args):
+        from hq_superset.concurrency import finish_queued_import
+        from hq_superset.views import trigger_datasource_refresh
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        with (
+            patch.dict(self.app.config, {'HQ_ASYNC_DOWNLOADS': True}),
+            patch("hq_superset.views.get_datasource_defn") as ds_defn_mock,
+            patch("hq_superset.tasks.import_hq_datasource_task") as task_mock,
+            patch("hq_superset.tasks.AsyncImportHelper"),
+            patch("hq_superset.views.g") as mock_g,
+        ):
+            mock_g.user = UserMock()
+            task_mock.apply_async.return_value.task_id = 'task1'
+            trigger_datasource_refresh('test1', ucr_id, 'ds_name', True)
+            # Nothing is fetched from CommCare HQ in the web request
+            ds_defn_mock.assert_not_called()
+            # Incremental refreshes go ahead of full imports
+            task_mock.apply_async.assert_called_once_with(
+                args=('test1', ucr_id, ANY, True),
+                priority=IMPORT_PRIORITY_HIGH,
+            )
+            finish_queued_import('test1', ucr_id)
+
+    def test_import_hq_datasource_task(self):
+        from hq_superset.concurrency import get_queued_import, queue_import
+        from hq_superset.oauth import save_oauth_token
+        from hq_superset.tasks import import_hq_datasource_task
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        token = {
+            'access_token': 'queued-token',
+            'refresh_token': 'refresh',
+            'expires_at': int(time.time()) + 900,
+        }
+        subscription_urls = {
+            'webhook_url': 'https://superset.example.com/hq_webhook/change/',
+            'token_url': 'https://superset.example.com/oauth/token',
+        }
+        save_oauth_token(2, token)
+        queue_import('test1', ucr_id, 2, False, subscription_urls)
+        with (
+            patch.object(self.oauth_mock, 'get', wraps=self.oauth_mock.get) as get_mock,
+            patch.object(self.oauth_mock, 'post', create=True) as post_mock,
+            patch("hq_superset.services.get_datasource_fingerprint", return_value='fingerprint'),
+            patch("hq_superset.services.is_datasource_up_to_date", return_value=False),
+            patch("hq_superset.services.refresh_hq_datasource") as refresh_mock,
+            patch("hq_superset.tasks.dispatch_imports"),
+        ):
+            post_mock.return_value = MockResponse({}, 201)
+            # Runs the task body in this process. The session has no
+            # OAuth token, so requests must use the user's saved token.
+            import_hq_datasource_task.apply(args=('test1', ucr_id, 2)).get()
+
+            self.assertEqual(
+                [c.kwargs['token'] for c in get_mock.call_args_list],
+                [token, token],
+            )
+            post_mock.assert_called_once_with(
+                f'a/test1/configurable_reports/data_sources/subscribe/{ucr_id}/',
+                data=ANY,
+                token=token,
+            )
+            self.assertEqual(
+                post_mock.call_args.kwargs['data']['webhook_url'],
+                subscription_urls['webhook_url'],
+            )
+            refresh_mock.assert_called_once()
+        self.assertIsNone(get_queued_import('test1', ucr_id))
+
+    def test_trigger_datasource_refresh_already_queued(self):
+        from hq_superset.concurrency import finish_queued_import, queue_import
+        from hq_superset.views import trigger_datasource_refresh
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        queue_import('test1', ucr_id, None)
+        with (
+            patch("hq_superset.views.get_datasource_defn") as ds_defn_mock,
+            patch("hq_superset.views.flash") as flash_mock,
+        ):
+            trigger_datasource_refresh('test1', ucr_id, 'ds_name')
+            ds_defn_mock.assert_not_called()
+            self.assertIn(
+                "already being imported",
+                flash_mock.call_args.args[0],
+            )
+        finish_queued_import('test1', ucr_id)
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    @patch('hq_superset.views.os.remove')
+    def test_trigger_datasource_refresh_up_to_date(self, *args):
+        from hq_superset.views import trigger_datasource_refresh
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        with (
+            patch("hq_superset.views.get_datasource_defn") as ds_defn_mock,
+            patch("hq_superset.services.download_and_subscribe_to_datasource") as download_ds_mock,
+            patch("hq_superset.services.get_datasource_fingerprint") as fingerprint_mock,
+            patch("hq_superset.services.is_datasource_up_to_date") as up_to_date_mock,
+            patch("hq_superset.views.refresh_hq_datasource") as refresh_mock,
+            patch("hq_superset.views.flash") as flash_mock,
+        ):
+            ds_defn_mock.return_value = TEST_DATASOURCE
+            download_ds_mock.return_value = '/file_path', 1
+            fingerprint_mock.return_value = 'fingerprint'
+            up_to_date_mock.return_value = True
+            trigger_datasource_refresh('test1', ucr_id, 'ds_name')
+            up_to_date_mock.assert_called_once_with(
+                'test1', ucr_id, 'fingerprint'
+            )
+            refresh_mock.assert_not_called()
+            self.assertIn("already up to date", flash_mock.call_args.args[0])
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    @patch('hq_superset.views.os.remove')
+    def test_trigger_incremental_datasource_refresh(self, *args):
+        from hq_superset.services import DatasourceMigration
+        from hq_superset.views import trigger_datasource_refresh
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        since = datetime(2021, 12, 22)
+        with (
+            patch("hq_superset.views.get_datasource_defn") as ds_defn_mock,
+            patch("hq_superset.services.get_incremental_refresh_start") as start_mock,
+            patch("hq_superset.services.get_datasource_migration") as migration_mock,
+            patch("hq_superset.services.migrate_datasource_table") as migrate_mock,
+            patch("hq_superset.services.download_and_subscribe_to_datasource") as download_ds_mock,
+            patch("hq_superset.views.refresh_hq_datasource") as refresh_mock,
+            patch("hq_superset.views.queue_refresh_task") as queue_mock,
+        ):
+            ds_defn_mock.return_value = TEST_DATASOURCE
+            download_ds_mock.return_value = '/file_path', 1
+            migration_mock.return_value = DatasourceMigration({}, [], {}, [])
+
+            start_mock.return_value = since
+            trigger_datasource_refresh('test1', ucr_id, 'ds_name', True)
+            download_ds_mock.assert_called_with('test1', ucr_id, since=since)
+            self.assertTrue(refresh_mock.call_args.args[6])
+
+            # Falls back to a full refresh if the table can't be updated
+            start_mock.return_value = None
+            with (
+                patch(
+                    "hq_superset.services.get_datasource_fingerprint",
+                    return_value='fingerprint',
+                ),
+                patch(
+                    "hq_superset.services.is_datasource_up_to_date",
+                    return_value=False,
+                ),
+            ):
+                trigger_datasource_refresh('test1', ucr_id, 'ds_name', True)
+            download_ds_mock.assert_called_with('test1', ucr_id, since=None)
+            self.assertFalse(refresh_mock.call_args.args[6])
+
+            # New columns are loaded from a full export, in the
+            # background, where the table is migrated
+            start_mock.reset_mock()
+            refresh_mock.reset_mock()
+            migration_mock.return_value = DatasourceMigration(
+                {'data_risk_score': 'INTEGER'}, [], {}, [],
+            )
+            trigger_datasource_refresh('test1', ucr_id, 'ds_name', True)
+            start_mock.assert_not_called()
+            download_ds_mock.assert_called_with('test1', ucr_id, since=None)
+            refresh_mock.assert_not_called()
+            self.assertFalse(queue_mock.call_args.args[6])
+            self.assertEqual(
+                queue_mock.call_args.args[8],
+                ['data_risk_score'],
+            )
+            migrate_mock.assert_not_called()
+
     @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
     @patch('hq_superset.services.subscribe_to_hq_datasource')
     @patch('hq_superset.hq_requests.HQRequest.get')
+    @patch('hq_superset.services.DOWNLOAD_CHUNK_SIZE', 16)
     def test_download_datasource(self, hq_request_get_mock, subscribe_mock, *args):
         from hq_superset.services import download_and_subscribe_to_datasource
 
@@ -293,15 +568,114 @@ class TestViews(HQDBTestCase):
         )
         ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
         path, size = download_and_subscribe_to_datasource('test1', ucr_id)
+        hq_request_get_mock.assert_called_once_with(stream=True)
         subscribe_mock.assert_called_once_with(
             'test1',
             ucr_id,
+            token=None,
+            subscription_urls=None,
         )
         with open(path, 'rb') as f:
             self.assertEqual(pickle.load(f), TEST_UCR_CSV_V1)
             self.assertEqual(size, len(pickle.dumps(TEST_UCR_CSV_V1)))
         os.remove(path)
 
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    @patch('hq_superset.services.subscribe_to_hq_datasource')
+    @patch('hq_superset.services.arrow.is_pyarrow_available', return_value=True)
+    @patch('hq_superset.services.EXPORT_FORMATS', ['parquet', 'csv'])
+    def test_download_datasource_falls_back_to_csv(self, *args):
+        from hq_superset.services import download_and_subscribe_to_datasource
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        # CommCare HQ does not offer Parquet exports
+        self.oauth_mock.get = lambda url, token, **kwargs: (
+            MockResponse(TEST_UCR_CSV_V1, 200) if url.endswith('format=csv')
+            else MockResponse({'error': 'Unsupported format'}, 400)
+        )
+        path, size = download_and_subscribe_to_datasource('test1', ucr_id)
+        self.assertTrue(path.endswith('.zip'))
+        os.remove(path)
+
+    def test_remove_stale_exports(self):
+        import superset
+
+        from hq_superset.concurrency import (
+            finish_queued_import,
+            import_slot,
+            queue_import,
+        )
+        from hq_superset.services import (
+            STALE_EXPORT_AGE,
+            remove_stale_exports,
+        )
+
+        queue_import('test1', 'queued', None)
+        with self.hq_db.get_sqla_engine_with_context() as engine:
+            with engine.begin() as connection:
+                connection.execute(text('CREATE SCHEMA hqdomain_test1'))
+                for table_name in [
+                    'stale_staging',
+                    'stale_checkpoints',
+                    'queued_staging',
+                    'running_checkpoints',
+                ]:
+                    connection.execute(text(
+                        f'CREATE TABLE hqdomain_test1.{table_name} (id INT)'
+                    ))
+        with tempfile.TemporaryDirectory() as shared_dir:
+            stale_time = time.time() - STALE_EXPORT_AGE - 1
+            filenames = [
+                'stale.zip',
+                'stale.zip.part',
+                'queued.zip',
+                'running.parquet',
+            ]
+            for filename in [*filenames, 'current.zip']:
+                with open(os.path.join(shared_dir, filename), 'wb'):
+                    pass
+            os.mkdir(os.path.join(shared_dir, 'stale.zip.tmp1234'))
+            for filename in [*filenames, 'stale.zip.tmp1234']:
+                path = os.path.join(shared_dir, filename)
+                os.utime(path, (stale_time, stale_time))
+            with (
+                patch.object(superset.config, 'SHARED_DIR', shared_dir),
+                import_slot('test1', 'running'),
+            ):
+                remove_stale_exports()
+            self.assertEqual(
+                sorted(os.listdir(shared_dir)),
+                ['current.zip', 'queued.zip', 'running.parquet'],
+            )
+        finish_queued_import('test1', 'queued')
+        with self.hq_db.get_sqla_engine_with_context() as engine:
+            self.assertEqual(
+                sorted(sqlalchemy.inspect(engine).get_table_names(
+                    schema='hqdomain_test1',
+                )),
+                ['queued_staging', 'running_checkpoints'],
+            )
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    @patch('hq_superset.services.subscribe_to_hq_datasource')
+    @patch('hq_superset.services.arrow.is_pyarrow_available', return_value=True)
+    @patch('hq_superset.services.EXPORT_FORMATS', ['parquet', 'csv'])
+    def test_download_datasource_format_not_requested(self, *args):
+        from hq_superset.services import download_and_subscribe_to_datasource
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        # CommCare HQ ignores "format=parquet", and sends a zipped CSV
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as zip_file:
+            zip_file.writestr('export.csv', TEST_UCR_CSV_V1)
+        self.oauth_mock.get = lambda url, token, **kwargs: (
+            MockResponse(None, 200)
+        )
+        with patch.object(MockResponse, 'content', buffer.getvalue()):
+            path, size = download_and_subscribe_to_datasource('test1', ucr_id)
+        self.assertTrue(path.endswith(f'{ucr_id}.zip'))
+        os.remove(path)
+
     @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
     def test_refresh_hq_datasource(self, *args):
         from hq_superset.services import refresh_hq_datasource
@@ -332,6 +706,11 @@ class TestViews(HQDBTestCase):
                             result,
                             expected_output
                         )
+                        # The staging table has replaced the live table
+                        staging_table = connection.execute(text(
+                            "SELECT to_regclass('hqdomain_test1.test1_ucr1_staging')"
+                        )).scalar()
+                        self.assertIsNone(staging_table)
                 # Check that updated dataset is reflected in the list view
                 client.get('/hq_datasource/list/', follow_redirects=True)
                 self.assert_context('ucr_id_to_pks', {'test1_ucr1': 1})
@@ -352,3 +731,333 @@ class TestViews(HQDBTestCase):
             self.assertEqual(response.status, "302 FOUND")
             client.get('/hq_datasource/list/', follow_redirects=True)
             self.assert_context('ucr_id_to_pks', {})
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    def test_refresh_hq_datasource_no_rows(self, *args):
+        from hq_superset import arrow
+        from hq_superset.services import refresh_hq_datasource
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        header = TEST_UCR_CSV_V1.splitlines(keepends=True)[0]
+        csv_engines = ['pandas']
+        if arrow.is_pyarrow_available():
+            # PyArrow yields no chunks at all for a file without rows
+            csv_engines.append('pyarrow')
+        with (
+            patch("hq_superset.services.get_datasource_file") as csv_mock,
+            self.app.test_client() as client
+        ):
+            self.login(client)
+            client.get('/domain/select/test1/', follow_redirects=True)
+            for csv_engine in csv_engines:
+                with patch.dict(
+                    self.app.config,
+                    {'HQ_IMPORT_CSV_ENGINE': csv_engine},
+                ):
+                    csv_mock.return_value = io.BytesIO(header.encode('utf-8'))
+                    refresh_hq_datasource(
+                        'test1', ucr_id, 'ds1', '_', TEST_DATASOURCE
+                    )
+                with self.hq_db.get_sqla_engine_with_context() as engine:
+                    with engine.connect() as connection:
+                        result = connection.execute(text(
+                            'SELECT * FROM hqdomain_test1.test1_ucr1'
+                        ))
+                        self.assertEqual(result.fetchall(), [])
+                        self.assertEqual(
+                            list(result.keys()),
+                            header.strip().split(','),
+                        )
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    def test_refresh_hq_datasource_sends_metrics(self, *args):
+        from hq_superset.services import refresh_hq_datasource
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        sink = Mock()
+        with (
+            patch("hq_superset.services.get_datasource_file") as csv_mock,
+            patch.dict(self.app.config, {'HQ_IMPORT_METRICS_SINK': sink}),
+            self.app.test_client() as client
+        ):
+            self.login(client)
+            client.get('/domain/select/test1/', follow_redirects=True)
+            csv_mock.return_value = StringIO(TEST_UCR_CSV_V1)
+            refresh_hq_datasource('test1', ucr_id, 'ds1', '_', TEST_DATASOURCE)
+        # The import ran to the end
+        stage, metrics, tags = sink.send.call_args.args
+        self.assertEqual(stage, 'import')
+        self.assertEqual(metrics['rows'], 2)
+        self.assertEqual(tags, {'domain': 'test1', 'datasource_id': ucr_id})
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    @patch('hq_superset.services.IMPORT_UNLOGGED_STAGING', True)
+    def test_refresh_hq_datasource_unlogged_staging(self, *args):
+        from hq_superset.services import refresh_hq_datasource
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        with (
+            patch("hq_superset.services.get_datasource_file") as csv_mock,
+            self.app.test_client() as client
+        ):
+            self.login(client)
+            client.get('/domain/select/test1/', follow_redirects=True)
+            csv_mock.return_value = StringIO(TEST_UCR_CSV_V1)
+            refresh_hq_datasource('test1', ucr_id, 'ds1', '_', TEST_DATASOURCE)
+            with self.hq_db.get_sqla_engine_with_context() as engine:
+                with engine.connect() as connection:
+                    persistence = connection.execute(text(
+                        "SELECT relpersistence FROM pg_class "
+                        "WHERE oid = 'hqdomain_test1.test1_ucr1'::regclass"
+                    )).scalar()
+            # The table was switched to a regular, logged table
+            self.assertEqual(persistence, 'p')
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    def test_refresh_hq_datasource_partitioned(self, *args):
+        from hq_superset.services import refresh_hq_datasource
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        with (
+            patch("hq_superset.services.get_datasource_file") as csv_mock,
+            patch.dict(
+                self.app.config,
+                {'HQ_PARTITIONED_DATASOURCES': {ucr_id: 'inserted_at'}},
+            ),
+            self.app.test_client() as client
+        ):
+            self.login(client)
+            client.get('/domain/select/test1/', follow_redirects=True)
+            csv_mock.return_value = StringIO(TEST_UCR_CSV_V1)
+            refresh_hq_datasource('test1', ucr_id, 'ds1', '_', TEST_DATASOURCE)
+            # Refreshing again replaces the partitions
+            csv_mock.return_value = StringIO(TEST_UCR_CSV_V2)
+            refresh_hq_datasource('test1', ucr_id, 'ds1', '_', TEST_DATASOURCE)
+            with self.hq_db.get_sqla_engine_with_context() as engine:
+                with engine.connect() as connection:
+                    partitions = connection.execute(text(
+                        "SELECT DISTINCT tableoid::regclass::text "
+                        "FROM hqdomain_test1.test1_ucr1"
+                    )).scalars().all()
+            self.assertTrue(partitions)
+            for partition in partitions:
+                self.assertTrue(
+                    partition.startswith('hqdomain_test1.test1_ucr1_p')
+                )
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    def test_resume_refresh_hq_datasource(self, *args):
+        from hq_superset.services import refresh_hq_datasource
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        with (
+            patch("hq_superset.services.get_datasource_file") as csv_mock,
+            self.app.test_client() as client
+        ):
+            self.login(client)
+            client.get('/domain/select/test1/', follow_redirects=True)
+            csv_mock.return_value = StringIO(TEST_UCR_CSV_V1)
+            refresh_hq_datasource('test1', ucr_id, 'ds1', '_', TEST_DATASOURCE)
+
+            # An import of the export with fingerprint "fingerprint" was
+            # interrupted after loading its first row
+            with self.hq_db.get_sqla_engine_with_context() as engine:
+                with engine.begin() as connection:
+                    connection.execute(text(
+                        'CREATE TABLE hqdomain_test1.test1_ucr1_staging AS '
+                        'SELECT * FROM hqdomain_test1.test1_ucr1 '
+                        "WHERE doc_id = 'a1'"
+                    ))
+                    connection.execute(text(
+                        'UPDATE hqdomain_test1.test1_ucr1_staging '
+                        'SET data_visit_number_33d63739 = 999'
+                    ))
+                    connection.execute(text(
+                        'CREATE TABLE hqdomain_test1.test1_ucr1_checkpoints ('
+                        'export_file TEXT, start_row BIGINT, end_row BIGINT)'
+                    ))
+                    connection.execute(text(
+                        'INSERT INTO hqdomain_test1.test1_ucr1_checkpoints '
+                        "VALUES ('fingerprint', 0, 1)"
+                    ))
+
+            # The retried import downloaded the same export again
+            csv_mock.return_value = StringIO(TEST_UCR_CSV_V1)
+            refresh_hq_datasource(
+                'test1',
+                ucr_id,
+                'ds1',
+                'redownloaded',
+                TEST_DATASOURCE,
+                fingerprint='fingerprint',
+            )
+            with self.hq_db.get_sqla_engine_with_context() as engine:
+                with engine.connect() as connection:
+                    result = connection.execute(text(
+                        'SELECT doc_id, data_visit_number_33d63739 '
+                        'FROM hqdomain_test1.test1_ucr1 ORDER BY doc_id'
+                    )).fetchall()
+                    checkpoint_table = connection.execute(text(
+                        "SELECT to_regclass('hqdomain_test1.test1_ucr1_checkpoints')"
+                    )).scalar()
+            # The first row was not loaded again
+            self.assertEqual(result, [('a1', 999), ('a2', 10)])
+            self.assertIsNone(checkpoint_table)
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    def test_refresh_hq_datasource_multiple_files(self, *args):
+        from hq_superset.services import refresh_hq_datasource
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        header, *rows = TEST_UCR_CSV_V2.splitlines(keepends=True)
+        with (
+            tempfile.TemporaryDirectory() as tempdir,
+            patch.dict(self.app.config, {'HQ_IMPORT_PARSERS': 2}),
+            self.app.test_client() as client
+        ):
+            self.login(client)
+            client.get('/domain/select/test1/', follow_redirects=True)
+            # An export split into three CSV files, each with a header
+            export_path = os.path.join(tempdir, 'export.zip')
+            with zipfile.ZipFile(export_path, 'w') as archive:
+                for i, row in enumerate(rows):
+                    archive.writestr(f'part{i}.csv', header + row)
+            refresh_hq_datasource('test1', ucr_id, 'ds1', export_path, TEST_DATASOURCE)
+            with self.hq_db.get_sqla_engine_with_context() as engine:
+                with engine.connect() as connection:
+                    result = connection.execute(text(
+                        'SELECT doc_id FROM hqdomain_test1.test1_ucr1 '
+                        'ORDER BY doc_id'
+                    )).fetchall()
+            self.assertEqual(result, [('a1', ), ('a2', ), ('a3', )])
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    def test_incremental_refresh_hq_datasource(self, *args):
+        from hq_superset.services import (
+            get_incremental_refresh_start,
+            is_datasource_up_to_date,
+            refresh_hq_datasource,
+        )
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        with (
+            patch("hq_superset.services.get_datasource_file") as csv_mock,
+            self.app.test_client() as client
+        ):
+            self.login(client)
+            client.get('/domain/select/test1/', follow_redirects=True)
+            self.assertIsNone(
+                get_incremental_refresh_start('test1', ucr_id, TEST_DATASOURCE)
+            )
+
+            csv_mock.return_value = StringIO(TEST_UCR_CSV_V1)
+            refresh_hq_datasource(
+                'test1', ucr_id, 'ds1', '_', TEST_DATASOURCE,
+                fingerprint='fingerprint',
+            )
+            self.assertEqual(
+                get_incremental_refresh_start('test1', ucr_id, TEST_DATASOURCE),
+                datetime(2021, 12, 22),
+            )
+            self.assertTrue(
+                is_datasource_up_to_date('test1', ucr_id, 'fingerprint')
+            )
+
+            csv_mock.return_value = StringIO(TEST_UCR_CSV_DELTA)
+            refresh_hq_datasource(
+                'test1', ucr_id, 'ds1', '_', TEST_DATASOURCE,
+                incremental=True,
+            )
+            self.assertFalse(
+                is_datasource_up_to_date('test1', ucr_id, 'fingerprint')
+            )
+            with self.hq_db.get_sqla_engine_with_context() as engine:
+                with engine.connect() as connection:
+                    result = connection.execute(text(
+                        'SELECT doc_id, data_visit_number_33d63739 '
+                        'FROM hqdomain_test1.test1_ucr1 ORDER BY doc_id'
+                    )).fetchall()
+            self.assertEqual(result, [('a1', 100), ('a2', 11), ('a3', 10)])
+
+    @patch('hq_superset.hq_requests.get_valid_cchq_oauth_token', return_value={})
+    def test_migrate_hq_datasource(self, *args):
+        from hq_superset.services import (
+            get_datasource_migration,
+            get_incremental_refresh_start,
+            migrate_datasource_table,
+            refresh_hq_datasource,
+        )
+
+        ucr_id = self.oauth_mock.test1_datasources['objects'][0]['id']
+        indicators = TEST_DATASOURCE['configured_indicators']
+        new_defn = {
+            **TEST_DATASOURCE,
+            'configured_indicators': [
+                # Drops data_visit_comment_fb984fda
+                *indicators[:-1],
+                {
+                    **indicators[-1],
+                    'column_id': 'data_risk_score',
+                    'datatype': 'integer',
+                },
+            ],
+        }
+        with (
+            patch("hq_superset.services.get_datasource_file") as csv_mock,
+            self.app.test_client() as client
+        ):
+            self.login(client)
+            client.get('/domain/select/test1/', follow_redirects=True)
+            self.assertIsNone(
+                migrate_datasource_table('test1', ucr_id, new_defn)
+            )
+
+            csv_mock.return_value = StringIO(TEST_UCR_CSV_V1)
+            refresh_hq_datasource('test1', ucr_id, 'ds1', '_', TEST_DATASOURCE)
+            self.assertEqual(
+                migrate_datasource_table('test1', ucr_id, TEST_DATASOURCE),
+                [],
+            )
+            # Checking does not alter the table
+            for __ in range(2):
+                migration = get_datasource_migration('test1', ucr_id, new_defn)
+                self.assertEqual(
+                    migration.backfill_columns,
+                    ['data_risk_score'],
+                )
+                self.assertEqual(
+                    migration.drop_columns,
+                    ['data_visit_comment_fb984fda'],
+                )
+            backfill_columns = migrate_datasource_table(
+                'test1', ucr_id, new_defn
+            )
+            self.assertEqual(backfill_columns, ['data_risk_score'])
+            # The backfill has not run, so it is still needed
+            self.assertEqual(
+                migrate_datasource_table('test1', ucr_id, new_defn),
+                ['data_risk_score'],
+            )
+
+            csv_mock.return_value = StringIO(TEST_UCR_CSV_MIGRATED)
+            refresh_hq_datasource(
+                'test1', ucr_id, 'ds1', '_', new_defn,
+                backfill_columns=backfill_columns,
+            )
+            self.assertEqual(
+                migrate_datasource_table('test1', ucr_id, new_defn),
+                [],
+            )
+            with self.hq_db.get_sqla_engine_with_context() as engine:
+                with engine.connect() as connection:
+                    result = connection.execute(text(
+                        'SELECT doc_id, data_visit_number_33d63739, '
+                        'data_risk_score '
+                        'FROM hqdomain_test1.test1_ucr1 ORDER BY doc_id'
+                    )).fetchall()
+            self.assertEqual(result, [('a1', 100, 5), ('a2', 10, None)])
+            # Incremental refreshes continue from the existing rows
+            self.assertEqual(
+                get_incremental_refresh_start('test1', ucr_id, new_defn),
+                datetime(2021, 12, 22),
+            )
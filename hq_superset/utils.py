@@ -1,13 +1,20 @@
 import ast
+import hashlib
+import io
+import json
+import os
+import re
 import secrets
 import string
 import sys
+import tempfile
 from contextlib import contextmanager
 from datetime import date, datetime
 from functools import partial
 from typing import Any, Generator
-from zipfile import ZipFile
+from zipfile import ZipFile, is_zipfile
 
+import numpy
 import pandas
 import sqlalchemy
 from cryptography.fernet import Fernet
@@ -18,11 +25,31 @@ from superset.utils.database import get_or_create_db
 
 from .const import HQ_DATABASE_NAME
 from .exceptions import DatabaseMissing
+from .pipeline import READ_BLOCK_SIZE, StreamStage
 
 DOMAIN_PREFIX = "hqdomain_"
 SESSION_USER_DOMAINS_KEY = "user_hq_domains"
 SESSION_OAUTH_RESPONSE_KEY = "oauth_response"
 
+# Formats of UCR exports that are read with PyArrow instead of being
+# parsed as CSV
+COLUMNAR_EXPORT_FORMATS = ('parquet', 'arrow')
+# The first bytes of columnar exports, by format
+EXPORT_MAGIC_BYTES = (
+    (b'PAR1', 'parquet'),
+    (b'ARROW1', 'arrow'),
+    # The Arrow IPC streaming format starts with a continuation marker
+    (b'\xff\xff\xff\xff', 'arrow'),
+)
+
+# Matches lists of strings that contain no quotes or backslashes, e.g.
+# "['a', 'b']", which is how CommCare HQ exports most array values
+_QUOTED_STRING = r"'[^'\\]*'"
+SIMPLE_STRING_LIST_RE = re.compile(
+    rf"\s*\[\s*(?:{_QUOTED_STRING}(?:\s*,\s*{_QUOTED_STRING})*\s*,?)?\s*\]\s*"
+)
+QUOTED_STRING_RE = re.compile(r"'([^'\\]*)'")
+
 
 def get_hq_database():
     """
@@ -84,13 +111,107 @@ def get_column_dtypes(datasource_defn):
             array_type_columns.append(ind['column_id'])
         elif pandas_dtypes[indicator_datatype] == 'datetime64[ns]':
             # the dtype datetime64[ns] is not supported for parsing,
-            # pass this column using parse_dates instead
+            # parse this column with parse_dates() instead
             date_columns.append(ind['column_id'])
         else:
             column_dtypes[ind['column_id']] = pandas_dtypes[indicator_datatype]
     return column_dtypes, date_columns, array_type_columns
 
 
+def get_index_columns(datasource_defn):
+    """
+    Returns the columns of a UCR data source that should get a btree
+    index, the columns that should get a BRIN index, and the columns of
+    its primary key, if it has one.
+
+    ``doc_id`` is always indexed, because ``DataSetChange`` deletes rows
+    by ``doc_id``. ``inserted_at`` gets a BRIN index, which is small
+    because rows are imported roughly in the order they were inserted.
+    """
+    index_columns = ['doc_id']
+    primary_key_columns = []
+    for ind in datasource_defn['configured_indicators']:
+        if ind.get('is_primary_key'):
+            primary_key_columns.append(ind['column_id'])
+        elif ind.get('create_index') and ind['column_id'] not in index_columns:
+            index_columns.append(ind['column_id'])
+    if primary_key_columns[:1] == ['doc_id']:
+        # The primary key's index can be used instead
+        index_columns.remove('doc_id')
+    brin_columns = ['inserted_at']
+    return index_columns, brin_columns, primary_key_columns
+
+
+class ChunkSizer:
+    """
+    Works out how many rows of a UCR export to read at a time, so that
+    the chunks of the export that are in memory at the same time fit
+    within ``memory_budget`` bytes.
+
+    The initial chunk size is estimated from the data types of the
+    columns. After that, the chunk size is adjusted using the measured
+    size of each chunk.
+
+    >>> sizer = ChunkSizer({'doc_id': 'string', 'count': 'Int64'}, [], [],
+    ...                    memory_budget=1_090_000, chunks_in_memory=1)
+    >>> sizer.chunk_size
+    10000
+    >>> df = pandas.DataFrame({'count': pandas.array(range(100), 'Int64')})
+    >>> sizer.update(df)  # Rows are smaller than estimated
+    65555
+
+    """
+    # Estimated bytes per value in memory, including the overhead of
+    # Python objects for strings
+    bytes_per_value = {
+        'string': 100,
+        'Int64': 9,
+        'Float64': 9,
+        'Int8': 2,
+        'date': 70,  # Before parsing, dates are strings
+        'array': 150,
+    }
+    min_chunk_size = 1_000
+    max_chunk_size = 1_000_000
+
+    def __init__(
+        self,
+        column_dtypes,
+        date_columns,
+        array_columns,
+        memory_budget,
+        chunks_in_memory,
+    ):
+        row_size = (
+            sum(self.bytes_per_value.get(t, 100) for t in column_dtypes.values())
+            + self.bytes_per_value['date'] * len(date_columns)
+            + self.bytes_per_value['array'] * len(array_columns)
+        )
+        self.chunk_memory_budget = memory_budget // chunks_in_memory
+        self.chunk_size = self._bounded(self.chunk_memory_budget // row_size)
+
+    def update(self, df):
+        """
+        Returns the chunk size to use next, given the size of ``df``,
+        the chunk that was just read.
+        """
+        if len(df):
+            row_size = df.memory_usage(deep=True, index=False).sum() / len(df)
+            measured_chunk_size = self.chunk_memory_budget // max(row_size, 1)
+            # Move halfway to the measured size to smooth out chunks of
+            # unusually long or short rows
+            self.chunk_size = self._bounded(
+                (self.chunk_size + measured_chunk_size) // 2
+            )
+        return self.chunk_size
+
+    def _bounded(self, chunk_size):
+        return int(max(
+            self.min_chunk_size,
+            min(chunk_size, self.max_chunk_size),
+        ))
+
+
 def parse_date(date_str):
     """
     Simple, fast date parser for dates formatted by CommCare HQ.
@@ -115,6 +236,52 @@ def parse_date(date_str):
         return date_str
 
 
+def parse_dates(values):
+    """
+    Vectorized version of ``parse_date()`` for a column of dates
+    formatted by CommCare HQ.
+
+    Returns a ``datetime64[ns]`` Series if every value is a date, a
+    datetime, or missing. Otherwise, like ``parse_date()``, values that
+    are not dates are left unchanged.
+
+    >>> parse_dates(['2022-02-24 12:29:19.450137', '2022-02-22', None])
+    0   2022-02-24 12:29:19.450137
+    1   2022-02-22 00:00:00.000000
+    2                          NaT
+    dtype: datetime64[ns]
+    >>> parse_dates(['2022-02-22', 'not a date']).tolist()
+    [datetime.date(2022, 2, 22), 'not a date']
+
+    """
+    strings = pandas.Series(values).astype('string')
+    parsed = pandas.to_datetime(strings, format='ISO8601', errors='coerce')
+    if parsed.dtype == 'datetime64[ns]':
+        unparsed = parsed.isna() & strings.notna()
+        if not unparsed.any():
+            return parsed
+
+    # Some values are not dates, or have time zones. Parse them one by
+    # one, and leave the column as objects unless they all turned out
+    # to be dates.
+    result = strings.astype(object).map(parse_date)
+    return pandas.to_datetime(result, errors='ignore')
+
+
+def parse_date_columns(df, date_columns):
+    """
+    Parses the values of ``date_columns`` in ``df`` as dates, unless
+    they have already been parsed.
+    """
+    for column in date_columns:
+        if (
+            column in df.columns
+            and not pandas.api.types.is_datetime64_dtype(df[column])
+        ):
+            df[column] = parse_dates(df[column])
+    return df
+
+
 class DomainSyncUtil:
 
     def __init__(self, security_manager):
@@ -165,10 +332,138 @@ class DomainSyncUtil:
 
 
 @contextmanager
-def get_datasource_file(path):
+def get_datasource_file(path, filename=None):
+    """
+    Yields a binary stream of the CSV file ``filename``, or of the first
+    file, in the zip archive at ``path``. The file is decompressed in a
+    background thread while the stream is being read.
+    """
+    with ZipFile(path) as zipfile:
+        if filename is None:
+            filename = zipfile.namelist()[0]
+        with (
+            zipfile.open(filename) as member,
+            StreamStage(member, name=f"unzip {filename}") as stream,
+        ):
+            yield io.BufferedReader(stream)
+
+
+def get_datasource_parts(path):
+    """
+    Returns the names of the files in the zip archive at ``path``, in
+    the order they were archived. Large exports can be split into
+    several CSV files ("parts"), each with its own header row, which are
+    parsed in parallel. Returns an empty list if ``path`` is not a zip
+    archive.
+    """
+    if not is_zipfile(path):
+        return []
     with ZipFile(path) as zipfile:
+        return [
+            info.filename for info in zipfile.infolist()
+            if not info.is_dir()
+        ]
+
+
+def get_export_format(path):
+    """
+    Returns the format of the UCR export at ``path``: "csv" (a zipped
+    CSV file), "parquet" or "arrow" (Arrow IPC). The format is given by
+    the file extension that the export was downloaded with.
+
+    >>> get_export_format('/shared/ucr1_2024-01-01.parquet')
+    'parquet'
+    >>> get_export_format('/shared/ucr1_2024-01-01.zip')
+    'csv'
+
+    """
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    return extension if extension in COLUMNAR_EXPORT_FORMATS else 'csv'
+
+
+def detect_export_format(path):
+    """
+    Returns the format of the UCR export at ``path`` from its contents,
+    whatever format was requested: "parquet", "arrow", or "csv" for a
+    zip archive of CSV files. A zipped columnar file is detected by the
+    first bytes of the file in the archive. Returns None if the format
+    is not recognised.
+    """
+    if is_zipfile(path):
+        with ZipFile(path) as zipfile:
+            names = zipfile.namelist()
+            if not names:
+                return 'csv'
+            with zipfile.open(names[0]) as member:
+                magic = member.read(8)
+        return _get_magic_bytes_format(magic) or 'csv'
+    with open(path, 'rb') as f:
+        return _get_magic_bytes_format(f.read(8))
+
+
+def _get_magic_bytes_format(magic):
+    for prefix, export_format in EXPORT_MAGIC_BYTES:
+        if magic.startswith(prefix):
+            return export_format
+    return None
+
+
+@contextmanager
+def get_columnar_file(path):
+    """
+    Yields the path of a Parquet or Arrow IPC export. If the export is
+    zipped, its first file is extracted to a temporary file, because
+    columnar files are read out of order.
+    """
+    if not is_zipfile(path):
+        yield path
+        return
+    with (
+        ZipFile(path) as zipfile,
+        # Named after the export, so that ``remove_stale_exports()``
+        # can tell which import it belongs to
+        tempfile.TemporaryDirectory(
+            prefix=f'{os.path.basename(path)}.',
+            dir=os.path.dirname(path),
+        ) as tempdir,
+    ):
         filename = zipfile.namelist()[0]
-        yield zipfile.open(filename)
+        yield zipfile.extract(filename, path=tempdir)
+
+
+def get_datasource_fingerprint(path, datasource_defn, settings=None):
+    """
+    Returns a hash of the contents of the UCR export at ``path``, of its
+    data source definition, and of ``settings``, the import settings
+    that change the table it is imported into. If they are all unchanged
+    since the last import, the data source does not need to be imported
+    again.
+
+    The files in a zip archive are identified by their names, CRC-32
+    checksums and sizes, which are read from the archive's central
+    directory without decompressing the files. The archive itself is
+    not hashed, because it includes the time it was created.
+    """
+    fingerprint = hashlib.sha256()
+    fingerprint.update(
+        json.dumps(
+            {'definition': datasource_defn, 'settings': settings},
+            sort_keys=True,
+        ).encode('utf-8')
+    )
+    if not is_zipfile(path):
+        with open(path, 'rb') as f:
+            for block in iter(partial(f.read, READ_BLOCK_SIZE), b''):
+                fingerprint.update(block)
+        return fingerprint.hexdigest()
+
+    with ZipFile(path) as zipfile:
+        for info in zipfile.infolist():
+            fingerprint.update(
+                f'{info.filename}:{info.CRC}:{info.file_size}\n'
+                .encode('utf-8')
+            )
+    return fingerprint.hexdigest()
 
 
 def get_fernet_keys():
@@ -210,14 +505,21 @@ def convert_to_array(string_array):
 
     >>> convert_to_array("hello, world")
     []
+
+    >>> convert_to_array("")
+    []
     """
 
     def array_is_falsy(array_values):
         return not array_values or array_values == [None]
 
+    if SIMPLE_STRING_LIST_RE.fullmatch(string_array):
+        # Skip ``ast.literal_eval()`` for the most common case
+        return QUOTED_STRING_RE.findall(string_array)
+
     try:
         array_values = ast.literal_eval(string_array)
-    except ValueError:
+    except (ValueError, SyntaxError):
         return []
 
     if isinstance(array_values, tuple):
@@ -230,6 +532,38 @@ def convert_to_array(string_array):
     return array_values
 
 
+def convert_to_arrays(values):
+    """
+    Vectorized version of ``convert_to_array()`` for a column of lists.
+    Missing values are converted to empty lists.
+
+    >>> convert_to_arrays(["['a', 'b']", "[None]", None]).tolist()
+    [['a', 'b'], [], []]
+
+    """
+    return map_distinct_values(values, convert_to_array, na_value=[])
+
+
+def map_distinct_values(values, func, na_value=None):
+    """
+    Returns a Series of ``func(value)`` for ``values``, calling
+    ``func`` only once for each distinct value. Missing values are
+    mapped to ``na_value``.
+
+    >>> map_distinct_values(['a', 'b', 'a', None], str.upper).tolist()
+    ['A', 'B', 'A', None]
+
+    """
+    series = pandas.Series(values)
+    codes, uniques = pandas.factorize(series)
+    # A code of -1 is a missing value, so ``na_value`` goes last
+    mapped = numpy.empty(len(uniques) + 1, dtype=object)
+    for i, value in enumerate(uniques):
+        mapped[i] = func(value)
+    mapped[-1] = na_value
+    return pandas.Series(mapped[codes], index=series.index, dtype=object)
+
+
 def js_to_py_datetime(jsdt, preserve_tz=True):
     """
     JavaScript UTC datetimes end in "Z". In Python < 3.11,
@@ -3,7 +3,17 @@ import os
 
 import requests
 import superset
-from flask import Response, abort, flash, g, redirect, request, url_for
+from flask import (
+    Response,
+    abort,
+    current_app,
+    flash,
+    g,
+    jsonify,
+    redirect,
+    request,
+    url_for,
+)
 from flask_appbuilder import expose
 from flask_appbuilder.security.decorators import has_access, permission_name
 from superset import db
@@ -16,16 +26,28 @@ from superset.commands.dataset.delete import (
 from superset.connectors.sqla.models import SqlaTable
 from superset.views.base import BaseSupersetView
 
+from .concurrency import (
+    datasource_lock,
+    get_queued_import,
+    get_queued_imports,
+    queue_import,
+)
 from .hq_domain import user_domains
 from .hq_url import datasource_list
 from .hq_requests import HQRequest
+from .oauth import get_valid_cchq_oauth_token, save_oauth_token
 from .services import (
     AsyncImportHelper,
-    download_and_subscribe_to_datasource,
+    download_datasource_export,
     get_datasource_defn,
+    get_subscription_urls,
     refresh_hq_datasource,
 )
-from .tasks import refresh_hq_datasource_task
+from .tasks import (
+    dispatch_imports,
+    get_import_priority,
+    refresh_hq_datasource_task,
+)
 from .utils import (
     DomainSyncUtil,
     get_hq_database,
@@ -33,6 +55,10 @@ from .utils import (
 )
 
 ASYNC_DATASOURCE_IMPORT_LIMIT_IN_BYTES = 5_000_000  # ~5MB
+# Whether Import/Refresh only queue a Celery task, which fetches the
+# definition, downloads the export and imports it. Override with
+# ``HQ_ASYNC_DOWNLOADS`` in superset_config.py.
+ASYNC_DOWNLOADS = False
 
 logger = logging.getLogger(__name__)
 
@@ -55,11 +81,42 @@ class HQDatasourceView(BaseSupersetView):
         # Fetches data for a datasource from HQ and creates/updates a
         # Superset table
         display_name = request.args.get("name")
+        incremental = bool(request.args.get("incremental"))
         res = trigger_datasource_refresh(
-            g.hq_domain, datasource_id, display_name
+            g.hq_domain, datasource_id, display_name, incremental
         )
         return res
 
+    @expose("/import/", methods=["POST"])
+    def import_datasources(self):
+        # Queues imports of several datasources. Accepts a form, from
+        # the datasource list, or JSON: {"datasource_ids": [...]}
+        if request.is_json:
+            data = request.get_json(silent=True)
+            datasource_ids = (
+                data.get("datasource_ids", []) if isinstance(data, dict)
+                else None
+            )
+            if not (
+                isinstance(datasource_ids, list)
+                and all(isinstance(id_, str) for id_ in datasource_ids)
+            ):
+                return abort(
+                    400,
+                    description='Expected {"datasource_ids": [...]}',
+                )
+        else:
+            datasource_ids = request.form.getlist("datasource_ids")
+        queued = queue_import_tasks(g.hq_domain, datasource_ids)
+        if request.is_json:
+            return jsonify({"queued": queued})
+        flash(
+            f"{len(queued)} datasource(s) are being imported in the "
+            "background. This may take a while.",
+            "info",
+        )
+        return redirect("/hq_datasource/list/")
+
     @expose("/list/", methods=["GET"])
     def list_hq_datasources(self):
         hq_request = HQRequest(url=datasource_list(g.hq_domain))
@@ -85,10 +142,16 @@ class HQDatasourceView(BaseSupersetView):
                 status=400
             )
         hq_datasources = response.json()
+        queued_imports = get_queued_imports(g.hq_domain)
+        waiting_ids = {
+            item.datasource_id for item in queued_imports
+            if not item.is_running
+        }
         for ds in hq_datasources['objects']:
             ds['is_import_in_progress'] = AsyncImportHelper(
                 g.hq_domain, ds['id']
             ).is_import_in_progress()
+            ds['is_import_queued'] = ds['id'] in waiting_ids
         return self.render_template(
             "hq_datasource_list.html",
             hq_datasources=hq_datasources,
@@ -115,8 +178,18 @@ class HQDatasourceView(BaseSupersetView):
         return redirect("/tablemodelview/list/")
 
 
-def trigger_datasource_refresh(domain, datasource_id, display_name):
-    if AsyncImportHelper(domain, datasource_id).is_import_in_progress():
+def trigger_datasource_refresh(
+    domain,
+    datasource_id,
+    display_name,
+    incremental=False,
+):
+    if (
+        AsyncImportHelper(domain, datasource_id).is_import_in_progress()
+        # Queued imports are started by the dispatcher, and would load
+        # into the same staging table as this refresh
+        or get_queued_import(domain, datasource_id)
+    ):
         flash(
             "The datasource is already being imported in the background. "
             "Please wait for it to finish before retrying.",
@@ -124,13 +197,60 @@ def trigger_datasource_refresh(domain, datasource_id, display_name):
         )
         return redirect("/tablemodelview/list/")
 
-    path, size = download_and_subscribe_to_datasource(domain, datasource_id)
+    if current_app.config.get('HQ_ASYNC_DOWNLOADS', ASYNC_DOWNLOADS):
+        # Fetching the definition and downloading the export can take
+        # longer than a web request is allowed. Leave it all to Celery.
+        queue_import_tasks(domain, [datasource_id], incremental)
+        flash(
+            f"The datasource \"{display_name}\" is being imported in the "
+            "background. This may take a while, please wait for it to "
+            "finish.",
+            "info",
+        )
+        return redirect("/tablemodelview/list/")
+
     datasource_defn = get_datasource_defn(domain, datasource_id)
-    if size < ASYNC_DATASOURCE_IMPORT_LIMIT_IN_BYTES:
-        refresh_hq_datasource(
-            domain, datasource_id, display_name, path, datasource_defn, None
+    export = download_datasource_export(
+        domain,
+        datasource_id,
+        datasource_defn,
+        incremental,
+    )
+    if export is None:
+        flash(
+            f"The datasource \"{display_name}\" is already up to date.",
+            "info",
         )
-        os.remove(path)
+        return redirect("/tablemodelview/list/")
+    # A backfill alters the dataset's table first, which is not done in
+    # the web request.
+    if (
+        export.size < ASYNC_DATASOURCE_IMPORT_LIMIT_IN_BYTES
+        and not export.backfill_columns
+    ):
+        # Held like the lock of an import task, so that the staging
+        # table is not taken to be orphaned (see
+        # ``remove_stale_exports()``)
+        with datasource_lock(datasource_id) as acquired:
+            if acquired:
+                refresh_hq_datasource(
+                    domain,
+                    datasource_id,
+                    display_name,
+                    export.path,
+                    datasource_defn,
+                    None,
+                    export.incremental,
+                    export.fingerprint,
+                    export.backfill_columns,
+                )
+        os.remove(export.path)
+        if not acquired:
+            flash(
+                "The datasource is already being imported in the "
+                "background. Please wait for it to finish before retrying.",
+                "warning",
+            )
         return redirect("/tablemodelview/list/")
     else:
         limit_in_mb = int(ASYNC_DATASOURCE_IMPORT_LIMIT_IN_BYTES / 1000000)
@@ -144,9 +264,12 @@ def trigger_datasource_refresh(domain, datasource_id, display_name):
             domain,
             datasource_id,
             display_name,
-            path,
+            export.path,
             datasource_defn,
             g.user.get_id(),
+            export.incremental,
+            export.fingerprint,
+            export.backfill_columns,
         )
 
 
@@ -157,19 +280,63 @@ def queue_refresh_task(
     export_path,
     datasource_defn,
     user_id,
+    incremental=False,
+    fingerprint=None,
+    backfill_columns=None,
 ):
-    task_id = refresh_hq_datasource_task.delay(
-        domain,
-        datasource_id,
-        display_name,
-        export_path,
-        datasource_defn,
-        g.user.get_id(),
+    priority = get_import_priority(
+        size=os.path.getsize(export_path),
+        incremental=incremental,
+    )
+    task_id = refresh_hq_datasource_task.apply_async(
+        args=(
+            domain,
+            datasource_id,
+            display_name,
+            export_path,
+            datasource_defn,
+            g.user.get_id(),
+            incremental,
+            fingerprint,
+            backfill_columns,
+        ),
+        priority=priority,
     ).task_id
     AsyncImportHelper(domain, datasource_id).mark_as_in_progress(task_id)
     return redirect("/tablemodelview/list/")
 
 
+def queue_import_tasks(domain, datasource_ids, incremental=False):
+    """
+    Adds an import of each of ``datasource_ids`` to the import queue,
+    unless it is already queued or being imported, and starts the
+    imports that have free slots. If ``incremental`` is True,
+    datasources that have been imported are refreshed incrementally.
+    Domains take turns to run their imports (see
+    ``hq_superset.concurrency``).
+
+    Returns the IDs of the datasources that were queued.
+    """
+    # Imports run outside of the user's session and this request
+    save_oauth_token(g.user.get_id(), get_valid_cchq_oauth_token())
+    subscription_urls = get_subscription_urls()
+    queued = []
+    for datasource_id in dict.fromkeys(datasource_ids):
+        if AsyncImportHelper(domain, datasource_id).is_import_in_progress():
+            continue
+        if queue_import(
+            domain,
+            datasource_id,
+            g.user.get_id(),
+            incremental,
+            subscription_urls,
+        ):
+            queued.append(datasource_id)
+    if queued:
+        dispatch_imports()
+    return queued
+
+
 class SelectDomainView(BaseSupersetView):
     """
     Select a Domain view, all roles that have 'profile' access on
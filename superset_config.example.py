@@ -13,7 +13,7 @@ from flask_appbuilder.security.manager import AUTH_DB, AUTH_OAUTH
 from sentry_sdk.integrations.flask import FlaskIntegration
 
 from hq_superset import flask_app_mutator, oauth
-from hq_superset.const import OAUTH2_DATABASE_NAME
+from hq_superset.const import OAUTH2_DATABASE_NAME, TASK_ROUTES
 
 # Use a tool to generate a sufficiently random string, e.g.
 #     $ openssl rand -base64 42
@@ -78,11 +78,111 @@ AUTH_USER_ADDITIONAL_ROLES = ["sql_lab"]
 # This is where async UCR imports are stored temporarily
 SHARED_DIR = 'shared_dir'
 
+# Memory, in bytes, that each UCR import may use for chunks of parsed
+# data. The number of rows read at a time is worked out from this and
+# the size of the UCR's rows. Lower it if Celery workers run out of
+# memory; raise it to import narrow UCRs faster.
+# HQ_IMPORT_MEMORY_BUDGET = 256 * 1024 * 1024  # 256MB
+
+# Number of database connections each UCR import uses to load data into
+# the HQ database in parallel. Only applies when HQ_DATABASE_URI is a
+# PostgreSQL database.
+# HQ_IMPORT_WRITERS = 2
+
+# Number of connections used to download each UCR export. If CommCare HQ
+# accepts HTTP range requests for an export, it is downloaded in 64MB
+# segments, several at a time. If a download is interrupted, the next
+# download of the same export only fetches the missing segments.
+# Set to 1 to download exports in a single request.
+# HQ_DOWNLOAD_CONNECTIONS = 4
+
+# Number of CSV files that each UCR import parses at the same time, if
+# a UCR export is split into several CSV files. Defaults to the number
+# of CPUs.
+# HQ_IMPORT_PARSERS = 4
+
+# Parser for UCR exports: "pandas" or "pyarrow". PyArrow parses using
+# several threads, and is faster for large UCRs. If PyArrow is not
+# installed, "pandas" is used.
+# HQ_IMPORT_CSV_ENGINE = 'pyarrow'
+
+# Formats to request UCR exports from CommCare HQ in, in order of
+# preference: "parquet", "arrow" (Arrow IPC) or "csv". Columnar formats
+# are typed, so they are loaded without parsing. They need PyArrow. If
+# CommCare HQ does not offer a format, the next one is requested, and
+# CSV is always the last resort.
+# HQ_EXPORT_FORMATS = ['parquet', 'csv']
+
+# Load UCR imports into UNLOGGED staging tables. Unlogged tables skip
+# PostgreSQL's write-ahead log (WAL), so imports are faster and do not
+# flood replicas with WAL while rows are loaded. When the import is
+# done, the table is switched to a regular table, which writes it to the
+# WAL once. Only applies when HQ_DATABASE_URI is a PostgreSQL database.
+# HQ_IMPORT_UNLOGGED_STAGING = True
+
+# Leave imported tables UNLOGGED when they go live. This avoids writing
+# them to the WAL at all, but an unlogged table is emptied if the
+# database server crashes, and is empty on replicas, so dashboards that
+# use a replica show no data. A crashed table is filled again by the
+# next refresh of its data source.
+# HQ_IMPORT_KEEP_UNLOGGED = True
+
+# Store the tables of very large UCRs as PostgreSQL tables partitioned
+# by month of a date column, e.g. "inserted_at" or a date indicator.
+# Partitions are created as data is imported, or forwarded by CommCare
+# HQ. Dashboards that filter on the column only read the partitions they
+# need, and old data can be removed by dropping its partitions, which
+# are named "<data source ID>_pYYYYMM". Takes effect on the next full
+# refresh of the data source.
+# HQ_PARTITIONED_DATASOURCES = {
+#     '<data source ID>': 'inserted_at',
+# }
+
+# Where to send the metrics of each stage of UCR imports: download and
+# parse times, rows loaded per second, the worker's peak memory, etc.
+# The default sink logs them. To send them to Superset's STATS_LOGGER
+# (e.g. StatsD), or to a Prometheus Pushgateway (requires
+# prometheus_client). Celery workers can't be scraped, so Prometheus
+# reads the metrics from the Pushgateway. They are labelled by stage and
+# domain, not data source. Peak memory is the largest of all the imports
+# that the worker process has run; to measure each import on its own,
+# run the import workers with --max-tasks-per-child=1.
+# from hq_superset.metrics import (
+#     PrometheusMetricsSink,
+#     StatsLoggerMetricsSink,
+# )
+# HQ_IMPORT_METRICS_SINK = StatsLoggerMetricsSink()
+# HQ_IMPORT_METRICS_SINK = PrometheusMetricsSink('localhost:9091')
+# A sink can be any object with a `send(stage, metrics, tags)` method.
+
+# The number of UCR imports that Celery workers run at the same time, in
+# total and for each domain. Other imports wait for a turn. Importing
+# several UCRs at once, from the "Import selected" button on the UCR
+# list, queues them all. Only applies when HQ_DATABASE_URI is a
+# PostgreSQL database.
+# HQ_IMPORT_CONCURRENCY = 4
+# HQ_IMPORT_CONCURRENCY_PER_DOMAIN = 2
+
+# Domains take turns to run queued imports. A domain with a weight of 2
+# gets twice as many turns as a domain with the default weight of 1.
+# Weights must be greater than 0. The number of waiting and running imports of each domain, and how
+# long they wait, are sent to HQ_IMPORT_METRICS_SINK.
+# HQ_IMPORT_DOMAIN_WEIGHTS = {
+#     '<domain>': 2,
+# }
+
 # If this is enabled, UCRs larger than
 #   hq_superset.views.ASYNC_DATASOURCE_IMPORT_LIMIT_IN_BYTES
 #   are imported via Celery/Redis.
 ENABLE_ASYNC_UCR_IMPORTS = False
 
+# Import and refresh UCRs entirely in Celery. The web request only
+# queues a task, which fetches the UCR's definition, downloads its
+# export, and imports it, so large exports do not tie up web workers or
+# hit request timeouts. Otherwise the export is downloaded in the web
+# request, and small UCRs are imported there too.
+# HQ_ASYNC_DOWNLOADS = True
+
 # Enable below for sentry integration
 sentry_sdk.init(
     dsn='',
@@ -115,8 +215,25 @@ class CeleryConfig:
     )
     result_backend = _REDIS_URL
     worker_log_level = 'DEBUG'
+    # Workers for the UCR import queue override this with
+    # `--prefetch-multiplier=1` (see README.md)
     worker_prefetch_multiplier = 10
     task_acks_late = True
+    # UCR imports run on their own queue, "hq_imports", so that they do
+    # not hold up SQL Lab queries. Run a separate worker for it.
+    task_routes = TASK_ROUTES
+    broker_transport_options = {
+        # Small imports and incremental refreshes are given a higher
+        # priority than large imports (see hq_superset.const).
+        'priority_steps': list(range(10)),
+        'queue_order_strategy': 'priority',
+        # With `task_acks_late`, Redis gives a task to another worker if
+        # it is not done within this time. It must be longer than the
+        # longest UCR import, and shorter than
+        # `hq_superset.services.STALE_EXPORT_AGE`, after which the
+        # exports of tasks that are not running are deleted.
+        'visibility_timeout': 6 * 60 * 60,  # 6 hours
+    }
     task_annotations = {
         'sql_lab.get_sql_results': {
             'rate_limit': '100/s',
@@ -133,6 +250,13 @@ class CeleryConfig:
             'task': 'email_reports.schedule_hourly',
             'schedule': crontab(minute='1', hour='*'),
         },
+        # Starts queued UCR imports that were missed, and deletes the
+        # exports of imports that did not finish, e.g. because a worker
+        # died
+        'dispatch_hq_imports_task': {
+            'task': 'dispatch_hq_imports_task',
+            'schedule': crontab(minute='*'),
+        },
     }
 
 